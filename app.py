@@ -1,17 +1,29 @@
 import os
 import re
 import io
+import csv
 import json
 import time
 import random
+import hashlib
+import hmac
+import secrets
+import shutil
+import sqlite3
+import threading
 import yaml
+from collections import OrderedDict
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from typing import Dict, Any, List, Optional, Tuple
 
 import streamlit as st
 
 # Data + charts
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import plotly.express as px
 import plotly.graph_objects as go
 
@@ -73,7 +85,7 @@ I18N = {
         "agents_exec": "Agent Execution",
         "chain_agents": "Chain Agents",
         "start_chain": "Start Chain (step-by-step)",
-        "run_all": "Run Chain (auto)",
+        "run_all": "Run Chain (background)",
         "reset_chain": "Reset Chain Session",
         "agent_config": "Agent Config",
         "model": "Model",
@@ -188,7 +200,7 @@ I18N = {
         "agents_exec": "Agent 執行",
         "chain_agents": "串接 Agents",
         "start_chain": "開始串接（逐步）",
-        "run_all": "執行串接（自動）",
+        "run_all": "執行串接（背景）",
         "reset_chain": "重置串接工作階段",
         "agent_config": "Agent 設定",
         "model": "模型",
@@ -446,6 +458,18 @@ def ss_init():
             "overrides": {},
         }
 
+    if "llm_cache_enabled" not in st.session_state:
+        st.session_state.llm_cache_enabled = False  # opt-in response cache
+
+    if "jobs" not in st.session_state:
+        st.session_state.jobs = []  # background job ids started from this session
+    if "jobs_logged" not in st.session_state:
+        st.session_state.jobs_logged = []  # finished jobs already copied into execution_log
+    if "active_job" not in st.session_state:
+        st.session_state.active_job = None  # job shown in the Agents tab
+    if "job_owner" not in st.session_state:
+        st.session_state.job_owner = secrets.token_urlsafe(24)  # owner secret of this session's jobs (?job_key=)
+
     if "runs" not in st.session_state:
         st.session_state.runs = 0
     if "last_run_ts" not in st.session_state:
@@ -473,10 +497,32 @@ def ss_init():
         st.session_state.dist_dataset_name = "default_distribution_dataset"
     if "dist_df" not in st.session_state:
         st.session_state.dist_df = None  # standardized df
+    if "dist_extras" not in st.session_state:
+        st.session_state.dist_extras = None  # unmapped columns as (row, field, value)
+    if "dist_cube" not in st.session_state:
+        st.session_state.dist_cube = None  # aggregate cube of dist_df (see build_distribution_cube)
+        st.session_state.dist_cube_src = None  # the dist_df object the cube was built from
+        st.session_state.dist_cube_index = None  # DistributionFilterIndex over the cube
+        st.session_state.dist_row_index = None  # DistributionFilterIndex over dist_df, built on first use
+        st.session_state.dist_cube_cells = None  # RowHashIndex: cube cell -> position, built on first append
+        st.session_state.dist_drill_index = None  # NodeDrillIndex over the cube, built on the first node click
+        st.session_state.dist_drill_src = None  # the cube it was built from
+    if "dist_append_log" not in st.session_state:
+        st.session_state.dist_append_log = []
+        st.session_state.dist_dedup_index = None  # RowHashIndex over dist_df's dedup key
+        st.session_state.dist_dedup_for = None  # (dist_df, dedup key) the index belongs to
+    if "dist_cache_info" not in st.session_state:
+        st.session_state.dist_cache_info = None  # last standardize: {"tier": memory|disk|miss, "key", "ms"}
     if "dist_prompt_by_dataset" not in st.session_state:
         st.session_state.dist_prompt_by_dataset = {}  # dataset_name -> prompt string
     if "dist_summary_md" not in st.session_state:
         st.session_state.dist_summary_md = ""
+    if "sql_stream" not in st.session_state:
+        st.session_state.sql_stream = None  # SqlResultStream of the last SQL console query
+        st.session_state.sql_page = 0
+        st.session_state.sql_error = None
+    if "sql_query" not in st.session_state:
+        st.session_state.sql_query = "SELECT SupplierID, COUNT(*) AS shipments, SUM(Number) AS units\nFROM shipments\nGROUP BY 1\nORDER BY units DESC"
 
 
 ss_init()
@@ -509,6 +555,24 @@ MODEL_CHOICES = [
     "grok-3-mini",
 ]
 
+# (context window, max output tokens) per model. Unknown models fall back to DEFAULT_CONTEXT_LIMIT.
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o-mini": (128_000, 16_384),
+    "gpt-4.1-mini": (1_047_576, 32_768),
+    "gemini-2.5-flash": (1_048_576, 65_536),
+    "gemini-2.5-flash-lite": (1_048_576, 65_536),
+    "gemini-3-flash-preview": (1_048_576, 65_536),
+    "claude-3-5-sonnet-latest": (200_000, 8_192),
+    "claude-3-5-haiku-latest": (200_000, 8_192),
+    "claude-3-opus-latest": (200_000, 4_096),
+    "grok-4-fast-reasoning": (2_000_000, 30_000),
+    "grok-3-mini": (131_072, 16_384),
+}
+DEFAULT_CONTEXT_LIMIT = (128_000, 8_192)
+
+def model_context_limit(model: str) -> Tuple[int, int]:
+    return MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+
 DIST_SUMMARY_MODELS = ["gemini-2.5-flash", "gemini-3-flash-preview", "gpt-4o-mini"]
 
 STANDARD_COLS = [
@@ -533,10 +597,38 @@ SYNONYMS = {
 def now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+def new_run_id(prefix: str) -> str:
+    # random, not time-based: job ids name files under JOBS_DIR and must not collide or be guessable
+    return f"{prefix}-{secrets.token_urlsafe(12)}"
+
+# CJK ideographs, kana/hangul, full-width forms and CJK punctuation: roughly one token each.
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef\u3000-\u303f]")
+TOKENIZER_SAMPLE_CHARS = 200_000
+
+@st.cache_resource(show_spinner=False)
+def get_local_tokenizer():
+    # Optional: tiktoken's o200k_base is exact for gpt-4o/4.1 and a close proxy for the others.
+    try:
+        import tiktoken  # type: ignore
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
 def estimate_tokens(text: str) -> int:
     if not text:
         return 0
-    return max(1, int(len(text) / 4))
+    enc = get_local_tokenizer()
+    if enc is not None:
+        try:
+            if len(text) <= TOKENIZER_SAMPLE_CHARS:
+                return max(1, len(enc.encode(text, disallowed_special=())))
+            # Very large inputs: tokenize a prefix and scale, to keep reruns cheap.
+            sample = text[:TOKENIZER_SAMPLE_CHARS]
+            return max(1, int(len(enc.encode(sample, disallowed_special=())) * len(text) / len(sample)))
+        except Exception:
+            pass
+    cjk = len(_CJK_RE.findall(text))
+    return max(1, cjk + int((len(text) - cjk) / 4))
 
 def escape_html(s: str) -> str:
     if s is None:
@@ -584,6 +676,585 @@ def get_api_key(env_var: str) -> Tuple[Optional[str], bool]:
     v = st.session_state.ui_keys.get(env_var, "")
     return (v if v else None), False
 
+# =========================
+# LLM client pool (process-wide, shared across sessions)
+# =========================
+PROVIDER_BASE_URLS = {
+    "grok": "https://api.x.ai/v1",
+}
+
+LLM_HTTP_TIMEOUT_S = float(os.environ.get("LLM_HTTP_TIMEOUT_S", "120"))
+LLM_HTTP_CONNECT_TIMEOUT_S = float(os.environ.get("LLM_HTTP_CONNECT_TIMEOUT_S", "10"))
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "32"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "16"))
+LLM_CLIENT_IDLE_TTL_S = float(os.environ.get("LLM_CLIENT_IDLE_TTL_S", "1800"))
+LLM_CLIENT_MAX_ENTRIES = int(os.environ.get("LLM_CLIENT_MAX_ENTRIES", "64"))
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+def _make_httpx_client(sdk_module):
+    import httpx  # type: ignore
+    return sdk_module.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=60.0,
+        ),
+        timeout=httpx.Timeout(LLM_HTTP_TIMEOUT_S, connect=LLM_HTTP_CONNECT_TIMEOUT_S),
+    )
+
+class LLMClientPool:
+    """
+    Thread-safe registry of SDK clients keyed by (provider, api_key, base_url).
+    OpenAI/Grok/Anthropic clients each own one keep-alive httpx pool; Gemini gets a
+    per-key GenerativeServiceClient so sessions never race on genai.configure().
+    Entries idle longer than idle_ttl_s are closed; beyond max_entries the LRU entry is dropped.
+    """
+
+    def __init__(self, idle_ttl_s: float, max_entries: int):
+        self.idle_ttl_s = idle_ttl_s
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+        self._retired: List[Tuple[float, Any]] = []  # (last_used, client) dropped while possibly in flight
+
+    def get(self, provider: str, api_key: str, base_url: Optional[str] = None):
+        base_url = base_url or PROVIDER_BASE_URLS.get(provider, "")
+        key = (provider, key_fingerprint(api_key), base_url)
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            self._close_retired(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["last_used"] = now
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["client"]
+            self.misses += 1
+
+        # Build outside the lock: first-time SDK imports can take a while.
+        client = self._build(provider, api_key, base_url)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Another session built the same client concurrently; keep theirs.
+                self._close(client)
+                entry["last_used"] = now
+                return entry["client"]
+            self._entries[key] = {"client": client, "created": now, "last_used": now}
+            while len(self._entries) > self.max_entries:
+                _, old = self._entries.popitem(last=False)
+                self.evictions += 1
+                self._retire(old, now)
+        return client
+
+    def _retire(self, entry: Dict[str, Any], now: float) -> None:
+        # An in-flight call may still hold it; only close once past the request timeout.
+        if now - entry["last_used"] > LLM_HTTP_TIMEOUT_S:
+            self._close(entry["client"])
+        else:
+            self._retired.append((entry["last_used"], entry["client"]))
+
+    def _close_retired(self, now: float) -> None:
+        keep = []
+        for last_used, client in self._retired:
+            if now - last_used > LLM_HTTP_TIMEOUT_S:
+                self._close(client)
+            else:
+                keep.append((last_used, client))
+        self._retired = keep
+
+    def _evict_idle(self, now: float) -> None:
+        stale = [k for k, e in self._entries.items() if now - e["last_used"] > self.idle_ttl_s]
+        for k in stale:
+            self._retire(self._entries.pop(k), now)
+            self.evictions += 1
+
+    def _build(self, provider: str, api_key: str, base_url: str):
+        if provider in ("openai", "grok"):
+            import openai  # type: ignore
+            # Retries are owned by the LLM scheduler, so the SDK's own retry loop is disabled.
+            return openai.OpenAI(api_key=api_key, base_url=base_url or None, max_retries=0, http_client=_make_httpx_client(openai))
+        if provider == "anthropic":
+            import anthropic  # type: ignore
+            return anthropic.Anthropic(api_key=api_key, base_url=base_url or None, max_retries=0, http_client=_make_httpx_client(anthropic))
+        if provider == "gemini":
+            from google.ai import generativelanguage as glm  # type: ignore
+            return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        raise ValueError(f"Unknown provider '{provider}'.")
+
+    @staticmethod
+    def _close(client) -> None:
+        try:
+            if hasattr(client, "close"):
+                client.close()
+            elif hasattr(client, "transport"):
+                client.transport.close()
+        except Exception:
+            pass
+
+    def clear(self) -> None:
+        """Drop every client; ones used within the request timeout are closed on a later get()."""
+        now = time.time()
+        with self._lock:
+            for e in self._entries.values():
+                self._retire(e, now)
+            self._entries.clear()
+            self._close_retired(now)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            return {
+                "clients": [
+                    {
+                        "provider": k[0],
+                        "key": k[1],
+                        "base_url": k[2] or "(default)",
+                        "idle_s": round(now - e["last_used"], 1),
+                        "age_s": round(now - e["created"], 1),
+                    }
+                    for k, e in self._entries.items()
+                ],
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_llm_client_pool() -> LLMClientPool:
+    return LLMClientPool(idle_ttl_s=LLM_CLIENT_IDLE_TTL_S, max_entries=LLM_CLIENT_MAX_ENTRIES)
+
+# =========================
+# LLM response cache (opt-in; memory LRU + SQLite on disk)
+# =========================
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", ".cache")
+LLM_CACHE_MEMORY_ENTRIES = int(os.environ.get("LLM_CACHE_MEMORY_ENTRIES", "256"))
+LLM_CACHE_TTL_S = float(os.environ.get("LLM_CACHE_TTL_S", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+def llm_cache_key(
+    provider: str,
+    model: str,
+    system_prompt: str,
+    user_prompt: str,
+    temperature: float,
+    max_tokens: int,
+) -> str:
+    payload = json.dumps(
+        [provider, model, system_prompt or "", user_prompt or "", round(float(temperature), 4), int(max_tokens)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LLMResponseCache:
+    """
+    Content-addressed completion cache. A small in-memory LRU sits in front of a SQLite table;
+    disk entries expire after ttl_s and the oldest-accessed rows are dropped beyond max_bytes.
+    """
+
+    def __init__(self, path: str, memory_entries: int, ttl_s: float, max_bytes: int):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, Tuple[str, Dict[str, Any], float]]" = OrderedDict()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, meta TEXT NOT NULL, "
+            "created REAL NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None and now - item[2] <= self.ttl_s:
+                self._mem.move_to_end(key)
+                self.hits["memory"] += 1
+                return item[0], dict(item[1], cache="hit", cache_tier="memory")
+            row = self._db.execute("SELECT text, meta, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[2] > self.ttl_s:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            text, meta = row[0], json.loads(row[1])
+            self._remember(key, text, meta, row[2])
+            self.hits["disk"] += 1
+            return text, dict(meta, cache="hit", cache_tier="disk")
+
+    def put(self, key: str, text: str, meta: Dict[str, Any]) -> None:
+        now = time.time()
+        stored = {k: v for k, v in meta.items() if k not in ("cache", "cache_tier")}
+        meta_json = json.dumps(stored, ensure_ascii=False, default=str)
+        size = len(text.encode("utf-8")) + len(meta_json.encode("utf-8"))
+        with self._lock:
+            self._remember(key, text, json.loads(meta_json), now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, text, meta, created, last_access, size) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, meta_json, now, now, size),
+            )
+            self._evict_disk(now)
+            self._db.commit()
+
+    def _remember(self, key: str, text: str, meta: Dict[str, Any], created: float) -> None:
+        self._mem[key] = (text, meta, created)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_entries:
+            self._mem.popitem(last=False)
+
+    def _evict_disk(self, now: float) -> None:
+        cur = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_s,))
+        self.evictions += max(cur.rowcount, 0)
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._mem.pop(key, None)
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            rows, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return {
+                "memory_entries": len(self._mem),
+                "disk_entries": int(rows),
+                "disk_bytes": int(size),
+                "hits_memory": self.hits["memory"],
+                "hits_disk": self.hits["disk"],
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_llm_response_cache() -> LLMResponseCache:
+    return LLMResponseCache(
+        path=os.path.join(LLM_CACHE_DIR, "llm_responses.sqlite"),
+        memory_entries=LLM_CACHE_MEMORY_ENTRIES,
+        ttl_s=LLM_CACHE_TTL_S,
+        max_bytes=LLM_CACHE_MAX_BYTES,
+    )
+
+# =========================
+# LLM scheduler: per-(provider, model) token buckets + retry with backoff
+# =========================
+PROVIDER_LABELS = {"openai": "OpenAI", "gemini": "Gemini", "anthropic": "Anthropic", "grok": "Grok"}
+
+# Requests/min and tokens/min budgets. Tokens are counted as prompt estimate + max_tokens,
+# like the providers' own rate limiters; unused completion budget is refunded afterwards.
+PROVIDER_RATE_LIMITS = {
+    "openai": {"rpm": int(os.environ.get("OPENAI_RPM", "500")), "tpm": int(os.environ.get("OPENAI_TPM", "200000"))},
+    "gemini": {"rpm": int(os.environ.get("GEMINI_RPM", "1000")), "tpm": int(os.environ.get("GEMINI_TPM", "1000000"))},
+    "anthropic": {"rpm": int(os.environ.get("ANTHROPIC_RPM", "50")), "tpm": int(os.environ.get("ANTHROPIC_TPM", "80000"))},
+    "grok": {"rpm": int(os.environ.get("GROK_RPM", "60")), "tpm": int(os.environ.get("GROK_TPM", "100000"))},
+}
+MODEL_RATE_LIMITS: Dict[str, Dict[str, int]] = {}  # per-model overrides, e.g. {"gpt-4.1-mini": {"rpm": 200, "tpm": 100000}}
+
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_S = float(os.environ.get("LLM_BACKOFF_BASE_S", "1.0"))
+LLM_BACKOFF_MAX_S = float(os.environ.get("LLM_BACKOFF_MAX_S", "30"))
+LLM_QUEUE_TIMEOUT_S = float(os.environ.get("LLM_QUEUE_TIMEOUT_S", "120"))
+
+@dataclass
+class LLMError:
+    """Typed failure returned in meta["error"] instead of a fake completion text."""
+    kind: str  # rate_limited | server_error | timeout | connection | auth | bad_request | queue_timeout | missing_api_key | upstream_failed | cancelled | batch_failed | unknown
+    message: str
+    provider: str = ""
+    status: Optional[int] = None
+    retry_after_s: Optional[float] = None
+    attempts: int = 0
+    retryable: bool = False
+
+    def __str__(self) -> str:
+        label = PROVIDER_LABELS.get(self.provider, self.provider or "LLM")
+        status = f" HTTP {self.status}" if self.status else ""
+        tries = f" after {self.attempts} attempt(s)" if self.attempts > 1 else ""
+        return f"({label} call failed: {self.kind}{status}{tries} — {self.message})"
+
+def _retry_after_seconds(e: Exception) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        ra = headers.get("retry-after")
+        if ra:
+            try:
+                return float(ra)
+            except ValueError:
+                from email.utils import parsedate_to_datetime
+                return max(0.0, parsedate_to_datetime(ra).timestamp() - time.time())
+    except Exception:
+        return None
+    return None
+
+def classify_llm_exception(provider: str, e: Exception) -> LLMError:
+    status = getattr(e, "status_code", None)
+    if status is None and isinstance(getattr(e, "code", None), int):
+        status = e.code  # google.api_core exceptions
+    name = type(e).__name__
+    msg = str(e)[:500]
+    if status == 429 or name in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return LLMError("rate_limited", msg, provider, 429, _retry_after_seconds(e), retryable=True)
+    if status is not None and status >= 500 or name in ("InternalServerError", "ServiceUnavailable", "OverloadedError"):
+        return LLMError("server_error", msg, provider, status, _retry_after_seconds(e), retryable=True)
+    if "Timeout" in name or name == "DeadlineExceeded":
+        return LLMError("timeout", msg, provider, status, retryable=True)
+    if name in ("APIConnectionError", "ConnectError", "ConnectionError", "RemoteProtocolError"):
+        return LLMError("connection", msg, provider, status, retryable=True)
+    if status in (401, 403) or name in ("AuthenticationError", "PermissionDeniedError", "PermissionDenied", "Unauthenticated"):
+        return LLMError("auth", msg, provider, status)
+    if status is not None and 400 <= status < 500:
+        return LLMError("bad_request", msg, provider, status)
+    return LLMError("unknown", f"{name}: {msg}", provider, status)
+
+def backoff_delay(attempt: int, retry_after_s: Optional[float] = None) -> float:
+    # Full jitter, but never earlier than the server asked for.
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX_S, LLM_BACKOFF_BASE_S * (2 ** attempt)))
+    if retry_after_s is not None:
+        delay = max(delay, retry_after_s + random.uniform(0, 0.5))
+    return min(delay, LLM_BACKOFF_MAX_S * 2)
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float) -> float:
+        """Take `amount` if available and return 0, else return the seconds to wait."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def refund(self, amount: float) -> None:
+        with self._lock:
+            self._refill(time.time())
+            self.tokens = min(self.capacity, self.tokens + max(0.0, amount))
+
+    def block_for(self, seconds: float) -> None:
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+class LLMScheduler:
+    """Process-wide RPM/TPM buckets per (provider, model); a 429 pauses that bucket for every session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[str, str], Dict[str, TokenBucket]] = {}
+        self.waits = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def _get(self, provider: str, model: str) -> Dict[str, TokenBucket]:
+        key = (provider, model)
+        with self._lock:
+            b = self._buckets.get(key)
+            if b is None:
+                lim = MODEL_RATE_LIMITS.get(model) or PROVIDER_RATE_LIMITS.get(provider) or {"rpm": 60, "tpm": 100000}
+                b = {"rpm": TokenBucket(lim["rpm"]), "tpm": TokenBucket(lim["tpm"])}
+                self._buckets[key] = b
+            return b
+
+    def acquire(
+        self,
+        provider: str,
+        model: str,
+        tokens: int,
+        timeout_s: float = LLM_QUEUE_TIMEOUT_S,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> float:
+        """Block until one request and `tokens` fit the budgets; returns seconds waited.
+        Raises InterruptedError (nothing taken) once cancel_event is set."""
+        b = self._get(provider, model)
+        started = time.time()
+        waited_once = False
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                raise InterruptedError("cancelled while queued")
+            wait_s = b["rpm"].try_take(1)
+            if wait_s == 0:
+                wait_s = b["tpm"].try_take(tokens)
+                if wait_s == 0:
+                    return round(time.time() - started, 3)
+                b["rpm"].refund(1)
+            if time.time() - started + wait_s > timeout_s:
+                raise TimeoutError(f"rate-limit queue wait would exceed {timeout_s:.0f}s")
+            if not waited_once:
+                with self._lock:
+                    self.waits += 1
+                waited_once = True
+            if cancel_event is not None:
+                cancel_event.wait(min(wait_s, 1.0))
+            else:
+                time.sleep(min(wait_s, 1.0))
+
+    def refund_tokens(self, provider: str, model: str, tokens: int) -> None:
+        if tokens > 0:
+            self._get(provider, model)["tpm"].refund(tokens)
+
+    def penalize(self, provider: str, model: str, seconds: float) -> None:
+        with self._lock:
+            self.rate_limited += 1
+        for bucket in self._get(provider, model).values():
+            bucket.block_for(seconds)
+
+    def note_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            rows = []
+            for (provider, model), b in self._buckets.items():
+                for name, bucket in b.items():
+                    with bucket._lock:
+                        bucket._refill(now)
+                        rows.append({
+                            "provider": provider, "model": model, "budget": name,
+                            "available": int(bucket.tokens), "per_minute": int(bucket.capacity),
+                            "paused_s": round(max(0.0, bucket.blocked_until - now), 1),
+                        })
+            return {"buckets": rows, "waits": self.waits, "retries": self.retries, "rate_limited": self.rate_limited}
+
+@st.cache_resource(show_spinner=False)
+def get_llm_scheduler() -> LLMScheduler:
+    return LLMScheduler()
+
+# USD per 1M tokens (input, output) at list price; update when providers change pricing.
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-3-flash-preview": (0.50, 3.00),
+    "claude-3-5-sonnet-latest": (3.00, 15.00),
+    "claude-3-5-haiku-latest": (0.80, 4.00),
+    "claude-3-opus-latest": (15.00, 75.00),
+    "grok-4-fast-reasoning": (0.20, 0.50),
+    "grok-3-mini": (0.30, 0.50),
+}
+
+def normalize_usage(usage) -> Optional[Dict[str, int]]:
+    """Map OpenAI/Grok, Anthropic and Gemini usage objects onto input/output/total token counts."""
+    if usage is None:
+        return None
+
+    def get(k):
+        return usage.get(k) if isinstance(usage, dict) else getattr(usage, k, None)
+
+    def first(*ks):
+        for k in ks:
+            v = get(k)
+            if isinstance(v, (int, float)):
+                return int(v)
+        return None
+
+    inp = first("prompt_tokens", "input_tokens", "prompt_token_count")
+    out = first("completion_tokens", "output_tokens", "candidates_token_count")
+    if inp is None and out is None:
+        return None
+    inp, out = inp or 0, out or 0
+    norm = {"input_tokens": inp, "output_tokens": out, "total_tokens": first("total_tokens", "total_token_count") or inp + out}
+    cached = first("cache_read_input_tokens", "cached_content_token_count")
+    details = get("prompt_tokens_details")
+    if cached is None and details is not None:
+        cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    if cached:
+        norm["cached_input_tokens"] = int(cached)
+    return norm
+
+def estimate_cost_usd(model: str, usage: Optional[Dict[str, int]]) -> Optional[float]:
+    price = MODEL_PRICING.get(model)
+    if not price or not usage:
+        return None
+    return round((usage.get("input_tokens", 0) * price[0] + usage.get("output_tokens", 0) * price[1]) / 1_000_000, 6)
+
+def _finalize_usage(meta: Dict[str, Any], prompt_text: str, output_text: str) -> None:
+    # Fall back to the local estimator when the provider didn't report usage.
+    if meta.get("usage"):
+        meta["usage_source"] = "provider"
+    else:
+        inp, out = estimate_tokens(prompt_text), estimate_tokens(output_text)
+        meta["usage"] = {"input_tokens": inp, "output_tokens": out, "total_tokens": inp + out}
+        meta["usage_source"] = "estimate"
+    cost = estimate_cost_usd(meta.get("model", ""), meta["usage"])
+    if cost is not None:
+        meta["cost_usd"] = cost
+
+def _scheduled(provider: str, model: str, prompt_text: str, est_tokens: int, meta: Dict[str, Any], attempt_fn):
+    """
+    Run attempt_fn() under the scheduler with exponential backoff + jitter, honoring Retry-After.
+    Returns attempt_fn()'s text, or None with meta["error"] set to an LLMError.
+    """
+    sched = get_llm_scheduler()
+    meta["queued_s"] = 0.0
+    err = None
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            meta["queued_s"] = round(meta["queued_s"] + sched.acquire(provider, model, est_tokens), 3)
+        except TimeoutError as e:
+            meta["error"] = LLMError("queue_timeout", str(e), provider, attempts=attempt)
+            return None
+        try:
+            result = attempt_fn()
+            meta["attempts"] = attempt + 1
+            _finalize_usage(meta, prompt_text, result or "")
+            sched.refund_tokens(provider, model, int(meta.get("max_tokens", 0)) - meta["usage"]["output_tokens"])
+            return result
+        except Exception as e:
+            # a failed attempt is not billed: give its reservation back before any backoff
+            sched.refund_tokens(provider, model, est_tokens)
+            err = classify_llm_exception(provider, e)
+            err.attempts = attempt + 1
+            if err.kind == "rate_limited":
+                sched.penalize(provider, model, err.retry_after_s or backoff_delay(attempt))
+            if not err.retryable or attempt == LLM_MAX_RETRIES:
+                break
+            sched.note_retry()
+            time.sleep(backoff_delay(attempt, err.retry_after_s))
+    meta["error"] = err
+    return None
+
 def call_llm(
     provider: str,
     model: str,
@@ -592,91 +1263,366 @@ def call_llm(
     user_prompt: str,
     max_tokens: int = 12000,
     temperature: float = 0.2,
+    use_cache: bool = False,
 ) -> Tuple[str, Dict[str, Any]]:
+    """Returns (text, meta). On failure text is "" and meta["error"] holds an LLMError."""
     provider = (provider or infer_provider(model)).lower().strip()
-    meta = {"provider": provider, "model": model, "max_tokens": max_tokens, "temperature": temperature}
+    if not use_cache:
+        return _call_llm_scheduled(provider, model, api_key, system_prompt, user_prompt, max_tokens, temperature)
+    cache = get_llm_response_cache()
+    ck = llm_cache_key(provider, model, system_prompt, user_prompt, temperature, max_tokens)
+    hit = cache.get(ck)
+    if hit is not None:
+        return hit
+    text, meta = _call_llm_scheduled(provider, model, api_key, system_prompt, user_prompt, max_tokens, temperature)
+    meta["cache"] = "miss"
+    if text and not meta.get("error"):
+        cache.put(ck, text, meta)
+    return text, meta
 
-    if provider == "openai":
-        try:
-            from openai import OpenAI  # type: ignore
-            client = OpenAI(api_key=api_key)
-            resp = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt or ""},
-                    {"role": "user", "content": user_prompt or ""},
-                ],
-                temperature=float(temperature),
-                max_tokens=int(max_tokens),
-            )
-            text = resp.choices[0].message.content or ""
-            usage = getattr(resp, "usage", None)
-            if usage:
-                meta["usage"] = dict(usage)
-            return text, meta
-        except Exception as e:
-            return f"(OpenAI call failed: {e})", meta
+def _call_llm_scheduled(
+    provider: str,
+    model: str,
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+) -> Tuple[str, Dict[str, Any]]:
+    meta = {"provider": provider, "model": model, "max_tokens": max_tokens, "temperature": temperature}
+    if provider not in PROVIDER_LABELS:
+        meta["error"] = LLMError("bad_request", f"Unknown provider '{provider}'.", provider)
+        return "", meta
+    prompt_text = f"{system_prompt or ''}\n{user_prompt or ''}"
+    est = estimate_tokens(prompt_text) + int(max_tokens)
+    started = time.time()
+    text = _scheduled(
+        provider, model, prompt_text, est, meta,
+        lambda: _call_llm_provider(provider, model, api_key, system_prompt, user_prompt, max_tokens, temperature, meta),
+    )
+    meta["elapsed_s"] = round(time.time() - started, 3)
+    return text or "", meta
+
+def _gemini_request(model: str, system_prompt: str, user_prompt: str, max_tokens: int, temperature: float):
+    """GenerateContentRequest for the pooled per-key GenerativeServiceClient (no process-global genai.configure())."""
+    from google.ai import generativelanguage as glm  # type: ignore
+    req = glm.GenerateContentRequest(
+        model=model if model.startswith("models/") else f"models/{model}",
+        contents=[glm.Content(role="user", parts=[glm.Part(text=user_prompt or "")])],
+        generation_config=glm.GenerationConfig(temperature=float(temperature), max_output_tokens=int(max_tokens)),
+    )
+    if system_prompt:
+        req.system_instruction = glm.Content(parts=[glm.Part(text=system_prompt)])
+    return req
+
+def _gemini_text(resp) -> str:
+    parts = []
+    for cand in getattr(resp, "candidates", None) or []:
+        content = getattr(cand, "content", None)
+        for part in getattr(content, "parts", None) or []:
+            if getattr(part, "text", ""):
+                parts.append(part.text)
+        break  # first candidate only, like GenerateContentResponse.text
+    return "".join(parts)
+
+def _call_llm_provider(
+    provider: str,
+    model: str,
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    meta: Dict[str, Any],
+) -> str:
+    """One provider round trip; raises on failure (the scheduler classifies and retries)."""
+    if provider in ("openai", "grok"):
+        client = get_llm_client_pool().get(provider, api_key)
+        resp = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt or ""},
+                {"role": "user", "content": user_prompt or ""},
+            ],
+            temperature=float(temperature),
+            max_tokens=int(max_tokens),
+        )
+        meta["usage"] = normalize_usage(getattr(resp, "usage", None))
+        return resp.choices[0].message.content or ""
 
     if provider == "gemini":
-        try:
-            import google.generativeai as genai  # type: ignore
-            genai.configure(api_key=api_key)
-            try:
-                model_obj = genai.GenerativeModel(model_name=model, system_instruction=system_prompt or "")
-            except Exception:
-                model_obj = genai.GenerativeModel(model_name=model)
-            resp = model_obj.generate_content(
-                user_prompt or "",
-                generation_config={"temperature": float(temperature), "max_output_tokens": int(max_tokens)},
-            )
-            text = getattr(resp, "text", None) or ""
-            return text, meta
-        except Exception as e:
-            return f"(Gemini call failed: {e})", meta
+        client = get_llm_client_pool().get(provider, api_key)
+        # retries are owned by the LLM scheduler
+        resp = client.generate_content(
+            _gemini_request(model, system_prompt, user_prompt, max_tokens, temperature),
+            retry=None,
+            timeout=LLM_HTTP_TIMEOUT_S,
+        )
+        meta["usage"] = normalize_usage(getattr(resp, "usage_metadata", None))
+        return _gemini_text(resp)
 
     if provider == "anthropic":
+        client = get_llm_client_pool().get(provider, api_key)
+        resp = client.messages.create(
+            model=model,
+            max_tokens=int(max_tokens),
+            temperature=float(temperature),
+            system=system_prompt or "",
+            messages=[{"role": "user", "content": user_prompt or ""}],
+        )
+        meta["usage"] = normalize_usage(getattr(resp, "usage", None))
+        blocks = getattr(resp, "content", []) or []
+        text_parts = []
+        for b in blocks:
+            tx = getattr(b, "text", None)
+            if tx:
+                text_parts.append(tx)
+        return "\n".join(text_parts).strip()
+
+    raise ValueError(f"Unknown provider '{provider}'.")
+
+class LLMStream:
+    """
+    Iterable of text deltas for st.write_stream. Once iteration finishes, `text` holds the
+    full completion and `meta` carries the same fields as call_llm plus ttft_s / elapsed_s.
+    A failure never yields fake text: it leaves meta["error"] set to an LLMError.
+    """
+
+    def __init__(self, deltas, meta: Dict[str, Any], on_done=None):
+        self._deltas = deltas
+        self._parts: List[str] = []
+        self.meta = meta
+        self.done = False
+        self._on_done = on_done
+        self.cancel_event = threading.Event()  # set by abort()
+        self._closers: List[Any] = []
+        self._closers_lock = threading.Lock()
+
+    def __iter__(self):
+        started = time.time()
+        for d in self._deltas:
+            if not d:
+                continue
+            if "ttft_s" not in self.meta:
+                self.meta["ttft_s"] = round(time.time() - started, 3)
+            self._parts.append(d)
+            yield d
+        self.meta["elapsed_s"] = round(time.time() - started, 3)
+        self.done = True
+        if self._on_done is not None and not self.cancel_event.is_set():
+            self._on_done(self.text, self.meta)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts).strip()
+
+    @property
+    def error(self) -> Optional[LLMError]:
+        return self.meta.get("error")
+
+    def close(self) -> None:
+        """Stop early (from the consuming thread); closing the delta generator drops the HTTP stream."""
+        close = getattr(self._deltas, "close", None)
+        if close is not None:
+            close()
+
+    def on_open(self, closer) -> None:
+        """Register the open provider response; an already aborted stream closes it right away."""
+        with self._closers_lock:
+            self._closers.append(closer)
+            aborted = self.cancel_event.is_set()
+        if aborted:
+            self._run_closer(closer)
+
+    def abort(self) -> None:
+        """Stop from any thread: a call still queued is never sent, an open response is closed."""
+        with self._closers_lock:
+            self.cancel_event.set()
+            closers = list(self._closers)
+        for closer in closers:
+            self._run_closer(closer)
+
+    @staticmethod
+    def _run_closer(closer) -> None:
         try:
-            from anthropic import Anthropic  # type: ignore
-            client = Anthropic(api_key=api_key)
-            resp = client.messages.create(
-                model=model,
-                max_tokens=int(max_tokens),
-                temperature=float(temperature),
-                system=system_prompt or "",
-                messages=[{"role": "user", "content": user_prompt or ""}],
-            )
-            blocks = getattr(resp, "content", []) or []
-            text_parts = []
-            for b in blocks:
-                tx = getattr(b, "text", None)
-                if tx:
-                    text_parts.append(tx)
-            return "\n".join(text_parts).strip(), meta
-        except Exception as e:
-            return f"(Anthropic call failed: {e})", meta
+            closer()
+        except Exception:
+            pass
 
-    if provider == "grok":
+def _provider_deltas(
+    provider: str,
+    model: str,
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int,
+    temperature: float,
+    meta: Dict[str, Any],
+    on_open=None,
+):
+    """Raw streaming deltas for one attempt; raises on failure. on_open(closer) receives the open response."""
+    on_open = on_open or (lambda closer: None)
+    if provider in ("openai", "grok"):
+        client = get_llm_client_pool().get(provider, api_key)
+        resp = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt or ""},
+                {"role": "user", "content": user_prompt or ""},
+            ],
+            temperature=float(temperature),
+            max_tokens=int(max_tokens),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        on_open(resp.close)
         try:
-            from openai import OpenAI  # type: ignore
-            client = OpenAI(api_key=api_key, base_url="https://api.x.ai/v1")
-            resp = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt or ""},
-                    {"role": "user", "content": user_prompt or ""},
-                ],
-                temperature=float(temperature),
-                max_tokens=int(max_tokens),
-            )
-            text = resp.choices[0].message.content or ""
-            usage = getattr(resp, "usage", None)
+            for chunk in resp:
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    meta["usage"] = normalize_usage(usage)
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+        finally:
+            resp.close()
+        return
+
+    if provider == "gemini":
+        client = get_llm_client_pool().get(provider, api_key)
+        resp = client.stream_generate_content(
+            _gemini_request(model, system_prompt, user_prompt, max_tokens, temperature),
+            retry=None,
+            timeout=LLM_HTTP_TIMEOUT_S,
+        )
+        on_open(getattr(resp, "cancel", lambda: None))  # gRPC streaming call
+        for chunk in resp:
+            usage = normalize_usage(getattr(chunk, "usage_metadata", None))
             if usage:
-                meta["usage"] = dict(usage)
-            return text, meta
-        except Exception as e:
-            return f"(Grok call failed: {e})", meta
+                meta["usage"] = usage  # cumulative; the last chunk carries the final counts
+            delta = _gemini_text(chunk)
+            if delta:
+                yield delta
+        return
 
-    return f"(Unknown provider '{provider}'.)", meta
+    if provider == "anthropic":
+        client = get_llm_client_pool().get(provider, api_key)
+        with client.messages.stream(
+            model=model,
+            max_tokens=int(max_tokens),
+            temperature=float(temperature),
+            system=system_prompt or "",
+            messages=[{"role": "user", "content": user_prompt or ""}],
+        ) as s:
+            on_open(s.close)
+            for delta in s.text_stream:
+                if delta:
+                    yield delta
+            meta["usage"] = normalize_usage(getattr(s.get_final_message(), "usage", None))
+        return
+
+    raise ValueError(f"Unknown provider '{provider}'.")
+
+def call_llm_stream(
+    provider: str,
+    model: str,
+    api_key: str,
+    system_prompt: str,
+    user_prompt: str,
+    max_tokens: int = 12000,
+    temperature: float = 0.2,
+    use_cache: bool = False,
+) -> LLMStream:
+    provider = (provider or infer_provider(model)).lower().strip()
+    on_done = None
+    if use_cache:
+        cache = get_llm_response_cache()
+        ck = llm_cache_key(provider, model, system_prompt, user_prompt, temperature, max_tokens)
+        hit = cache.get(ck)
+        if hit is not None:
+            return LLMStream(iter([hit[0]]), dict(hit[1], streamed=True))
+
+        def on_done(text: str, done_meta: Dict[str, Any]) -> None:
+            done_meta["cache"] = "miss"
+            if text and not done_meta.get("error"):
+                cache.put(ck, text, {k: v for k, v in done_meta.items() if k not in ("ttft_s", "elapsed_s", "agent")})
+
+    meta = {"provider": provider, "model": model, "max_tokens": max_tokens, "temperature": temperature, "streamed": True}
+    if provider not in PROVIDER_LABELS:
+        meta["error"] = LLMError("bad_request", f"Unknown provider '{provider}'.", provider)
+        return LLMStream(iter([]), meta)
+
+    def scheduled_deltas():
+        # Same policy as _scheduled(), but a retry is only safe before the first delta is shown.
+        # stream.abort() (any thread) stops it while queued, before the request, or mid-response.
+        sched = get_llm_scheduler()
+        cancel = stream.cancel_event
+        prompt_text = f"{system_prompt or ''}\n{user_prompt or ''}"
+        est = estimate_tokens(prompt_text) + int(max_tokens)
+        meta["queued_s"] = 0.0
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                meta["queued_s"] = round(meta["queued_s"] + sched.acquire(provider, model, est, cancel_event=cancel), 3)
+            except TimeoutError as e:
+                meta["error"] = LLMError("queue_timeout", str(e), provider, attempts=attempt)
+                return
+            except InterruptedError:
+                meta["error"] = LLMError("cancelled", "Cancelled before the request was sent.", provider, attempts=attempt)
+                return
+            if cancel.is_set():
+                sched.refund_tokens(provider, model, est)
+                meta["error"] = LLMError("cancelled", "Cancelled before the request was sent.", provider, attempts=attempt)
+                return
+            parts: List[str] = []
+            try:
+                for d in _provider_deltas(
+                    provider, model, api_key, system_prompt, user_prompt, max_tokens, temperature, meta, on_open=stream.on_open
+                ):
+                    if cancel.is_set():
+                        break
+                    parts.append(d)
+                    yield d
+                if cancel.is_set():
+                    raise InterruptedError("stream aborted")
+                meta["attempts"] = attempt + 1
+                _finalize_usage(meta, prompt_text, "".join(parts))
+                sched.refund_tokens(provider, model, int(max_tokens) - meta["usage"]["output_tokens"])
+                return
+            except GeneratorExit:
+                # Consumer stopped early (race lost / cancelled): bill what was generated, refund the rest.
+                meta["stopped_early"] = True
+                _finalize_usage(meta, prompt_text, "".join(parts))
+                sched.refund_tokens(provider, model, int(max_tokens) - meta["usage"]["output_tokens"])
+                raise
+            except Exception as e:
+                if cancel.is_set():
+                    # aborted mid-response (the closed response raises here): bill what was generated
+                    meta["stopped_early"] = True
+                    _finalize_usage(meta, prompt_text, "".join(parts))
+                    sched.refund_tokens(provider, model, int(max_tokens) - meta["usage"]["output_tokens"])
+                    meta["error"] = LLMError("cancelled", "Stream aborted.", provider, attempts=attempt + 1)
+                    return
+                if parts:
+                    # failed mid-response: bill what was generated, refund the rest
+                    _finalize_usage(meta, prompt_text, "".join(parts))
+                    sched.refund_tokens(provider, model, int(max_tokens) - meta["usage"]["output_tokens"])
+                else:
+                    sched.refund_tokens(provider, model, est)
+                err = classify_llm_exception(provider, e)
+                err.attempts = attempt + 1
+                if err.kind == "rate_limited":
+                    sched.penalize(provider, model, err.retry_after_s or backoff_delay(attempt))
+                if parts or not err.retryable or attempt == LLM_MAX_RETRIES:
+                    meta["error"] = err
+                    return
+                sched.note_retry()
+                if cancel.wait(backoff_delay(attempt, err.retry_after_s)):
+                    meta["error"] = LLMError("cancelled", "Cancelled before the retry was sent.", provider, attempts=attempt + 1)
+                    return
+
+    stream = LLMStream(scheduled_deltas(), meta, on_done)
+    return stream
 
 def render_template(tpl: str, variables: Dict[str, Any]) -> str:
     tpl = tpl or "{input}"
@@ -685,12 +1631,12 @@ def render_template(tpl: str, variables: Dict[str, Any]) -> str:
     except Exception:
         return tpl
 
-def run_agent(
+def resolve_agent_call(
     agent_conf: Dict[str, Any],
     input_text: str,
     overrides: Dict[str, Any],
     keys: Dict[str, Optional[str]],
-) -> Tuple[str, Dict[str, Any]]:
+) -> Dict[str, Any]:
     name = agent_conf.get("name", "Unnamed Agent")
     base_model = agent_conf.get("model", "gpt-4o-mini")
     base_provider = agent_conf.get("provider", infer_provider(base_model))
@@ -718,26 +1664,300 @@ def run_agent(
     elif provider == "grok":
         api_key = keys.get("grok")
 
+    call = {
+        "agent": name,
+        "provider": provider,
+        "model": model,
+        "api_key": api_key,
+        "system_prompt": system_prompt,
+        "user_prompt": render_template(prompt_tpl, {"input": input_text}),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "prompt_tpl": prompt_tpl,
+        "input_text": input_text,
+    }
     if not api_key:
-        return f"(Missing API key for provider '{provider}' while running {name}.)", {
-            "agent": name, "provider": provider, "model": model, "error": "missing_api_key"
-        }
+        call["error"] = LLMError("missing_api_key", f"Missing API key for provider '{provider}' while running {name}.", provider)
+    return call
+
+def _llm_kwargs(call: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: call[k] for k in ("provider", "model", "api_key", "system_prompt", "user_prompt", "max_tokens", "temperature")}
+
+# Context budgeting: system + rendered prompt + max_tokens must fit the model window before we call.
+CONTEXT_SAFETY_RATIO = float(os.getenv("LLM_CONTEXT_SAFETY_RATIO", "0.9"))  # headroom for token-estimate error
+CONTEXT_TABLE_KEEP_ROWS = (20, 5)
+CONTEXT_SUMMARY_MODELS = ["gemini-2.5-flash-lite", "gpt-4o-mini", "claude-3-5-haiku-latest", "grok-3-mini"]
+CONTEXT_SUMMARY_CHUNK_TOKENS = int(os.getenv("LLM_CONTEXT_SUMMARY_CHUNK_TOKENS", "60000"))
+CONTEXT_SUMMARY_MAX_CHUNKS = int(os.getenv("LLM_CONTEXT_SUMMARY_MAX_CHUNKS", "16"))
+
+_TABLE_SEP_RE = re.compile(r"^\|[\s:|-]+\|$")
+_JSON_INDENT_RE = re.compile(r'(?m)^[ \t]+(?=["{}\[\]])')
+
+def squeeze_whitespace(text: str) -> str:
+    """Drop markdown-table padding, JSON indentation, trailing spaces and blank-line runs (content unchanged)."""
+    lines = []
+    for line in text.split("\n"):
+        line = line.rstrip()
+        if line.startswith("|"):
+            line = re.sub(r"-{4,}", "---", line) if _TABLE_SEP_RE.match(line) else re.sub(r"[ \t]{2,}", " ", line)
+        lines.append(line)
+    return re.sub(r"\n{3,}", "\n\n", _JSON_INDENT_RE.sub("", "\n".join(lines)))
+
+def dedupe_paragraphs(text: str) -> Tuple[str, int]:
+    seen, kept, removed = set(), [], 0
+    for block in re.split(r"\n\s*\n", text):
+        key = block.strip()
+        # Short blocks (headings, separators) repeat legitimately.
+        if len(key) >= 40 and key in seen:
+            removed += 1
+            continue
+        seen.add(key)
+        kept.append(block)
+    return "\n\n".join(kept), removed
+
+def trim_markdown_tables(text: str, keep_rows: int) -> Tuple[str, int]:
+    out: List[str] = []
+    run: List[str] = []
+    omitted = 0
+
+    def flush():
+        nonlocal omitted
+        if len(run) > keep_rows + 2:  # header + separator + rows
+            n = len(run) - keep_rows - 2
+            out.extend(run[: keep_rows + 2])
+            out.append(f"_(… {n} more table rows omitted to fit the context window)_")
+            omitted += n
+        else:
+            out.extend(run)
+        run.clear()
 
-    user_prompt = render_template(prompt_tpl, {"input": input_text})
+    for line in text.split("\n"):
+        if line.lstrip().startswith("|"):
+            run.append(line)
+        else:
+            flush()
+            out.append(line)
+    flush()
+    return "\n".join(out), omitted
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    chars_per_token = len(text) / max(1, estimate_tokens(text))
+    keep = max(0, int(max_tokens * chars_per_token * 0.95))
+    if keep >= len(text):
+        return text
+    head = keep * 2 // 3
+    tail = keep - head
+    return (
+        text[:head]
+        + f"\n\n_(… {len(text) - keep:,} characters omitted to fit the context window …)_\n\n"
+        + (text[-tail:] if tail else "")
+    )
 
-    started = time.time()
-    text, meta = call_llm(
-        provider=provider,
-        model=model,
-        api_key=api_key,
-        system_prompt=system_prompt,
-        user_prompt=user_prompt,
-        max_tokens=max_tokens,
-        temperature=temperature,
+def summarize_for_context(text: str, target_tokens: int, keys: Dict[str, Optional[str]]) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Map-style compression with the cheapest model we hold a key for; chunks run in parallel."""
+    model = next((m for m in CONTEXT_SUMMARY_MODELS if keys.get(infer_provider(m))), None)
+    if model is None:
+        return None, {"error": "no API key for a summary model"}
+    provider = infer_provider(model)
+    window, max_out = model_context_limit(model)
+    chunk_tokens = min(CONTEXT_SUMMARY_CHUNK_TOKENS, int(window * CONTEXT_SAFETY_RATIO / 2))
+    chunk_chars = max(1000, int(chunk_tokens * len(text) / max(1, estimate_tokens(text))))
+    chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+    if len(chunks) > CONTEXT_SUMMARY_MAX_CHUNKS:
+        return None, {"model": model, "error": f"{len(chunks)} chunks exceeds LLM_CONTEXT_SUMMARY_MAX_CHUNKS"}
+    per_chunk = max(256, min(max_out, target_tokens // len(chunks)))
+    system = (
+        "You compress source material for another model. Keep every number, ID, date, name and conclusion; "
+        "drop repetition and boilerplate. Output Markdown only."
     )
-    meta.update({"agent": name, "elapsed_s": round(time.time() - started, 3)})
+
+    def one(chunk: str):
+        usr = f"Compress this part ({len(chunks)} parts total) to at most ~{per_chunk} tokens:\n\n{chunk}"
+        return call_llm(provider, model, keys[provider], system, usr, per_chunk, 0.0)
+
+    with ThreadPoolExecutor(max_workers=min(4, len(chunks))) as ex:
+        results = list(ex.map(one, chunks))
+    info: Dict[str, Any] = {"model": model, "chunks": len(chunks), "cost_usd": 0.0}
+    for out, meta in results:
+        if meta.get("error") or not out:
+            info["error"] = str(meta.get("error") or "empty summary")
+            return None, info
+        info["cost_usd"] = round(info["cost_usd"] + (meta.get("cost_usd") or 0.0), 6)
+    return "\n\n".join(out for out, _ in results), info
+
+def budget_agent_call(call: Dict[str, Any], keys: Dict[str, Optional[str]], allow_summary: bool = True) -> Dict[str, Any]:
+    """
+    Pre-flight check for a resolved agent call. Clamps max_tokens to the model's output limit and,
+    if the input would overflow the window, compacts it in increasing order of loss:
+    whitespace → duplicate paragraphs → table rows → cheap-model summary → middle truncation.
+    What was done is reported in call["budget"] (copied into meta by run_agent).
+    """
+    window, max_out = model_context_limit(call["model"])
+    steps: List[str] = []
+    if call["max_tokens"] > max_out:
+        steps.append(f"max_tokens {call['max_tokens']:,} → {max_out:,} (model output limit)")
+        call["max_tokens"] = max_out
+
+    tpl = call.get("prompt_tpl") or "{input}"
+    text = call.get("input_text") or ""
+    overhead = estimate_tokens(call["system_prompt"]) + estimate_tokens(render_template(tpl, {"input": ""}))
+    available = max(1024, int(window * CONTEXT_SAFETY_RATIO) - call["max_tokens"] - overhead)
+    before = estimate_tokens(text) if "{input}" in tpl else 0
+    budget: Dict[str, Any] = {"context_window": window, "input_budget": available, "input_tokens": before}
+
+    def fits(t: str) -> bool:
+        return estimate_tokens(t) <= available
+
+    if before > available:
+        compact = squeeze_whitespace(text)
+        if compact != text:
+            steps.append("squeezed whitespace / table padding")
+        if not fits(compact):
+            compact, n = dedupe_paragraphs(compact)
+            if n:
+                steps.append(f"removed {n} duplicate paragraph(s)")
+        for keep in CONTEXT_TABLE_KEEP_ROWS:
+            if fits(compact):
+                break
+            compact, n = trim_markdown_tables(compact, keep)
+            if n:
+                steps.append(f"trimmed tables to {keep} rows ({n} rows omitted)")
+        if not fits(compact) and allow_summary:
+            summary, info = summarize_for_context(compact, available, keys)
+            budget["summary"] = info
+            if summary is not None:
+                compact = summary
+                steps.append(f"summarized with {info['model']} ({info['chunks']} chunk(s))")
+            else:
+                steps.append(f"summary skipped: {info.get('error', '')}")
+        if not fits(compact):
+            compact = truncate_middle(compact, available)
+            steps.append("truncated the middle of the input")
+        call["input_text"] = compact
+        call["user_prompt"] = render_template(tpl, {"input": compact})
+        budget["input_tokens_after"] = estimate_tokens(compact)
+
+    budget["steps"] = steps
+    call["budget"] = budget
+    return call
+
+def budget_notice(meta: Dict[str, Any]) -> Optional[str]:
+    b = meta.get("budget") or {}
+    if not b.get("steps"):
+        return None
+    size = f" ({b['input_tokens']:,} → {b['input_tokens_after']:,} tokens)" if "input_tokens_after" in b else ""
+    return f"🗜️ Input adjusted to fit {meta.get('model', '')} context{size}: " + "; ".join(b["steps"])
+
+def run_agent(
+    agent_conf: Dict[str, Any],
+    input_text: str,
+    overrides: Dict[str, Any],
+    keys: Dict[str, Optional[str]],
+    use_cache: bool = False,
+) -> Tuple[str, Dict[str, Any]]:
+    call = resolve_agent_call(agent_conf, input_text, overrides, keys)
+    if call.get("error"):
+        return "", {"agent": call["agent"], "provider": call["provider"], "model": call["model"], "error": call["error"]}
+
+    started = time.time()
+    call = budget_agent_call(call, keys)
+    text, meta = call_llm(**_llm_kwargs(call), use_cache=use_cache)
+    meta.update({"agent": call["agent"], "budget": call["budget"], "elapsed_s": round(time.time() - started, 3)})
     return text, meta
 
+def run_agent_stream(
+    agent_conf: Dict[str, Any],
+    input_text: str,
+    overrides: Dict[str, Any],
+    keys: Dict[str, Optional[str]],
+    use_cache: bool = False,
+) -> "LLMStream":
+    call = resolve_agent_call(agent_conf, input_text, overrides, keys)
+    if call.get("error"):
+        return LLMStream(iter([]), {"agent": call["agent"], "provider": call["provider"], "model": call["model"], "error": call["error"]})
+    call = budget_agent_call(call, keys)
+    stream = call_llm_stream(**_llm_kwargs(call), use_cache=use_cache)
+    stream.meta.update({"agent": call["agent"], "budget": call["budget"]})
+    return stream
+
+FANOUT_DEFAULT_MODELS = ["gpt-4o-mini", "gemini-2.5-flash", "claude-3-5-haiku-latest"]
+
+def run_agent_fanout(
+    agent_conf: Dict[str, Any],
+    input_text: str,
+    overrides: Dict[str, Any],
+    keys: Dict[str, Optional[str]],
+    models: List[str],
+    race: bool = False,
+    use_cache: bool = False,
+    on_result=None,
+) -> Dict[str, Any]:
+    """
+    Send one agent step to several models at once: same overrides and input, provider and key
+    resolved per model. race=True returns as soon as the first non-empty, error-free answer
+    arrives; the other streams are aborted from the calling thread right then (calls still queued
+    in the scheduler are never sent, open responses are closed) and reported as LLMError("cancelled").
+    on_result(model, text, meta) is called from the calling thread as models finish.
+    """
+    t0 = time.time()
+    winner: List[str] = []
+    streams: Dict[str, LLMStream] = {}
+    lock = threading.Lock()
+
+    def work(model: str):
+        ov = dict(overrides, model=model, provider=infer_provider(model))
+        stream = run_agent_stream(agent_conf, input_text, ov, keys, use_cache=use_cache)
+        with lock:
+            streams[model] = stream
+            lost = race and bool(winner)
+        if lost:
+            stream.abort()  # decided before this call was dispatched
+        for _ in stream:
+            pass
+        stream.meta["fanout_s"] = round(time.time() - t0, 3)
+        if race and stream.cancel_event.is_set():
+            stream.meta["error"] = LLMError("cancelled", f"Lost the race to {winner[0]}.", stream.meta.get("provider", ""))
+        elif race and stream.text and not stream.error:
+            with lock:
+                if not winner:
+                    winner.append(model)
+        return stream.text, stream.meta
+
+    results: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+    ex = ThreadPoolExecutor(max_workers=max(1, len(models)), thread_name_prefix="fanout")
+    futures = {ex.submit(work, m): m for m in models}
+    try:
+        pending = set(futures)
+        while pending and not (race and winner and winner[0] in results):
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                model = futures[f]
+                try:
+                    text, meta = f.result()
+                except Exception as e:
+                    text, meta = "", {"model": model, "provider": infer_provider(model), "error": LLMError("unknown", str(e), infer_provider(model))}
+                results[model] = (text, meta)
+                if on_result is not None:
+                    on_result(model, text, meta)
+            if race and winner:
+                with lock:
+                    losers = [other for m, other in streams.items() if m != winner[0]]
+                for loser in losers:
+                    loser.abort()
+    finally:
+        ex.shutdown(wait=False)  # aborted losers wind down on their own; nothing more is sent or cached
+
+    for model in models:
+        if model not in results:
+            meta = {"model": model, "provider": infer_provider(model), "agent": agent_conf.get("name", ""),
+                    "error": LLMError("cancelled", f"Lost the race to {winner[0]}.", infer_provider(model))}
+            results[model] = ("", meta)
+    if not race:
+        ok = [m for m in models if results[m][0] and not results[m][1].get("error")]
+        winner = sorted(ok, key=lambda m: results[m][1].get("fanout_s", 0.0))[:1]
+    return {"models": list(models), "results": results, "winner": winner[0] if winner else None,
+            "race": race, "wall_s": round(time.time() - t0, 3)}
+
 def load_agents_config() -> Dict[str, Any]:
     if not os.path.exists(AGENTS_YAML_PATH):
         return {"agents": []}
@@ -751,6 +1971,1009 @@ def save_agents_config(cfg: Dict[str, Any]) -> None:
 if st.session_state.agents_config is None:
     st.session_state.agents_config = load_agents_config()
 
+# =========================
+# Agent DAG executor (depends_on in agents.yaml)
+# =========================
+PROVIDER_CONCURRENCY = {
+    "openai": int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8")),
+    "gemini": int(os.environ.get("GEMINI_MAX_CONCURRENCY", "4")),
+    "anthropic": int(os.environ.get("ANTHROPIC_MAX_CONCURRENCY", "4")),
+    "grok": int(os.environ.get("GROK_MAX_CONCURRENCY", "4")),
+}
+DAG_MAX_WORKERS = int(os.environ.get("DAG_MAX_WORKERS", "16"))
+
+@st.cache_resource(show_spinner=False)
+def get_provider_semaphores() -> Dict[str, threading.BoundedSemaphore]:
+    # Process-wide, so concurrent sessions share one budget per provider.
+    return {p: threading.BoundedSemaphore(max(1, n)) for p, n in PROVIDER_CONCURRENCY.items()}
+
+def build_agent_dag(agent_names: List[str], all_agents: List[Dict[str, Any]], sequential: bool = False) -> Dict[str, List[str]]:
+    """
+    Dependency map for the selected agents. An agent with `depends_on` waits for those agents
+    (unselected ones are ignored; `depends_on: []` reads the original context). An agent without
+    `depends_on` keeps chain semantics and depends on the previously selected agent.
+    sequential=True ignores depends_on and builds a plain chain.
+    """
+    by_name = {a.get("name"): a for a in all_agents}
+    selected = set(agent_names)
+    deps: Dict[str, List[str]] = {}
+    for i, name in enumerate(agent_names):
+        conf = by_name.get(name) or {}
+        if "depends_on" in conf and not sequential:
+            raw = conf.get("depends_on") or []
+            if isinstance(raw, str):
+                raw = [raw]
+            deps[name] = [d for d in raw if d in selected and d != name]
+        else:
+            deps[name] = [agent_names[i - 1]] if i > 0 else []
+
+    # Kahn's algorithm, only to reject cycles.
+    indeg = {n: len(d) for n, d in deps.items()}
+    ready = [n for n, k in indeg.items() if k == 0]
+    seen = 0
+    while ready:
+        n = ready.pop()
+        seen += 1
+        for m, d in deps.items():
+            if n in d:
+                indeg[m] -= 1
+                if indeg[m] == 0:
+                    ready.append(m)
+    if seen != len(deps):
+        cyclic = [n for n, k in indeg.items() if k > 0]
+        raise ValueError(f"Cycle in depends_on among: {', '.join(cyclic)}")
+    return deps
+
+def dag_node_input(deps: List[str], outputs: Dict[str, str], context: str) -> str:
+    if not deps:
+        return context
+    if len(deps) == 1:
+        return outputs[deps[0]]
+    return "\n\n".join(f"## {d}\n\n{outputs[d]}" for d in deps)
+
+def run_agent_dag(
+    agent_names: List[str],
+    all_agents: List[Dict[str, Any]],
+    context: str,
+    overrides_by_agent: Dict[str, Dict[str, Any]],
+    keys: Dict[str, Optional[str]],
+    max_workers: int = DAG_MAX_WORKERS,
+    on_node_done=None,
+    use_cache: bool = False,
+    sequential: bool = False,
+    cancel_event: Optional[threading.Event] = None,
+    on_node_start=None,
+) -> Dict[str, Any]:
+    """
+    Run the selected agents as a DAG on a thread pool. Independent agents run concurrently,
+    bounded by the per-provider semaphores; a failed node skips all of its descendants.
+    on_node_done(name, text, meta) is called from the calling thread as nodes finish;
+    on_node_start(name) from the worker thread once a node holds its provider slot.
+    Setting cancel_event stops scheduling: in-flight calls finish, the rest are marked cancelled.
+    """
+    deps = build_agent_dag(agent_names, all_agents, sequential=sequential)
+    by_name = {a.get("name"): a for a in all_agents}
+    children: Dict[str, List[str]] = {n: [] for n in deps}
+    for n, d in deps.items():
+        for p in d:
+            children[p].append(n)
+    remaining = {n: set(d) for n, d in deps.items()}
+    sems = get_provider_semaphores()
+
+    t0 = time.time()
+    outputs: Dict[str, str] = {}
+    metas: Dict[str, Dict[str, Any]] = {}
+    timeline: List[Dict[str, Any]] = []
+
+    def cancelled() -> bool:
+        return cancel_event is not None and cancel_event.is_set()
+
+    def work(name: str, input_text: str):
+        queued = time.time()
+        conf = by_name.get(name) or {}
+        ov = overrides_by_agent.get(name, {}) or {}
+        provider = resolve_agent_call(conf, "", ov, keys)["provider"]
+        sem = sems.get(provider)
+        if sem is not None:
+            sem.acquire()
+        try:
+            started = time.time()
+            if cancelled():
+                text, meta = "", {"agent": name, "error": LLMError("cancelled", "Run cancelled before this agent started.")}
+            else:
+                if on_node_start is not None:
+                    on_node_start(name)
+                text, meta = run_agent(conf, input_text, ov, keys, use_cache=use_cache)
+        finally:
+            if sem is not None:
+                sem.release()
+        finished = time.time()
+        span = {
+            "node": name,
+            "provider": provider,
+            "depends_on": deps[name],
+            "queued_s": round(queued - t0, 3),
+            "start_s": round(started - t0, 3),
+            "end_s": round(finished - t0, 3),
+            "wait_s": round(started - queued, 3),
+            "status": "cancelled" if cancelled() and meta.get("error") else ("failed" if meta.get("error") else "done"),
+        }
+        return text, meta, span
+
+    def finish(name: str, text: str, meta: Dict[str, Any], span: Dict[str, Any]) -> None:
+        meta["dag"] = span
+        outputs[name], metas[name] = text, meta
+        timeline.append(span)
+        if on_node_done is not None:
+            on_node_done(name, text, meta)
+
+    def skip_descendants(name: str) -> None:
+        stack = list(children[name])
+        while stack:
+            c = stack.pop()
+            if c in outputs:
+                continue
+            now = round(time.time() - t0, 3)
+            if cancelled():
+                status, err = "cancelled", LLMError("cancelled", "Run cancelled before this agent started.")
+            else:
+                status, err = "skipped", LLMError("upstream_failed", f"Skipped: upstream agent '{name}' failed.")
+            span = {"node": c, "provider": "", "depends_on": deps[c], "queued_s": now,
+                    "start_s": now, "end_s": now, "wait_s": 0.0, "status": status}
+            finish(c, "", {"agent": c, "error": err}, span)
+            stack.extend(children[c])
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as ex:
+        futures = {}
+        for n in agent_names:
+            if not remaining[n]:
+                futures[ex.submit(work, n, dag_node_input(deps[n], outputs, context))] = n
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for f in done:
+                name = futures.pop(f)
+                try:
+                    text, meta, span = f.result()
+                except Exception as e:
+                    now = round(time.time() - t0, 3)
+                    text, meta = "", {"agent": name, "error": LLMError("unknown", f"Agent '{name}' failed: {e}")}
+                    span = {"node": name, "provider": "", "depends_on": deps[name], "queued_s": now,
+                            "start_s": now, "end_s": now, "wait_s": 0.0, "status": "failed"}
+                finish(name, text, meta, span)
+                if meta.get("error"):
+                    skip_descendants(name)
+                    continue
+                if cancelled():
+                    continue
+                for c in children[name]:
+                    remaining[c].discard(name)
+                    if not remaining[c] and c not in outputs:
+                        futures[ex.submit(work, c, dag_node_input(deps[c], outputs, context))] = c
+
+    for n in agent_names:
+        if n not in outputs:  # never scheduled because of cancellation
+            now = round(time.time() - t0, 3)
+            span = {"node": n, "provider": "", "depends_on": deps[n], "queued_s": now,
+                    "start_s": now, "end_s": now, "wait_s": 0.0, "status": "cancelled"}
+            finish(n, "", {"agent": n, "error": LLMError("cancelled", "Run cancelled before this agent started.")}, span)
+
+    wall = round(time.time() - t0, 3)
+    return {
+        "agents": agent_names,
+        "deps": deps,
+        "outputs": outputs,
+        "metas": metas,
+        "timeline": sorted(timeline, key=lambda r: (r["start_s"], r["node"])),
+        "wall_s": wall,
+        "sum_s": round(sum(r["end_s"] - r["start_s"] for r in timeline), 3),
+    }
+
+def build_dag_timeline(timeline: List[Dict[str, Any]]) -> go.Figure:
+    if not timeline:
+        return go.Figure()
+    colors = {"done": "#06D6A0", "failed": "#EF476F", "skipped": "#8D99AE", "cancelled": "#FFD166"}
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        y=[r["node"] for r in timeline],
+        x=[max(r["end_s"] - r["start_s"], 0.01) for r in timeline],
+        base=[r["start_s"] for r in timeline],
+        orientation="h",
+        marker_color=[colors.get(r["status"], "#3A86FF") for r in timeline],
+        hovertext=[f"{r['provider']} · wait {r['wait_s']}s · {r['status']}" for r in timeline],
+        name="run",
+    ))
+    fig.update_layout(
+        height=max(220, 26 * len(timeline) + 60),
+        margin=dict(l=10, r=10, t=10, b=10),
+        xaxis=dict(title="seconds since start"),
+        yaxis=dict(autorange="reversed"),
+        showlegend=False,
+    )
+    return fig
+
+# =========================
+# Batch mode (provider batch APIs: bulk runs, ~50% cheaper, results within 24h)
+# =========================
+BATCH_PROVIDERS = ("openai", "anthropic")  # others run interactively inside the same job
+BATCH_KEY_ENV = {"openai": "OPENAI_API_KEY", "anthropic": "ANTHROPIC_API_KEY"}  # to resume polling after a restart
+BATCH_POLL_S = float(os.environ.get("BATCH_POLL_S", "30"))
+BATCH_TIMEOUT_S = float(os.environ.get("BATCH_TIMEOUT_S", str(24 * 3600)))
+BATCH_PRICE_FACTOR = 0.5  # both providers bill batch tokens at half the interactive price
+
+def batch_request_line(call: Dict[str, Any], custom_id: str) -> Dict[str, Any]:
+    """One JSONL line in the provider's batch format for a resolved agent call."""
+    if call["provider"] == "anthropic":
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": call["model"],
+                "max_tokens": int(call["max_tokens"]),
+                "temperature": float(call["temperature"]),
+                "system": call["system_prompt"] or "",
+                "messages": [{"role": "user", "content": call["user_prompt"] or ""}],
+            },
+        }
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": call["model"],
+            "messages": [
+                {"role": "system", "content": call["system_prompt"] or ""},
+                {"role": "user", "content": call["user_prompt"] or ""},
+            ],
+            "max_tokens": int(call["max_tokens"]),
+            "temperature": float(call["temperature"]),
+        },
+    }
+
+class OpenAIBatchTransport:
+    """Files + Batches API: upload the JSONL, create a 24h batch, read the output/error files."""
+
+    def __init__(self, api_key: str):
+        self.client = get_llm_client_pool().get("openai", api_key)
+
+    def submit(self, jsonl: str) -> str:
+        f = self.client.files.create(file=("batch.jsonl", jsonl.encode("utf-8")), purpose="batch")
+        return self.client.batches.create(input_file_id=f.id, endpoint="/v1/chat/completions", completion_window="24h").id
+
+    def poll(self, batch_id: str) -> Dict[str, Any]:
+        b = self.client.batches.retrieve(batch_id)
+        rc = b.request_counts
+        return {
+            "status": b.status,
+            "done": b.status in ("completed", "failed", "expired", "cancelled"),
+            "completed": getattr(rc, "completed", 0) if rc else 0,
+            "failed": getattr(rc, "failed", 0) if rc else 0,
+            "total": getattr(rc, "total", 0) if rc else 0,
+        }
+
+    def results(self, batch_id: str):
+        b = self.client.batches.retrieve(batch_id)
+        for file_id in (b.output_file_id, b.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                resp = rec.get("response") or {}
+                body = resp.get("body") or {}
+                err = rec.get("error") or (body.get("error") if int(resp.get("status_code") or 200) >= 400 else None)
+                choices = body.get("choices") or []
+                yield {
+                    "custom_id": rec.get("custom_id"),
+                    "text": "" if err or not choices else (choices[0].get("message") or {}).get("content") or "",
+                    "usage": normalize_usage(body.get("usage")),
+                    "error": (err.get("message") if isinstance(err, dict) else str(err)) if err else None,
+                }
+
+    def cancel(self, batch_id: str) -> None:
+        self.client.batches.cancel(batch_id)
+
+class AnthropicBatchTransport:
+    """Message Batches API: requests are posted inline, results streamed back as JSONL."""
+
+    def __init__(self, api_key: str):
+        self.client = get_llm_client_pool().get("anthropic", api_key)
+
+    def submit(self, jsonl: str) -> str:
+        requests = [json.loads(line) for line in jsonl.splitlines() if line.strip()]
+        return self.client.messages.batches.create(requests=requests).id
+
+    def poll(self, batch_id: str) -> Dict[str, Any]:
+        b = self.client.messages.batches.retrieve(batch_id)
+        rc = b.request_counts
+        return {
+            "status": b.processing_status,
+            "done": b.processing_status == "ended",
+            "completed": rc.succeeded,
+            "failed": rc.errored + rc.canceled + rc.expired,
+            "total": rc.processing + rc.succeeded + rc.errored + rc.canceled + rc.expired,
+        }
+
+    def results(self, batch_id: str):
+        for r in self.client.messages.batches.results(batch_id):
+            res = r.result
+            if res.type == "succeeded":
+                text = "".join(getattr(block, "text", "") for block in res.message.content)
+                yield {"custom_id": r.custom_id, "text": text, "usage": normalize_usage(res.message.usage), "error": None}
+            else:
+                yield {"custom_id": r.custom_id, "text": "", "usage": None, "error": f"{res.type}: {getattr(res, 'error', '')}"}
+
+    def cancel(self, batch_id: str) -> None:
+        self.client.messages.batches.cancel(batch_id)
+
+@st.cache_resource(show_spinner=False)
+def get_mock_batch_store() -> Dict[str, Any]:
+    # Process-wide, like a provider's batch store: a new transport (e.g. after JobRunner restarts) sees old batches.
+    return {"lock": threading.Lock(), "batches": {}}
+
+class MockBatchTransport:
+    """
+    Local stand-in with the same interface, for tests and dry runs: no network, finishes after
+    `polls` polls and answers each request with a short deterministic echo of its prompt.
+    custom_ids listed in `fail_ids` come back as errors. Batches live in the process-wide
+    get_mock_batch_store(), together with their polls / fail_ids; ids it does not know (the
+    process itself restarted) are reported as expired.
+    """
+
+    def __init__(self, provider: str, polls: int = 1, fail_ids: Tuple[str, ...] = ()):
+        self.provider = provider
+        self.polls = polls
+        self.fail_ids = set(fail_ids)
+        self._store = get_mock_batch_store()
+        self._batches: Dict[str, Dict[str, Any]] = self._store["batches"]
+
+    def submit(self, jsonl: str) -> str:
+        batch_id = f"mock-{self.provider}-{secrets.token_hex(6)}"
+        lines = [json.loads(line) for line in jsonl.splitlines() if line.strip()]
+        with self._store["lock"]:
+            self._batches[batch_id] = {"lines": lines, "polls": 0, "cancelled": False,
+                                       "done_after": self.polls, "fail_ids": set(self.fail_ids)}
+        return batch_id
+
+    def poll(self, batch_id: str) -> Dict[str, Any]:
+        with self._store["lock"]:
+            b = self._batches.get(batch_id)
+            if b is None:
+                return {"status": "expired", "done": True, "completed": 0, "failed": 0, "total": 0}
+            b["polls"] += 1
+            done = b["cancelled"] or b["polls"] >= b["done_after"]
+        n = len(b["lines"])
+        failed = len([x for x in b["lines"] if x["custom_id"] in b["fail_ids"]])
+        return {"status": "cancelled" if b["cancelled"] else ("ended" if done else "in_progress"),
+                "done": done, "completed": n - failed if done else 0, "failed": failed if done else 0, "total": n}
+
+    def results(self, batch_id: str):
+        b = self._batches.get(batch_id)
+        if b is None:
+            return  # unknown batch: poll_agent_batch reports every item as failed
+        for line in b["lines"]:
+            req = line.get("params") or line.get("body") or {}
+            prompt = (req.get("messages") or [{}])[-1].get("content", "")
+            if b["cancelled"] or line["custom_id"] in b["fail_ids"]:
+                yield {"custom_id": line["custom_id"], "text": "", "usage": None, "error": "mock failure" if not b["cancelled"] else "canceled"}
+                continue
+            text = f"[mock {req.get('model', '')}] " + " ".join(prompt.split())[:200]
+            usage = {"input_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(text)}
+            usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+            yield {"custom_id": line["custom_id"], "text": text, "usage": usage, "error": None}
+
+    def cancel(self, batch_id: str) -> None:
+        with self._store["lock"]:
+            if batch_id in self._batches:
+                self._batches[batch_id]["cancelled"] = True
+
+def provider_batch_transport(provider: str, api_key: Optional[str]):
+    return {"openai": OpenAIBatchTransport, "anthropic": AnthropicBatchTransport}[provider](api_key)
+
+def mock_batch_transport(provider: str, api_key: Optional[str]):
+    return MockBatchTransport(provider)
+
+BATCH_TRANSPORTS = {"Provider batch API": provider_batch_transport, "Mock (local, no API calls)": mock_batch_transport}
+
+BATCH_CALL_FIELDS = ("agent", "provider", "model", "system_prompt", "user_prompt", "max_tokens", "temperature", "budget")
+
+def batch_calls(items: List[Dict[str, Any]], keys: Dict[str, Optional[str]], emit) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Resolve + budget (no summarization) every item; {provider: {item id: call}}, with providers that have
+    no batch endpoint under "". Items that cannot be resolved are emitted as failures right away.
+    """
+    by_provider: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    for it in items:
+        call = resolve_agent_call(it["agent_conf"], it["input"], it.get("overrides") or {}, keys)
+        if call.get("error"):
+            emit(it["id"], "", {"agent": call["agent"], "provider": call["provider"], "model": call["model"], "error": call["error"]})
+            continue
+        call = budget_agent_call(call, keys, allow_summary=False)
+        by_provider.setdefault(call["provider"] if call["provider"] in BATCH_PROVIDERS else "", {})[it["id"]] = call
+    return by_provider
+
+def submit_agent_batches(
+    by_provider: Dict[str, Dict[str, Dict[str, Any]]],
+    keys: Dict[str, Optional[str]],
+    transport_factory,
+    emit,
+    on_status=None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    One JSONL batch per provider, submitted via transport_factory(provider, api_key). Returns
+    {provider: batch} for poll_agent_batch; a failed submission fails its items instead.
+    """
+    batches: Dict[str, Dict[str, Any]] = {}
+    for provider, calls in by_provider.items():
+        if not provider:
+            continue
+        custom = {f"req-{i}": item_id for i, item_id in enumerate(calls)}
+        jsonl = "\n".join(json.dumps(batch_request_line(calls[iid], cid), ensure_ascii=False) for cid, iid in custom.items())
+        b = {"id": "", "custom": custom, "calls": {iid: {k: c.get(k) for k in BATCH_CALL_FIELDS} for iid, c in calls.items()},
+             "submitted": time.time(), "emitted": set()}
+        try:
+            b["transport"] = transport_factory(provider, keys.get(provider))
+            b["id"] = b["transport"].submit(jsonl)
+        except Exception as e:
+            _fail_batch(provider, b, classify_llm_exception(provider, e), emit)
+            continue
+        batches[provider] = b
+        if on_status is not None:
+            on_status(provider, b, {"status": "submitted", "done": False, "total": len(calls)})
+    return batches
+
+def run_interactive_calls(calls: Dict[str, Dict[str, Any]], emit, cancel_event: Optional[threading.Event] = None) -> None:
+    """Items of providers without a batch endpoint: regular calls, concurrent within the provider budgets."""
+    if not calls:
+        return
+    sems = get_provider_semaphores()
+
+    def work(item_id: str, call: Dict[str, Any]) -> None:
+        sem = sems.get(call["provider"])
+        if sem is not None:
+            sem.acquire()
+        try:
+            if cancel_event is not None and cancel_event.is_set():
+                emit(item_id, "", {"agent": call["agent"], "provider": call["provider"], "model": call["model"],
+                                   "error": LLMError("cancelled", "Batch run cancelled.", call["provider"])})
+                return
+            text, meta = call_llm(**_llm_kwargs(call))
+        finally:
+            if sem is not None:
+                sem.release()
+        meta.update({"agent": call["agent"], "budget": call["budget"], "batch": {"mode": "interactive"}})
+        emit(item_id, text, meta)
+
+    with ThreadPoolExecutor(max_workers=min(len(calls), DAG_MAX_WORKERS), thread_name_prefix="batch-fallback") as ex:
+        for f in [ex.submit(work, iid, call) for iid, call in calls.items()]:
+            f.result()
+
+def _fail_batch(provider: str, b: Dict[str, Any], err: LLMError, emit) -> None:
+    for item_id, call in b["calls"].items():
+        if item_id not in b["emitted"]:
+            b["emitted"].add(item_id)
+            emit(item_id, "", {"agent": call["agent"], "provider": provider, "model": call["model"],
+                               "batch": {"mode": "batch", "id": b["id"]}, "error": err})
+
+def poll_agent_batch(
+    provider: str,
+    b: Dict[str, Any],
+    emit,
+    on_status=None,
+    cancel_event: Optional[threading.Event] = None,
+    timeout_s: float = BATCH_TIMEOUT_S,
+) -> bool:
+    """
+    One polling round for a submitted batch (see submit_agent_batches): cancels it once cancel_event is
+    set, emits every item when it is done (items without a result as failures), fails it past timeout_s.
+    Returns True when the batch needs no more polling.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        try:
+            b["transport"].cancel(b["id"])
+        except Exception:
+            pass
+        _fail_batch(provider, b, LLMError("cancelled", "Batch run cancelled.", provider), emit)
+        return True
+    try:
+        status = b["transport"].poll(b["id"])
+    except Exception as e:
+        err = classify_llm_exception(provider, e)
+        if err.retryable and time.time() - b["submitted"] <= timeout_s:
+            return False  # transient; try again on the next round
+        _fail_batch(provider, b, err, emit)
+        return True
+    if on_status is not None:
+        on_status(provider, b, status)
+    if not status.get("done"):
+        if time.time() - b["submitted"] > timeout_s:
+            _fail_batch(provider, b, LLMError("timeout", f"Batch not finished after {timeout_s:.0f}s.", provider), emit)
+            return True
+        return False
+    turnaround = round(time.time() - b["submitted"], 3)
+    try:
+        for rec in b["transport"].results(b["id"]):
+            item_id = b["custom"].get(rec.get("custom_id"))
+            if item_id is None or item_id in b["emitted"]:
+                continue
+            call = b["calls"][item_id]
+            text = (rec.get("text") or "").strip()
+            meta = {"agent": call["agent"], "provider": provider, "model": call["model"],
+                    "max_tokens": call["max_tokens"], "temperature": call["temperature"], "budget": call["budget"],
+                    "elapsed_s": turnaround, "batch": {"mode": "batch", "id": b["id"], "custom_id": rec.get("custom_id")}}
+            if rec.get("error"):
+                meta["error"] = LLMError("batch_failed", str(rec["error"]), provider)
+                text = ""
+            else:
+                meta["usage"] = rec.get("usage")
+                _finalize_usage(meta, f"{call['system_prompt']}\n{call['user_prompt']}", text)
+                if meta.get("cost_usd") is not None:
+                    meta["cost_usd"] = round(meta["cost_usd"] * BATCH_PRICE_FACTOR, 6)
+            b["emitted"].add(item_id)
+            emit(item_id, text, meta)
+    except Exception as e:
+        _fail_batch(provider, b, classify_llm_exception(provider, e), emit)
+    _fail_batch(provider, b, LLMError("batch_failed", f"No result returned (batch {status.get('status')}).", provider), emit)
+    return True
+
+def run_agent_batch(
+    items: List[Dict[str, Any]],
+    keys: Dict[str, Optional[str]],
+    transport_factory=provider_batch_transport,
+    poll_s: float = BATCH_POLL_S,
+    timeout_s: float = BATCH_TIMEOUT_S,
+    cancel_event: Optional[threading.Event] = None,
+    on_status=None,
+    on_result=None,
+) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    """
+    Bulk agent runs through provider batch endpoints, blocking until every item has a result.
+    items: [{"id", "agent_conf", "input", "overrides"}]. Batches are submitted first (one JSONL per
+    provider), then providers without a batch endpoint run as regular calls, then the batches are
+    polled until done. Returns {item id: (text, meta)}; on_status(provider, batch, status) and
+    on_result(item_id, text, meta) report progress. Background jobs use the same pieces but hand the
+    polling to JobRunner's poller thread.
+    """
+    results: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+    def emit(item_id: str, text: str, meta: Dict[str, Any]) -> None:
+        results[item_id] = (text, meta)
+        if on_result is not None:
+            on_result(item_id, text, meta)
+
+    by_provider = batch_calls(items, keys, emit)
+    batches = submit_agent_batches(by_provider, keys, transport_factory, emit, on_status)
+    run_interactive_calls(by_provider.get("", {}), emit, cancel_event)
+    while batches:
+        for provider in list(batches):
+            if poll_agent_batch(provider, batches[provider], emit, on_status, cancel_event, timeout_s):
+                del batches[provider]
+        if not batches:
+            break
+        if cancel_event is not None:
+            cancel_event.wait(poll_s)
+        else:
+            time.sleep(poll_s)
+    return results
+
+# =========================
+# Background jobs (chain/DAG runs that outlive a script rerun)
+# =========================
+JOBS_DIR = os.path.join(LLM_CACHE_DIR, "jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", "50"))
+JOB_POLL_S = float(os.environ.get("JOB_POLL_S", "2"))
+JOB_PERSIST_INTERVAL_S = float(os.environ.get("JOB_PERSIST_INTERVAL_S", "2"))  # batch results: min gap between job JSON writes
+JOB_ACTIVE = ("queued", "running")
+
+def _job_json_default(o):
+    return {"__llm_error__": True, **o.__dict__} if hasattr(o, "retryable") else str(o)
+
+def _job_json_hook(d):
+    if d.pop("__llm_error__", False):
+        return LLMError(**d)
+    return d
+
+class JobRunner:
+    """
+    Process-wide runner for agent chains. Jobs execute on a small thread pool, outside any
+    Streamlit script run, so widget interactions no longer kill in-flight calls. Job state
+    (queued / running / done / failed / cancelled) is mirrored to JSON under JOBS_DIR;
+    API keys are only held in memory for the duration of the run.
+    Batch jobs only use a pool thread to submit; the provider batches are then polled by one
+    lightweight poller thread, and batches persisted by a previous process are polled again on
+    start (with keys from the environment, or from the owner's session via resume()).
+    """
+
+    def __init__(self, jobs_dir: str = JOBS_DIR, workers: int = JOB_WORKERS, batch_poll_s: float = BATCH_POLL_S):
+        self.jobs_dir = jobs_dir
+        self.batch_poll_s = batch_poll_s
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._cancel: Dict[str, threading.Event] = {}
+        self._watched: Dict[str, Dict[str, Any]] = {}  # job id -> {"batches", "t0"} polled by the poller
+        self._persisted: Dict[str, float] = {}  # job id -> time of the last JSON write
+        self._dirty: set = set()  # jobs with batch results not written yet (see _record / _flush)
+        self._wake = threading.Event()
+        os.makedirs(jobs_dir, exist_ok=True)
+        self._load()
+        threading.Thread(target=self._poll_loop, name="batch-poller", daemon=True).start()
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _load(self) -> None:
+        resume: List[str] = []
+        for fn in sorted(os.listdir(self.jobs_dir)):
+            if not fn.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, fn), "r", encoding="utf-8") as f:
+                    job = json.load(f, object_hook=_job_json_hook)
+            except Exception:
+                continue
+            if job.get("status") in JOB_ACTIVE and job.get("mode") == "batch" and any(
+                b.get("id") and b.get("custom") for b in job.get("batches", {}).values()
+            ):
+                # provider batches keep running (and are billed) without us: poll them again
+                job.update({"status": "running", "running": []})
+                self._cancel[job["id"]] = threading.Event()
+                resume.append(job["id"])
+            elif job.get("status") in JOB_ACTIVE:
+                # The process that owned it is gone.
+                job.update({"status": "failed", "error": "Interrupted by a server restart.", "running": []})
+            self._jobs[job["id"]] = job
+        env_keys = {p: os.environ.get(env) for p, env in BATCH_KEY_ENV.items()}
+        for job_id in resume:
+            self._resume_batches(job_id, env_keys, restarted=True)
+
+    def _persist(self, job: Dict[str, Any]) -> None:
+        tmp = self._path(job["id"]) + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(job, f, ensure_ascii=False, default=_job_json_default)
+            os.replace(tmp, self._path(job["id"]))
+        except Exception:
+            pass
+        self._persisted[job["id"]] = time.time()
+        self._dirty.discard(job["id"])
+
+    def _flush(self, job_id: str) -> None:
+        with self._lock:
+            if job_id in self._dirty and job_id in self._jobs:
+                self._persist(self._jobs[job_id])
+
+    def _update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(fields)
+            self._persist(job)
+
+    def _prune(self) -> None:
+        finished = sorted((j for j in self._jobs.values() if j["status"] not in JOB_ACTIVE), key=lambda j: j["created"])
+        for job in finished[: max(0, len(self._jobs) - JOB_RETENTION)]:
+            self._jobs.pop(job["id"], None)
+            try:
+                os.remove(self._path(job["id"]))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _owner_hash(owner: str) -> str:
+        return hashlib.sha256(owner.encode("utf-8")).hexdigest() if owner else ""
+
+    def _enqueue(self, mode: str, labels: List[str], deps: Dict[str, List[str]], owner: str, fn, *args) -> str:
+        job_id = new_run_id(mode)
+        job = {
+            "id": job_id,
+            "owner": self._owner_hash(owner),  # only the hash is persisted
+            "mode": mode,
+            "agents": list(labels),
+            "deps": deps,
+            "status": "queued",
+            "created": now_str(),
+            "started": None,
+            "finished": None,
+            "running": [],
+            "outputs": {},
+            "metas": {},
+            "timeline": [],
+            "batches": {},
+            "wall_s": 0.0,
+            "sum_s": 0.0,
+            "error": None,
+        }
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = job
+            self._cancel[job_id] = threading.Event()
+            self._persist(job)
+        self._executor.submit(self._run, job_id, fn, *args)
+        return job_id
+
+    def _run(self, job_id: str, fn, *args) -> None:
+        cancel = self._cancel[job_id]
+        if cancel.is_set():
+            self._update(job_id, status="cancelled", finished=now_str())
+            return
+        self._update(job_id, status="running", started=now_str())
+        try:
+            final = fn(job_id, cancel, *args)
+        except Exception as e:
+            self._update(job_id, status="failed", finished=now_str(), running=[], error=f"{type(e).__name__}: {e}")
+            return
+        if final.pop("pending", False):  # provider batches still out: the poller finishes the job
+            self._update(job_id, **final)
+            return
+        self._update(job_id, status="cancelled" if cancel.is_set() else "done", finished=now_str(), running=[], **final)
+
+    def _record(self, job_id: str, name: str, text: str, meta: Dict[str, Any], span: Dict[str, Any], bulk: bool = False) -> None:
+        """bulk: results arrive many at a time (batch jobs); write the job JSON at most every
+        JOB_PERSIST_INTERVAL_S and leave the rest to _flush()."""
+        with self._lock:
+            job = self._jobs[job_id]
+            job["outputs"][name], job["metas"][name] = text, meta
+            job["timeline"].append(span)
+            if name in job["running"]:
+                job["running"].remove(name)
+            if bulk and time.time() - self._persisted.get(job_id, 0.0) < JOB_PERSIST_INTERVAL_S:
+                self._dirty.add(job_id)
+            else:
+                self._persist(job)
+
+    def submit(
+        self,
+        agent_names: List[str],
+        all_agents: List[Dict[str, Any]],
+        context: str,
+        overrides_by_agent: Dict[str, Dict[str, Any]],
+        keys: Dict[str, Optional[str]],
+        sequential: bool = False,
+        use_cache: bool = False,
+        owner: str = "",
+    ) -> str:
+        """owner: secret that later proves the right to re-attach to the job (see owns())."""
+        deps = build_agent_dag(agent_names, all_agents, sequential=sequential)  # raises ValueError on cycles
+        return self._enqueue(
+            "sequential" if sequential else "dag", agent_names, deps, owner, self._run_dag,
+            list(agent_names), all_agents, context, dict(overrides_by_agent), dict(keys), sequential, use_cache,
+        )
+
+    def _run_dag(self, job_id, cancel, agent_names, all_agents, context, overrides_by_agent, keys, sequential, use_cache) -> Dict[str, Any]:
+        def on_node_start(name: str) -> None:
+            with self._lock:
+                self._jobs[job_id]["running"].append(name)
+
+        result = run_agent_dag(
+            agent_names, all_agents, context, overrides_by_agent, keys,
+            on_node_done=lambda name, text, meta: self._record(job_id, name, text, meta, meta.get("dag", {})),
+            use_cache=use_cache, sequential=sequential, cancel_event=cancel, on_node_start=on_node_start,
+        )
+        return {"timeline": result["timeline"], "wall_s": result["wall_s"], "sum_s": result["sum_s"]}
+
+    def submit_batch(
+        self,
+        items: List[Dict[str, Any]],
+        keys: Dict[str, Optional[str]],
+        transport_factory=provider_batch_transport,
+        owner: str = "",
+    ) -> str:
+        """items as in run_agent_batch; each item id doubles as the job's node label."""
+        job_id = self._enqueue("batch", [it["id"] for it in items], {}, owner, self._run_batch, list(items), dict(keys), transport_factory)
+        # the transport's name lets a restarted process rebuild it and resume polling
+        self._update(job_id, transport=next((n for n, f in BATCH_TRANSPORTS.items() if f is transport_factory), ""))
+        return job_id
+
+    def _batch_emit(self, job_id: str, t0: float):
+        def emit(item_id: str, text: str, meta: Dict[str, Any]) -> None:
+            end = round(time.time() - t0, 3)
+            span = {"node": item_id, "provider": meta.get("provider", ""), "depends_on": [], "queued_s": 0.0,
+                    "start_s": 0.0, "end_s": end, "wait_s": 0.0, "status": "failed" if meta.get("error") else "done"}
+            self._record(job_id, item_id, text, meta, span, bulk=True)
+        return emit
+
+    def _batch_status(self, job_id: str):
+        def on_status(provider: str, b: Dict[str, Any], status: Dict[str, Any]) -> None:
+            with self._lock:
+                job = self._jobs[job_id]
+                info = job["batches"].setdefault(provider, {})
+                info.update(status, id=b["id"], custom=b["custom"], calls=b["calls"], submitted=b["submitted"])
+                self._persist(job)
+        return on_status
+
+    def _run_batch(self, job_id, cancel, items, keys, transport_factory) -> Dict[str, Any]:
+        t0 = time.time()
+        with self._lock:
+            self._jobs[job_id]["running"] = [it["id"] for it in items]
+        emit = self._batch_emit(job_id, t0)
+        by_provider = batch_calls(items, keys, emit)
+        # batches first, so the provider's clock starts before the interactive fallback runs
+        batches = submit_agent_batches(by_provider, keys, transport_factory, emit, self._batch_status(job_id))
+        run_interactive_calls(by_provider.get("", {}), emit, cancel)
+        self._flush(job_id)
+        if batches:
+            self._watch(job_id, batches, t0)
+            return {"pending": True}
+        wall = round(time.time() - t0, 3)
+        return {"wall_s": wall, "sum_s": wall}
+
+    def _watch(self, job_id: str, batches: Dict[str, Dict[str, Any]], t0: float) -> None:
+        with self._lock:
+            w = self._watched.setdefault(job_id, {"batches": {}, "t0": t0})
+            w["batches"].update(batches)
+        self._wake.set()
+
+    def _poll_loop(self) -> None:
+        while True:
+            self._wake.wait(self.batch_poll_s)
+            self._wake.clear()
+            with self._lock:
+                watched = [(job_id, w, list(w["batches"].items())) for job_id, w in self._watched.items()]
+            for job_id, w, batches in watched:
+                emit, on_status, cancel = self._batch_emit(job_id, w["t0"]), self._batch_status(job_id), self._cancel.get(job_id)
+                for provider, b in batches:
+                    try:
+                        finished = poll_agent_batch(provider, b, emit, on_status, cancel)
+                    except Exception as e:  # one broken batch must not stop the poller
+                        _fail_batch(provider, b, LLMError("unknown", f"{type(e).__name__}: {e}", provider), emit)
+                        finished = True
+                    if finished:
+                        with self._lock:
+                            w["batches"].pop(provider, None)
+                            self._jobs[job_id]["batches"].get(provider, {})["finished"] = True
+                self._flush(job_id)  # one write per job and round, however many results came in
+                with self._lock:
+                    if w["batches"] or self._jobs[job_id].get("awaiting_keys"):
+                        continue
+                    self._watched.pop(job_id, None)
+                self._finish_batch_job(job_id, w["t0"])
+
+    def _finish_batch_job(self, job_id: str, t0: float) -> None:
+        cancel = self._cancel.get(job_id)
+        wall = round(time.time() - t0, 3)
+        self._update(job_id, status="cancelled" if cancel is not None and cancel.is_set() else "done",
+                     finished=now_str(), running=[], wall_s=wall, sum_s=wall)
+
+    def _resume_batches(self, job_id: str, keys: Dict[str, Optional[str]], restarted: bool = False) -> None:
+        """Poll persisted provider batches of job_id again; providers without a usable key wait for resume()."""
+        with self._lock:
+            job = self._jobs[job_id]
+            watched = self._watched.get(job_id, {}).get("batches", {})
+            factory = BATCH_TRANSPORTS.get(job.get("transport", ""))
+            pending: set = set()
+            batches: Dict[str, Dict[str, Any]] = {}
+            waiting: List[str] = []
+            for provider, info in job["batches"].items():
+                if not info.get("id") or info.get("finished"):
+                    continue
+                left = {iid for iid in info.get("custom", {}).values() if iid not in job["outputs"]}
+                pending |= left
+                if not left or provider in watched:
+                    continue
+                if factory is None or (factory is provider_batch_transport and not keys.get(provider)):
+                    waiting.append(provider)
+                    continue
+                try:
+                    transport = factory(provider, keys.get(provider))
+                except Exception:
+                    waiting.append(provider)
+                    continue
+                batches[provider] = {"transport": transport, "id": info["id"], "custom": info["custom"],
+                                     "calls": info["calls"], "submitted": info["submitted"], "emitted": set(job["outputs"])}
+            job["awaiting_keys"] = waiting
+            lost = [iid for iid in job["agents"] if iid not in job["outputs"] and iid not in pending] if restarted else []
+            t0 = min((info.get("submitted") or time.time() for info in job["batches"].values()), default=time.time())
+            self._persist(job)
+        for iid in lost:  # interactive items and unsubmitted batches died with the old process
+            self._batch_emit(job_id, t0)(iid, "", {"error": LLMError("cancelled", "Interrupted by a server restart.")})
+        self._flush(job_id)
+        if batches or not waiting:
+            self._watch(job_id, batches, t0)  # an empty watch just lets the poller finish the job
+
+    def resume(self, job_id: str, keys: Dict[str, Optional[str]]) -> None:
+        """Supply API keys for a restarted batch job that is waiting for them (see awaiting_keys)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] not in JOB_ACTIVE or not job.get("awaiting_keys"):
+                return
+        self._resume_batches(job_id, keys)
+
+    def cancel(self, job_id: str) -> None:
+        ev = self._cancel.get(job_id)
+        if ev is not None:
+            ev.set()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == "queued":
+                job.update({"status": "cancelled", "finished": now_str()})
+                self._persist(job)
+            if job is not None and job.get("awaiting_keys"):
+                job["awaiting_keys"] = []  # stop waiting; the poller closes the job on its next round
+                self._watched.setdefault(job_id, {"batches": {}, "t0": time.time()})
+        self._wake.set()
+
+    def owns(self, job_id: str, owner: str) -> bool:
+        """True when owner is the secret the job was submitted with (jobs without one are never attachable)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            expected = job.get("owner", "") if job is not None else ""
+        return bool(expected and owner) and hmac.compare_digest(expected, self._owner_hash(owner))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            snap = dict(job)
+            snap.update({"outputs": dict(job["outputs"]), "metas": dict(job["metas"]),
+                         "running": list(job["running"]), "timeline": list(job["timeline"])})
+            return snap
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {s: 0 for s in ("queued", "running", "done", "failed", "cancelled")}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+@st.cache_resource(show_spinner=False)
+def get_job_runner() -> JobRunner:
+    return JobRunner()
+
+# =========================
+# Telemetry (derived from execution_log)
+# =========================
+def build_telemetry_frame(log: List[Dict[str, Any]]) -> pd.DataFrame:
+    rows = []
+    for rec in log:
+        meta = rec.get("meta", {}) or {}
+        usage = meta.get("usage") or {}
+        hit = meta.get("cache") == "hit"
+        rows.append({
+            "ts": rec.get("ts", ""),
+            "agent": rec.get("agent", ""),
+            "chain": rec.get("chain") or "—",
+            "provider": meta.get("provider", ""),
+            "model": meta.get("model", ""),
+            "latency_s": meta.get("elapsed_s"),
+            "ttft_s": meta.get("ttft_s"),
+            "queued_s": meta.get("queued_s"),
+            # Cache hits are not billed.
+            "input_tokens": 0 if hit else int(usage.get("input_tokens", rec.get("input_tokens_est", 0)) or 0),
+            "output_tokens": 0 if hit else int(usage.get("output_tokens", rec.get("output_tokens_est", 0)) or 0),
+            "cost_usd": 0.0 if hit else float(meta.get("cost_usd") or 0.0),
+            "usage_source": "cache" if hit else meta.get("usage_source", "estimate"),
+            "cache_hit": hit,
+            "failed": bool(meta.get("error")),
+        })
+    df = pd.DataFrame(rows)
+    for col in ("latency_s", "ttft_s", "queued_s"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df
+
+def telemetry_rollup(df: pd.DataFrame, key: str) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame()
+    totals = df.groupby(key).agg(
+        calls=("agent", "size"),
+        failed=("failed", "sum"),
+        cache_hits=("cache_hit", "sum"),
+        input_tokens=("input_tokens", "sum"),
+        output_tokens=("output_tokens", "sum"),
+        cost_usd=("cost_usd", "sum"),
+    )
+    # Latency percentiles only over real, successful provider round trips.
+    live = df[~df["cache_hit"] & ~df["failed"]]
+    lat = live.groupby(key).agg(
+        latency_p50=("latency_s", lambda x: x.quantile(0.5)),
+        latency_p95=("latency_s", lambda x: x.quantile(0.95)),
+        ttft_p50=("ttft_s", lambda x: x.quantile(0.5)),
+    )
+    out = totals.join(lat, how="left").sort_values("cost_usd", ascending=False)
+    out["cost_usd"] = out["cost_usd"].round(4)
+    return out.round({"latency_p50": 2, "latency_p95": 2, "ttft_p50": 2}).reset_index()
+
 def parse_pdf_text(pdf_bytes: bytes, pages_spec: str = "1") -> str:
     pages_spec = (pages_spec or "").strip() or "1"
     page_numbers = set()
@@ -814,6 +3037,546 @@ def safe_read_uploaded(file) -> Tuple[str, str]:
     return name, s
 
 
+# =========================
+# Distribution: standardized dataset cache (process-wide, memory LRU + optional Parquet spill)
+# =========================
+# Keyed by a hash of the raw upload/text, so the same extract standardizes once per process and,
+# with the spill directory, once per deployment. Bump DATASET_CACHE_VERSION whenever the output of
+# standardize_distribution changes so stale spills are ignored.
+DATASET_CACHE_VERSION = "2"
+DATASET_CACHE_DIR = os.environ.get("DATASET_CACHE_DIR", os.path.join(LLM_CACHE_DIR, "datasets"))
+DATASET_CACHE_MEMORY_BYTES = int(os.environ.get("DATASET_CACHE_MEMORY_MB", "512")) * 1024 * 1024
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_MB", "2048")) * 1024 * 1024
+DATASET_CACHE_SPILL = os.environ.get("DATASET_CACHE_SPILL", "1").lower() not in ("0", "false", "no")
+
+def dataset_content_key(source) -> str:
+    """sha256 of the raw dataset (str, bytes or a seekable binary file object, read in 1 MB blocks)."""
+    h = hashlib.sha256(DATASET_CACHE_VERSION.encode("utf-8"))
+    if isinstance(source, str):
+        h.update(source.encode("utf-8"))
+    elif isinstance(source, (bytes, bytearray)):
+        h.update(source)
+    else:
+        source.seek(0)
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            h.update(block)
+        source.seek(0)
+    return h.hexdigest()
+
+class DatasetCache:
+    """
+    Standardized (frame, extras) pairs by content key. The memory tier is an LRU capped by
+    deep memory usage; the disk tier writes one directory per key (Parquet, or pickle when
+    pyarrow is missing or a column does not convert) and drops least-recently-used entries beyond
+    max_bytes. Hits return shallow copies, so callers can add columns without touching the cache.
+    """
+
+    def __init__(self, path: str, memory_bytes: int, max_bytes: int, spill: bool):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.evictions = {"memory": 0, "disk": 0}
+        self._lock = threading.Lock()
+        self._mem: "OrderedDict[str, Tuple[pd.DataFrame, pd.DataFrame, int]]" = OrderedDict()
+        self._mem_total = 0
+        if spill:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _copy(df: pd.DataFrame, extras: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        out = df.copy(deep=False)
+        out.attrs = dict(df.attrs)
+        return out, extras.copy(deep=False)
+
+    def get(self, key: str) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, str]]:
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                self._mem.move_to_end(key)
+                self.hits["memory"] += 1
+                return (*self._copy(item[0], item[1]), "memory")
+        loaded = self._read_disk(key) if self.spill else None
+        with self._lock:
+            if loaded is None:
+                self.misses += 1
+                return None
+            self.hits["disk"] += 1
+            self._remember(key, *loaded)
+        return (*self._copy(*loaded), "disk")
+
+    def put(self, key: str, df: pd.DataFrame, extras: pd.DataFrame) -> None:
+        with self._lock:
+            self._remember(key, df, extras)
+        if self.spill:
+            try:
+                self._write_disk(key, df, extras)
+            except Exception:
+                pass
+            self._evict_disk()
+
+    @staticmethod
+    def _nbytes(df: pd.DataFrame) -> int:
+        # memory_usage(deep=True) walks every Python string; sample object columns instead
+        size = int(df.memory_usage(index=False).sum())
+        for col in df.columns:
+            s = df[col]
+            if s.dtype == object and len(s):
+                sample = s.iloc[:: max(1, len(s) // 1000)]
+                deep = sample.memory_usage(index=False, deep=True) - sample.memory_usage(index=False)
+                size += int(deep / len(sample) * len(s))
+        return size
+
+    def _remember(self, key: str, df: pd.DataFrame, extras: pd.DataFrame) -> None:
+        size = self._nbytes(df) + self._nbytes(extras)
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_total -= old[2]
+        self._mem[key] = (df, extras, size)
+        self._mem_total += size
+        while self._mem_total > self.memory_bytes and len(self._mem) > 1:
+            _, (_, _, s) = self._mem.popitem(last=False)
+            self._mem_total -= s
+            self.evictions["memory"] += 1
+
+    # ---- disk tier ----
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def _write_disk(self, key: str, df: pd.DataFrame, extras: pd.DataFrame) -> None:
+        final = self._entry_dir(key)
+        if os.path.isdir(final):
+            return
+        tmp = f"{final}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(tmp, exist_ok=True)
+        formats = {}
+        for name, frame in (("frame", df), ("extras", extras)):
+            try:
+                frame.to_parquet(os.path.join(tmp, f"{name}.parquet"), index=False)
+                formats[name] = "parquet"
+            except Exception:
+                frame.to_pickle(os.path.join(tmp, f"{name}.pkl"))
+                formats[name] = "pickle"
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": DATASET_CACHE_VERSION, "rows": int(len(df)), "formats": formats,
+                       "attrs": df.attrs, "created": time.time()}, f, ensure_ascii=False, default=str)
+        try:
+            os.replace(tmp, final)
+        except OSError:
+            # another session spilled the same key first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _read_disk(self, key: str) -> Optional[Tuple[pd.DataFrame, pd.DataFrame]]:
+        d = self._entry_dir(key)
+        meta_path = os.path.join(d, "meta.json")
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != DATASET_CACHE_VERSION:
+                return None
+            frames = []
+            for name in ("frame", "extras"):
+                if meta["formats"][name] == "parquet":
+                    frames.append(pd.read_parquet(os.path.join(d, f"{name}.parquet")))
+                else:
+                    frames.append(pd.read_pickle(os.path.join(d, f"{name}.pkl")))
+            os.utime(meta_path)  # last access, for LRU eviction
+        except Exception:
+            return None
+        df, extras = frames
+        df.attrs = meta.get("attrs") or {}
+        return df, extras
+
+    def _disk_entries(self) -> List[Tuple[str, float, int]]:
+        out = []
+        if not os.path.isdir(self.path):
+            return out
+        for name in os.listdir(self.path):
+            d = os.path.join(self.path, name)
+            meta_path = os.path.join(d, "meta.json")
+            if ".tmp-" in name or not os.path.isfile(meta_path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d))
+                out.append((name, os.path.getmtime(meta_path), size))
+            except OSError:
+                continue
+        return out
+
+    def _evict_disk(self) -> None:
+        entries = sorted(self._disk_entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        for name, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            total -= size
+            with self._lock:
+                self.evictions["disk"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._mem_total = 0
+        for name, _, _ in self._disk_entries():
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        disk = self._disk_entries() if self.spill else []
+        with self._lock:
+            return {
+                "memory_entries": len(self._mem),
+                "memory_bytes": int(self._mem_total),
+                "disk_entries": len(disk),
+                "disk_bytes": int(sum(e[2] for e in disk)),
+                "hits_memory": self.hits["memory"],
+                "hits_disk": self.hits["disk"],
+                "misses": self.misses,
+                "evictions_memory": self.evictions["memory"],
+                "evictions_disk": self.evictions["disk"],
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_dataset_cache() -> DatasetCache:
+    return DatasetCache(
+        path=DATASET_CACHE_DIR,
+        memory_bytes=DATASET_CACHE_MEMORY_BYTES,
+        max_bytes=DATASET_CACHE_MAX_BYTES,
+        spill=DATASET_CACHE_SPILL,
+    )
+
+# =========================
+# Distribution: dataset store (named datasets on disk, Arrow IPC partitioned by Deliverdate month)
+# =========================
+# One directory per dataset under DATASET_STORE_DIR with hive partitions month=YYYY-MM (rows without
+# a date go to month=none). Files are uncompressed Arrow IPC so loads memory-map them; a load with a
+# date range only opens the partitions it overlaps and only the requested columns.
+DATASET_STORE_DIR = os.environ.get("DATASET_STORE_DIR", os.path.join("data", "datasets"))
+DATASET_STORE_NO_MONTH = "none"
+
+def dataset_store_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.dataset  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Object columns with mixed Python types (e.g. int and str Deliverdate from JSON) become text."""
+    fixes = {}
+    for c in df.columns:
+        s = df[c]
+        if s.dtype == object and pd.api.types.infer_dtype(s, skipna=True) not in ("string", "empty"):
+            fixes[c] = s.astype(object).where(s.isna(), s.astype(str))
+    return df.assign(**fixes) if fixes else df
+
+class DatasetStore:
+    """
+    Catalog of named distribution datasets. catalog.json maps name -> entry (directory, rows, months,
+    date range, bytes, columns, attrs); the standardized rows carry a _row column (original position) so
+    a pruned load can restore order and re-base the extras side table.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._catalog_path = os.path.join(root, "catalog.json")
+
+    def catalog(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self._catalog_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _write_catalog(self, cat: Dict[str, Dict[str, Any]]) -> None:
+        tmp = self._catalog_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cat, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, self._catalog_path)
+
+    @staticmethod
+    def _dirname(name: str) -> str:
+        slug = re.sub(r"[^\w.-]+", "_", name).strip("._")[:60] or "dataset"
+        return f"{slug}-{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}"
+
+    def save(self, name: str, df: pd.DataFrame, extras: Optional[pd.DataFrame] = None) -> Dict[str, Any]:
+        import pyarrow as pa
+        import pyarrow.dataset as pads
+        import pyarrow.feather as feather
+
+        name = (name or "").strip()
+        if not name:
+            raise ValueError("dataset name is empty")
+        final = os.path.join(self.root, self._dirname(name))
+        tmp = f"{final}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        # month label per row, formatted once per distinct month (NaT -> code -1 -> the last label)
+        codes, uniq = pd.factorize(df["Deliverdate_dt"].to_numpy(dtype="datetime64[ns]").astype("datetime64[M]"))
+        months = np.array([str(u)[:7] for u in uniq] + [DATASET_STORE_NO_MONTH], dtype=object)[codes]
+        frame = _arrow_safe(df).assign(_row=np.arange(len(df), dtype=np.int64), month=months)
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        pads.write_dataset(
+            table,
+            os.path.join(tmp, "rows"),
+            format="ipc",
+            partitioning=pads.partitioning(pa.schema([("month", pa.string())]), flavor="hive"),
+            existing_data_behavior="delete_matching",
+        )
+        if extras is not None and len(extras):
+            ex = extras.assign(value=extras["value"].astype(object).where(extras["value"].isna(), extras["value"].astype(str)))
+            feather.write_feather(ex, os.path.join(tmp, "extras.arrow"), compression="uncompressed")
+        size = sum(os.path.getsize(os.path.join(r, f)) for r, _, fs in os.walk(tmp) for f in fs)
+        dates = df["Deliverdate_dt"].dropna()
+        entry = {
+            "dir": os.path.basename(final),
+            "rows": int(len(df)),
+            "months": sorted(pd.unique(months).tolist()),
+            "date_min": str(dates.min().date()) if len(dates) else None,
+            "date_max": str(dates.max().date()) if len(dates) else None,
+            "bytes": int(size),
+            "columns": list(df.columns),
+            "extras_rows": int(len(extras)) if extras is not None else 0,
+            "attrs": df.attrs,
+            "saved": now_str(),
+        }
+        with self._lock:
+            old = f"{final}.old-{os.getpid()}"
+            if os.path.isdir(final):
+                os.replace(final, old)
+            os.replace(tmp, final)
+            shutil.rmtree(old, ignore_errors=True)
+            cat = self.catalog()
+            cat[name] = entry
+            self._write_catalog(cat)
+        return entry
+
+    def load(
+        self,
+        name: str,
+        date_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]] = None,
+        columns: Optional[List[str]] = None,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, Any]]:
+        """
+        Memory-map a saved dataset. date_range prunes month partitions (and rows, whole days) before
+        anything is read; columns prunes the rest. Returns (frame, extras, info) where info has the
+        partitions read and bytes on disk they hold.
+        """
+        import pyarrow.dataset as pads
+        import pyarrow.feather as feather
+
+        entry = self.catalog().get(name)
+        if entry is None:
+            raise KeyError(f"dataset '{name}' is not in the store")
+        base = os.path.join(self.root, entry["dir"])
+        dset = self.arrow_dataset(name)
+        expr = None
+        months = list(entry.get("months") or [])
+        if date_range:
+            start, end = date_range
+            lo, hi = start.strftime("%Y-%m"), end.strftime("%Y-%m")
+            months = [m for m in months if m != DATASET_STORE_NO_MONTH and lo <= m <= hi]
+            expr = (
+                (pads.field("month") >= lo) & (pads.field("month") <= hi)
+                & (pads.field("Deliverdate_dt") >= start.normalize())
+                & (pads.field("Deliverdate_dt") < end.normalize() + pd.Timedelta(days=1))
+            )
+        cols = [c for c in entry["columns"] if columns is None or c in columns or c == "Deliverdate_dt"]
+        fragments = list(dset.get_fragments(filter=expr)) if expr is not None else list(dset.get_fragments())
+        table = dset.to_table(columns=cols + ["_row"], filter=expr)
+        df = table.to_pandas()
+        order = np.argsort(df["_row"].to_numpy(), kind="stable")
+        src_rows = df["_row"].to_numpy()[order]
+        df = df.take(order).drop(columns=["_row"]).reset_index(drop=True)
+        for c in STANDARD_COLS:
+            # columns that were pruned still exist (empty) so the rest of the tab keeps working
+            if c not in df.columns:
+                df[c] = pd.Categorical([""] * len(df)) if c in DIST_CATEGORICAL_COLS else ""
+        df.attrs = dict(entry.get("attrs") or {})
+        extras = _extras_side_table(pd.DataFrame())
+        ex_path = os.path.join(base, "extras.arrow")
+        if os.path.exists(ex_path):
+            ex = feather.read_table(ex_path, memory_map=True).to_pandas()
+            pos = np.searchsorted(src_rows, ex["row"].to_numpy())
+            pos_c = np.minimum(pos, max(len(src_rows) - 1, 0))
+            hit = (pos < len(src_rows)) & (src_rows[pos_c] == ex["row"].to_numpy()) if len(src_rows) else np.zeros(len(ex), dtype=bool)
+            extras = ex[hit].assign(row=pos[hit].astype(np.int32)).reset_index(drop=True)[DIST_EXTRAS_COLS]
+        info = {
+            "partitions": len(fragments),
+            "partitions_total": len(entry.get("months") or []),
+            "bytes": sum(os.path.getsize(f.path) for f in fragments),
+            "months": months,
+        }
+        return df, extras, info
+
+    def arrow_dataset(self, name: str):
+        """The saved rows as a memory-mapped pyarrow dataset (month partition column, plus _row), for scanners like DuckDB."""
+        import pyarrow.dataset as pads
+        import pyarrow.fs as pafs
+
+        entry = self.catalog().get(name)
+        if entry is None:
+            raise KeyError(f"dataset '{name}' is not in the store")
+        return pads.dataset(
+            os.path.join(self.root, entry["dir"], "rows"),
+            format="ipc",
+            partitioning="hive",
+            filesystem=pafs.LocalFileSystem(use_mmap=True),
+        )
+
+    def delete(self, name: str) -> None:
+        with self._lock:
+            cat = self.catalog()
+            entry = cat.pop(name, None)
+            if entry is not None:
+                shutil.rmtree(os.path.join(self.root, entry["dir"]), ignore_errors=True)
+                self._write_catalog(cat)
+
+@st.cache_resource(show_spinner=False)
+def get_dataset_store() -> DatasetStore:
+    return DatasetStore(DATASET_STORE_DIR)
+
+# =========================
+# Distribution: SQL console (DuckDB, in-process, read-only)
+# =========================
+# Every query gets its own in-memory DuckDB connection: the standardized frame is registered as
+# `shipments` (the table name the 21-SQL agent's prompt assumes) and its aggregate cube as
+# `shipments_cube`, both zero-copy. Store datasets are scanned straight from their Arrow partitions.
+# File access is switched off and the configuration locked before any user SQL runs.
+SQL_TABLE_NAME = "shipments"
+SQL_PAGE_ROWS = int(os.environ.get("SQL_PAGE_ROWS", "500"))
+SQL_TIMEOUT_S = float(os.environ.get("SQL_TIMEOUT_S", "30"))
+SQL_THREADS = int(os.environ.get("SQL_THREADS", "4"))
+SQL_MEMORY_LIMIT = os.environ.get("SQL_MEMORY_LIMIT", "1GB")
+_SQL_FENCE_RE = re.compile(r"```[ \t]*([\w+-]*)[^\n]*\n(.*?)```", re.S)
+_SQL_LANGS = ("sql", "duckdb", "postgresql", "postgres", "mysql", "sqlite")
+
+def sql_engine_available() -> bool:
+    try:
+        import duckdb  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+def extract_sql_blocks(text: str) -> List[str]:
+    """Queries in an agent's output: ```sql fences (or untagged ones starting with SELECT/WITH), one entry per statement."""
+    import duckdb
+
+    out = []
+    for lang, body in _SQL_FENCE_RE.findall(text or ""):
+        lang = lang.lower()
+        if lang not in _SQL_LANGS and not (lang == "" and re.match(r"\s*(--[^\n]*\n\s*)*(select|with)\b", body, re.I)):
+            continue
+        try:
+            statements = [s.query for s in duckdb.extract_statements(body)]
+        except Exception:
+            statements = [body]  # dialect DuckDB can't parse: still offer it, the run reports the error
+        out.extend(q.strip().rstrip(";").strip() for q in statements if q.strip().rstrip(";").strip())
+    return out
+
+class SqlResultStream:
+    """
+    One query and its result, read forward in pages of page_rows over an Arrow batch reader. Pages are
+    kept once fetched, so paging back is free and paging forward only pulls what the next page needs.
+    Execution and every fetch run under timeout_s (the connection is interrupted past it); the
+    connection is closed once the result is exhausted or on close().
+    """
+
+    def __init__(
+        self,
+        sql: str,
+        tables: Dict[str, Any],
+        views: Optional[Dict[str, str]] = None,
+        page_rows: int = SQL_PAGE_ROWS,
+        timeout_s: float = SQL_TIMEOUT_S,
+    ):
+        import duckdb
+
+        statements = duckdb.extract_statements(sql)
+        if len(statements) != 1:
+            raise ValueError(f"run one statement at a time (found {len(statements)})")
+        if statements[0].type != duckdb.StatementType.SELECT:
+            raise ValueError("only read queries (SELECT / WITH / DESCRIBE / SUMMARIZE) are allowed")
+        self.sql = statements[0].query.strip()
+        self.page_rows = max(1, int(page_rows))
+        self.timeout_s = float(timeout_s)
+        self.pages: List[pd.DataFrame] = []
+        self.exhausted = False
+        self.ms = 0.0
+        self._carry = None  # rows read past the end of the last page
+        self._con = duckdb.connect(":memory:", config={"threads": SQL_THREADS, "memory_limit": SQL_MEMORY_LIMIT})
+        try:
+            for name, obj in tables.items():
+                self._con.register(name, obj)
+            for name, body in (views or {}).items():
+                self._con.execute(f'CREATE VIEW "{name}" AS {body}')
+            self._con.execute("SET enable_external_access = false")
+            self._con.execute("SET lock_configuration = true")
+            self._reader = self._guarded(lambda: self._con.execute(self.sql).to_arrow_reader(self.page_rows))
+        except Exception:
+            self.close()
+            raise
+        self.columns = list(self._reader.schema.names)
+
+    def _guarded(self, fn):
+        import duckdb
+
+        timer = threading.Timer(self.timeout_s, self._con.interrupt)
+        t0 = time.perf_counter()
+        timer.start()
+        try:
+            return fn()
+        except duckdb.InterruptException:
+            self.close()
+            raise TimeoutError(f"query cancelled after {self.timeout_s:g}s (SQL_TIMEOUT_S)") from None
+        finally:
+            timer.cancel()
+            self.ms += (time.perf_counter() - t0) * 1000
+
+    def _fetch_page(self) -> None:
+        import pyarrow as pa
+
+        parts = [self._carry] if self._carry is not None else []
+        n = self._carry.num_rows if self._carry is not None else 0
+        while n < self.page_rows and not self.exhausted:
+            try:
+                batch = self._guarded(self._reader.read_next_batch)
+            except StopIteration:
+                self.exhausted = True
+                self.close()
+                break
+            parts.append(pa.Table.from_batches([batch]))
+            n += batch.num_rows
+        table = pa.concat_tables(parts) if parts else self._reader.schema.empty_table()
+        self._carry = table.slice(self.page_rows) if table.num_rows > self.page_rows else None
+        if table.num_rows or not self.pages:
+            self.pages.append(table.slice(0, self.page_rows).to_pandas())
+
+    def page(self, i: int) -> pd.DataFrame:
+        while len(self.pages) <= i and not (self.exhausted and self._carry is None):
+            self._fetch_page()
+        return self.pages[min(i, len(self.pages) - 1)]
+
+    def has_page(self, i: int) -> bool:
+        """False only once it is known that page i would be empty."""
+        return i < len(self.pages) or not (self.exhausted and self._carry is None)
+
+    @property
+    def rows_fetched(self) -> int:
+        return sum(len(p) for p in self.pages)
+
+    def close(self) -> None:
+        con, self._con = getattr(self, "_con", None), None
+        if con is not None:
+            try:
+                con.close()
+            except Exception:
+                pass
+
 # =========================
 # Distribution: parsing + standardization
 # =========================
@@ -857,6 +3620,202 @@ def _coerce_deliverdate_to_datetime(x) -> Optional[pd.Timestamp]:
     except Exception:
         return None
 
+# Vectorized Deliverdate engine. The formats' patterns are disjoint; each one only sees values no
+# earlier format parsed, and whatever is left goes through _coerce_deliverdate_to_datetime, so the
+# result equals the per-row parser value for value.
+DELIVERDATE_FORMATS = [
+    ("%Y%m%d", r"\d{8}"),
+    ("%Y-%m-%d", r"\d{4}-\d{2}-\d{2}"),
+    ("%Y/%m/%d", r"\d{4}/\d{2}/\d{2}"),
+    ("%Y-%m-%d %H:%M:%S", r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}"),
+    ("%m/%d/%Y", r"\d{2}/\d{2}/\d{4}"),
+]
+DATE_FORMAT_CACHE_ENTRIES = 128
+
+@st.cache_resource(show_spinner=False)
+def get_date_format_cache() -> "OrderedDict[str, List[str]]":
+    # Signature of a dataset's date values -> formats that matched last time, most frequent first.
+    return OrderedDict()
+
+def parse_deliverdate_column(col: pd.Series) -> Tuple[pd.Series, Dict[str, Any]]:
+    """
+    Parse a Deliverdate column to datetime64. Works on the distinct values only (factorize), tries the
+    YYYYMMDD fast path and the other DELIVERDATE_FORMATS vectorized, and falls back to the per-value
+    parser for the rest. Returns (series, stats) where stats counts rows per format.
+    """
+    codes, uniques = pd.factorize(col)
+    ustr = pd.Series(uniques, dtype=object).astype(str).str.strip()
+    n = len(ustr)
+    weights = np.bincount(codes[codes >= 0], minlength=n)
+    parsed = np.full(n, np.datetime64("NaT"), dtype="datetime64[ns]")
+    done = (ustr == "").to_numpy(dtype=bool)
+    stats: Dict[str, Any] = {"rows": int(len(col)), "missing": int((codes < 0).sum() + weights[done].sum())}
+
+    cache = get_date_format_cache()
+    sig = hashlib.md5("\n".join(ustr.head(256)).encode("utf-8")).hexdigest()
+    cached = cache.get(sig)
+    stats["cached_detection"] = cached is not None
+    order = list(cached or []) + [f for f, _ in DELIVERDATE_FORMATS if f not in (cached or [])]
+    patterns = dict(DELIVERDATE_FORMATS)
+
+    for fmt in order:
+        todo = np.flatnonzero(~done)
+        if not len(todo):
+            break
+        sub = ustr.iloc[todo]
+        m = sub.str.fullmatch(patterns[fmt]).to_numpy(dtype=bool)
+        if not m.any():
+            continue
+        idx = todo[m]
+        vals = pd.to_datetime(sub[m], format=fmt, errors="coerce").to_numpy(dtype="datetime64[ns]")
+        ok = ~np.isnat(vals)
+        parsed[idx[ok]] = vals[ok]
+        # Per-row semantics: an 8-digit value that isn't a valid date is final (None); other
+        # formats leave their failures to the generic parser.
+        done[idx if fmt == "%Y%m%d" else idx[ok]] = True
+        stats[fmt] = int(weights[idx[ok]].sum())
+
+    rest = np.flatnonzero(~done)
+    fallback_rows = 0
+    for i in rest:
+        v = _coerce_deliverdate_to_datetime(ustr.iat[i])
+        if v is None or pd.isna(v):
+            continue
+        if v.tzinfo is not None:
+            # Timezone-aware strings: keep the exact per-row result (object dtype) rather than coerce.
+            stats["fallback"] = "per-row (timezone-aware values)"
+            return col.apply(_coerce_deliverdate_to_datetime), stats
+        parsed[i] = v.to_datetime64()
+        fallback_rows += int(weights[i])
+    if fallback_rows:
+        stats["fallback"] = fallback_rows
+
+    # missing values (code -1) index the trailing NaT slot; also covers a column with no values at all
+    out = np.append(parsed, np.datetime64("NaT", "ns"))[codes]
+    stats["unparsed"] = int(stats["rows"] - stats["missing"] - int((~np.isnat(out)).sum()))
+
+    hits = sorted((f for f, _ in DELIVERDATE_FORMATS if stats.get(f)), key=lambda f: -stats[f])
+    cache[sig] = hits
+    cache.move_to_end(sig)
+    while len(cache) > DATE_FORMAT_CACHE_ENTRIES:
+        cache.popitem(last=False)
+    return pd.Series(out, index=col.index, name=col.name), stats
+
+# CSV/TSV reading. The dialect is sniffed from a small sample rather than the whole text: the delimiter
+# whose field count is most consistent across lines, and whether ASCII double quotes really quote
+# fields. DeviceNAME values carry full-width quotes (“波士頓科技”…), which are never quote characters;
+# some exports write the same names with ASCII quotes (“"波士頓科技"英吉尼…”), and then quoting is
+# switched off so the quotes stay in the value. Every column is declared text up front: standardize
+# does the typing, and IDs such as UDID keep their leading zeros. pyarrow's multithreaded CSV reader
+# is used when it is installed, pandas' C parser otherwise.
+CSV_SNIFF_LINES = 200
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_DELIMITERS = [",", "\t", ";", "|"]
+CSV_BLOCK_BYTES = int(os.environ.get("CSV_BLOCK_MB", "4")) * 1024 * 1024
+# pandas' default NA tokens, so both engines agree on what is missing
+CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+_FULLWIDTH_QUOTES = "“”„‟＂「」『』"
+
+@dataclass
+class CsvDialect:
+    delimiter: str = ","
+    quoting: bool = True  # False: '"' is an ordinary character
+    newlines_in_values: bool = False  # a quoted field spans lines
+    header: Tuple[str, ...] = ()
+    fullwidth_quotes: bool = False  # seen in the sample; always read as literal text
+
+def sniff_csv_dialect(sample: str, complete: bool = True) -> CsvDialect:
+    """Dialect of a CSV/TSV sample. complete=False means the sample was cut off, so its last line is ignored."""
+    lines = sample.lstrip("\ufeff").splitlines()
+    if not complete and len(lines) > 1:
+        lines = lines[:-1]
+    lines = [ln for ln in lines if ln.strip()][:CSV_SNIFF_LINES]
+    if not lines:
+        return CsvDialect()
+
+    def parse(delimiter: str, quoting: bool) -> List[List[str]]:
+        try:
+            return list(csv.reader(lines, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL if quoting else csv.QUOTE_NONE))
+        except csv.Error:
+            return []
+
+    def score(rows: List[List[str]]) -> Tuple[float, int]:
+        # (share of rows as wide as the header, header width); a single column scores nothing
+        if not rows or len(rows[0]) < 2:
+            return (0.0, 1)
+        width = len(rows[0])
+        return (sum(len(r) == width for r in rows) / len(rows), width)
+
+    delimiter = max(CSV_DELIMITERS, key=lambda d: score(parse(d, True)))
+    if score(parse(delimiter, True))[1] < 2:
+        delimiter = ","
+    rows = parse(delimiter, True)
+    quoting = True
+    if '"' in sample:
+        # a quoted run followed by more text in the same field: the quotes are part of the value
+        d = re.escape(delimiter)
+        literal = re.search(rf'(?:^|{d})"[^"\r\n]*"[^{d}"\r\n]', "\n".join(lines), re.M) is not None
+        plain = parse(delimiter, False)
+        if literal and score(plain) >= score(rows):
+            quoting, rows = False, plain
+    return CsvDialect(
+        delimiter=delimiter,
+        quoting=quoting,
+        newlines_in_values=quoting and 0 < len(rows) < len(lines),
+        header=tuple(rows[0]) if rows else (),
+        fullwidth_quotes=any(q in sample for q in _FULLWIDTH_QUOTES),
+    )
+
+def _arrow_csv_options(dialect: CsvDialect) -> Dict[str, Any]:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    return {
+        "read_options": pacsv.ReadOptions(use_threads=True, block_size=CSV_BLOCK_BYTES),
+        "parse_options": pacsv.ParseOptions(
+            delimiter=dialect.delimiter,
+            quote_char='"' if dialect.quoting else False,
+            newlines_in_values=dialect.newlines_in_values,
+        ),
+        "convert_options": pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in dialect.header},
+            strings_can_be_null=True,
+            null_values=CSV_NULL_VALUES,
+        ),
+    }
+
+def _pandas_csv_kwargs(dialect: CsvDialect) -> Dict[str, Any]:
+    return {"sep": dialect.delimiter, "quoting": csv.QUOTE_MINIMAL if dialect.quoting else csv.QUOTE_NONE, "dtype": str}
+
+def read_csv_bytes(data: bytes, dialect: CsvDialect) -> pd.DataFrame:
+    """Whole CSV/TSV in one go, every column as text. pyarrow first; pandas if it is missing or rejects the file."""
+    try:
+        import pyarrow.csv as pacsv
+
+        return pacsv.read_csv(io.BytesIO(data), **_arrow_csv_options(dialect)).to_pandas()
+    except Exception:
+        pass  # ragged rows, invalid UTF-8, no pyarrow: pandas is more forgiving
+    return pd.read_csv(io.BytesIO(data), encoding="utf-8-sig", encoding_errors="ignore", **_pandas_csv_kwargs(dialect))
+
+def iter_arrow_csv_chunks(fileobj, dialect: CsvDialect, chunk_rows: int):
+    """Stream a binary CSV file object through pyarrow's reader, re-batched into frames of about chunk_rows."""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    reader = pacsv.open_csv(fileobj, **_arrow_csv_options(dialect))
+    batches, n = [], 0
+    for batch in reader:
+        batches.append(batch)
+        n += batch.num_rows
+        if n >= chunk_rows:
+            yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+            batches, n = [], 0
+    if batches:
+        yield pa.Table.from_batches(batches, schema=reader.schema).to_pandas()
+
 def parse_dataset_text_to_df(raw: str) -> pd.DataFrame:
     raw = (raw or "").strip()
     if not raw:
@@ -878,23 +3837,227 @@ def parse_dataset_text_to_df(raw: str) -> pd.DataFrame:
         except Exception:
             pass
 
-    # CSV / TSV fallback
-    # detect delimiter
-    delimiter = ","
-    if "\t" in raw and raw.count("\t") > raw.count(","):
-        delimiter = "\t"
+    # CSV / TSV: dialect from the head of the text, then one multithreaded parse
+    dialect = sniff_csv_dialect(raw[:CSV_SNIFF_BYTES], complete=len(raw) <= CSV_SNIFF_BYTES)
     try:
-        return pd.read_csv(io.StringIO(raw), delimiter=delimiter)
+        return read_csv_bytes(raw.encode("utf-8"), dialect)
     except Exception:
-        # last resort: try pandas default
+        # last resort: one row per line
+        return pd.DataFrame({"raw": raw.splitlines()})
+
+# Streaming ingest for uploads: the file is never decoded into one str; chunks are standardized
+# as they are read and only the standardized frames are kept.
+DIST_INGEST_CHUNK_ROWS = int(os.environ.get("DIST_INGEST_CHUNK_ROWS", "200000"))
+DIST_INGEST_SAMPLE_BYTES = CSV_SNIFF_BYTES
+_JSON_ENVELOPE_RE = re.compile(r'^\s*\{\s*"(data|records|items|rows)"\s*:\s*\[')
+
+class ArrowIngestFailed(Exception):
+    """pyarrow gave up on a CSV upload after chunks were already yielded; restart with arrow=False."""
+
+def iter_upload_chunks(fileobj, name: str, chunk_rows: int = DIST_INGEST_CHUNK_ROWS, arrow: bool = True):
+    """
+    Yield raw DataFrame chunks from an uploaded CSV/TSV/JSON/NDJSON file object (binary, seekable).
+    CSV/TSV are read with the dialect sniffed from the first DIST_INGEST_SAMPLE_BYTES (see
+    sniff_csv_dialect) and every column as text, so a chunk boundary never changes a value's type. JSON arrays and
+    {"data"/"records"/"items"/"rows": [...]} envelopes stream through ijson when it is installed.
+    CSV goes through pyarrow unless arrow=False. If pyarrow fails before the first chunk, pandas reads
+    the file instead; after that, ArrowIngestFailed is raised, since pandas cannot resume at the same row.
+    """
+    head_bytes = fileobj.read(DIST_INGEST_SAMPLE_BYTES)
+    sample = head_bytes.decode("utf-8", errors="ignore").lstrip("\ufeff")
+    fileobj.seek(0)
+    head = sample.lstrip()
+    if not head:
+        return
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", errors="ignore", newline="")
+    try:
+        if head[0] in "{[" or name.lower().endswith(".json"):
+            # A compact one-line document ({"data": [...]} or a dict of lists) is also a valid first
+            # NDJSON line, so envelopes are recognized before a parsed first line counts as NDJSON.
+            envelope = _JSON_ENVELOPE_RE.match(head)
+            ndjson = False
+            if head[0] == "{" and envelope is None:
+                try:
+                    first = json.loads(head.split("\n", 1)[0].strip())
+                    ndjson = isinstance(first, dict) and not (first and all(isinstance(v, list) for v in first.values()))
+                except Exception:
+                    ndjson = False
+            if ndjson:
+                batch: List[Dict[str, Any]] = []
+                for line in text:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    batch.append(json.loads(line))
+                    if len(batch) >= chunk_rows:
+                        yield pd.DataFrame(batch)
+                        batch = []
+                if batch:
+                    yield pd.DataFrame(batch)
+                return
+            prefix = "item" if head[0] == "[" else (f"{envelope.group(1)}.item" if envelope else None)
+            try:
+                import ijson  # type: ignore
+            except Exception:
+                ijson = None
+            if ijson is not None and prefix is not None:
+                batch = []
+                for rec in ijson.items(fileobj, prefix, use_float=True):
+                    batch.append(rec)
+                    if len(batch) >= chunk_rows:
+                        yield pd.DataFrame(batch)
+                        batch = []
+                if batch:
+                    yield pd.DataFrame(batch)
+                return
+            # No streaming parser available: load the document once, then hand it out in slices.
+            df = parse_dataset_text_to_df(text.read())
+            for i in range(0, len(df), chunk_rows):
+                yield df.iloc[i:i + chunk_rows]
+            return
+
+        dialect = sniff_csv_dialect(sample, complete=len(head_bytes) < DIST_INGEST_SAMPLE_BYTES)
+        if arrow:
+            yielded = False
+            try:
+                for chunk in iter_arrow_csv_chunks(fileobj, dialect, chunk_rows):
+                    yielded = True
+                    yield chunk
+                return
+            except Exception as e:
+                # no pyarrow, ragged rows or invalid UTF-8: pandas (lenient decoding) reads the file instead
+                if yielded:
+                    raise ArrowIngestFailed(str(e)) from e
+                fileobj.seek(0)
+        for chunk in pd.read_csv(text, chunksize=chunk_rows, **_pandas_csv_kwargs(dialect)):
+            yield chunk
+    finally:
+        text.detach()
+
+def _merge_date_stats(into: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    for k, v in (stats or {}).items():
+        if isinstance(v, bool):
+            into[k] = into.get(k, False) or v
+        elif isinstance(v, int):
+            into[k] = into.get(k, 0) + v
+        else:
+            into[k] = v
+    return into
+
+def ingest_distribution_upload(fileobj, name: str, chunk_rows: int = DIST_INGEST_CHUNK_ROWS, on_progress=None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Stream an upload into a standardized (frame, extras) pair. Each chunk goes through
+    standardize_distribution as soon as it is read, so working memory is one raw chunk plus the
+    standardized output. on_progress(fraction, rows) is called after every chunk. When pyarrow fails
+    part-way through a CSV, the partial parts are dropped and the file is read again with pandas.
+    """
+    total = getattr(fileobj, "size", None)
+    if not total:
+        fileobj.seek(0, io.SEEK_END)
+        total = fileobj.tell()
+        fileobj.seek(0)
+    for arrow in (True, False):
+        parts: List[Tuple[pd.DataFrame, pd.DataFrame]] = []
+        date_stats: Dict[str, Any] = {}
+        rows = 0
         try:
-            return pd.read_csv(io.StringIO(raw))
-        except Exception:
-            return pd.DataFrame({"raw": raw.splitlines()})
+            for raw in iter_upload_chunks(fileobj, name, chunk_rows, arrow=arrow):
+                part, extras = standardize_distribution(raw)
+                del raw
+                _merge_date_stats(date_stats, part.attrs.get("deliverdate_formats"))
+                parts.append((part, extras))
+                rows += len(part)
+                if on_progress is not None:
+                    on_progress(min(1.0, fileobj.tell() / total) if total else 1.0, rows)
+            break
+        except ArrowIngestFailed:
+            fileobj.seek(0)
+    df, extras = concat_standardized(parts)
+    df.attrs["deliverdate_formats"] = date_stats
+    return df, extras
+
+# Compact in-memory layout for the standardized frame: low-cardinality dimensions are dictionary-encoded
+# (pandas category, vocabulary kept sorted so groupby output order matches the plain-string layout),
+# Number is downcast to the smallest integer dtype, and unmapped source columns live in a sparse
+# long-format side table instead of a per-row dict column.
+DIST_CATEGORICAL_COLS = ["SupplierID", "CustomerID", "LicenseNo", "Category", "DeviceNAME", "Model"]
+DIST_STRING_COLS = ["SupplierID", "CustomerID", "LicenseNo", "Category", "UDID", "DeviceNAME", "LotNO", "SerNo", "Model"]
+DIST_EXTRAS_COLS = ["row", "field", "value"]
+
+def _clean_str_column(col: pd.Series, categorical: bool) -> pd.Series:
+    """
+    astype(str) -> "nan"/"None" to "" -> strip, applied once per distinct value instead of per row.
+    Returns a category Series (sorted vocabulary) or a plain object Series with the same values.
+    """
+    codes, uniques = pd.factorize(col, use_na_sentinel=True)
+    cleaned = pd.Index(uniques, dtype=object).astype(str)
+    cleaned = cleaned.where(~cleaned.isin(["nan", "None"]), "").str.strip()
+    cleaned = cleaned.to_numpy(dtype=object)
+    if (codes < 0).any():
+        # missing values become "": append a slot for them, which code -1 then indexes
+        cleaned = np.append(cleaned, "")
+    new_codes, vocab = pd.factorize(cleaned, sort=True)
+    codes = new_codes[codes]
+    if categorical:
+        out = pd.Categorical.from_codes(codes, categories=pd.Index(vocab, dtype=object))
+        return pd.Series(out, index=col.index, name=col.name)
+    return pd.Series(np.asarray(vocab, dtype=object)[codes], index=col.index, name=col.name)
+
+def _extras_side_table(extra: pd.DataFrame) -> pd.DataFrame:
+    """Long (row, field, value) table of the non-null cells of unmapped columns; row is the position in the standardized frame."""
+    parts = []
+    for c in extra.columns:
+        v = extra[c]
+        m = v.notna().to_numpy()
+        if m.any():
+            parts.append(pd.DataFrame({
+                "row": np.flatnonzero(m).astype(np.int32),
+                "field": str(c),
+                "value": v.to_numpy(dtype=object)[m],
+            }))
+    if not parts:
+        out = pd.DataFrame({"row": np.array([], dtype=np.int32), "field": pd.Series([], dtype=object), "value": pd.Series([], dtype=object)})
+    else:
+        out = pd.concat(parts, ignore_index=True)
+    out["field"] = out["field"].astype("category")
+    return out[DIST_EXTRAS_COLS]
 
-def standardize_distribution_df(df: pd.DataFrame) -> pd.DataFrame:
+def concat_standardized(parts: List[Tuple[pd.DataFrame, pd.DataFrame]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Concatenate standardized (frame, extras) pairs. Category columns are unioned into one shared sorted
+    vocabulary (a plain pd.concat would fall back to object when vocabularies differ) and extras row
+    positions are offset to the combined frame.
+    """
+    if not parts:
+        return pd.DataFrame(columns=STANDARD_COLS), _extras_side_table(pd.DataFrame())
+    if len(parts) == 1:
+        return parts[0]
+    frames = [f for f, _ in parts]
+    df = pd.concat([f.drop(columns=DIST_CATEGORICAL_COLS) for f in frames], ignore_index=True)
+    for col in DIST_CATEGORICAL_COLS:
+        df[col] = union_categoricals([f[col] for f in frames], sort_categories=True, ignore_order=True)
+    df = df[list(frames[0].columns)]
+    extras, offset = [], 0
+    for f, x in parts:
+        if len(x):
+            x = x.copy()
+            x["row"] = (x["row"].astype(np.int64) + offset).astype(np.int32)
+            extras.append(x)
+        offset += len(f)
+    if extras:
+        ex = pd.concat(extras, ignore_index=True)
+        ex["field"] = ex["field"].astype(str).astype("category")
+    else:
+        ex = _extras_side_table(pd.DataFrame())
+    return df, ex[DIST_EXTRAS_COLS]
+
+def standardize_distribution(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Map a raw frame onto STANDARD_COLS. Returns (standardized frame, extras side table); see
+    _extras_side_table for the side table layout.
+    """
     if df is None or df.empty:
-        return pd.DataFrame(columns=STANDARD_COLS)
+        return pd.DataFrame(columns=STANDARD_COLS), _extras_side_table(pd.DataFrame())
 
     # Rename columns via synonyms
     rename_map = {}
@@ -908,41 +4071,47 @@ def standardize_distribution_df(df: pd.DataFrame) -> pd.DataFrame:
                 if _normalize_col(target) == nc:
                     rename_map[c] = target
                     break
-    df2 = df.rename(columns=rename_map).copy()
+    df2 = df.rename(columns=rename_map)
 
     # Ensure all standard cols exist
     for col in STANDARD_COLS:
         if col not in df2.columns:
             df2[col] = None
 
-    # Keep only standard cols (drop extras but keep them in a "Extras" JSON column for traceability)
-    extras = [c for c in df2.columns if c not in STANDARD_COLS]
-    if extras:
-        df2["_extras"] = df2[extras].to_dict(orient="records")
-    else:
-        df2["_extras"] = [{} for _ in range(len(df2))]
-
-    df2 = df2[STANDARD_COLS + ["_extras"]].copy()
+    # Unmapped columns are kept for traceability in the extras side table (built after row filtering)
+    extras = df2[[c for c in df2.columns if c not in STANDARD_COLS]]
+    df2 = df2[STANDARD_COLS].copy()
 
     # Coerce types
-    df2["Deliverdate_dt"] = df2["Deliverdate"].apply(_coerce_deliverdate_to_datetime)
+    df2["Deliverdate_dt"], date_stats = parse_deliverdate_column(df2["Deliverdate"])
     # if Deliverdate missing but dt exists, fill string
     mask = df2["Deliverdate"].isna() & df2["Deliverdate_dt"].notna()
     df2.loc[mask, "Deliverdate"] = df2.loc[mask, "Deliverdate_dt"].dt.strftime("%Y%m%d")
 
-    # Number: numeric, default 1
+    # Number: numeric, default 1, smallest integer dtype that holds the values
     df2["Number"] = pd.to_numeric(df2["Number"], errors="coerce")
-    df2["Number"] = df2["Number"].fillna(1).astype(int)
+    df2["Number"] = pd.to_numeric(df2["Number"].fillna(1).astype(int), downcast="integer")
 
     # Standardize string columns
-    for col in ["SupplierID", "CustomerID", "LicenseNo", "Category", "UDID", "DeviceNAME", "LotNO", "SerNo", "Model"]:
-        df2[col] = df2[col].astype(str).replace({"nan": "", "None": ""}).str.strip()
+    for col in DIST_STRING_COLS:
+        df2[col] = _clean_str_column(df2[col], categorical=col in DIST_CATEGORICAL_COLS)
 
     # Drop rows that are completely empty across key dims (optional)
     key_cols = ["SupplierID", "CustomerID", "LicenseNo", "Category"]
-    df2 = df2[~(df2[key_cols].replace("", pd.NA).isna().all(axis=1))].reset_index(drop=True)
+    keep = ~np.logical_and.reduce([(df2[c] == "").to_numpy() for c in key_cols])
+    if not keep.all():
+        df2 = df2[keep].reset_index(drop=True)
+        extras = extras[keep]
+        for col in DIST_CATEGORICAL_COLS:
+            df2[col] = df2[col].cat.remove_unused_categories()
+    else:
+        df2.index = pd.RangeIndex(len(df2))
 
-    return df2
+    df2.attrs["deliverdate_formats"] = date_stats
+    return df2, _extras_side_table(extras.reset_index(drop=True))
+
+def standardize_distribution_df(df: pd.DataFrame) -> pd.DataFrame:
+    return standardize_distribution(df)[0]
 
 def df_preview_markdown(df: pd.DataFrame, n: int = 20) -> str:
     if df is None or df.empty:
@@ -954,7 +4123,7 @@ def build_filter_options(df: pd.DataFrame) -> Dict[str, List[str]]:
     def uniq(col):
         if col not in df.columns:
             return []
-        vals = sorted([v for v in df[col].dropna().astype(str).unique().tolist() if v.strip() != ""])
+        vals = sorted([v for v in pd.Series(df[col].dropna().unique()).astype(str).tolist() if v.strip() != ""])
         return vals[:2000]
     return {
         "SupplierID": uniq("SupplierID"),
@@ -963,6 +4132,37 @@ def build_filter_options(df: pd.DataFrame) -> Dict[str, List[str]]:
         "CustomerID": uniq("CustomerID"),
     }
 
+def distribution_filter_mask(
+    df: pd.DataFrame,
+    date_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]],
+    supplier_ids: List[str],
+    categories: List[str],
+    license_nos: List[str],
+    customer_ids: List[str],
+) -> Optional[np.ndarray]:
+    """Boolean row mask for the Distribution filters, or None when nothing is filtered."""
+    mask = None
+
+    def both(m):
+        nonlocal mask
+        m = np.asarray(m, dtype=bool)
+        mask = m if mask is None else (mask & m)
+
+    # Date filter (Deliverdate_dt), whole days: rows and day-level cube cells agree
+    if "Deliverdate_dt" in df.columns and date_range and df["Deliverdate_dt"].notna().any():
+        start, end = date_range
+        both((df["Deliverdate_dt"] >= start.normalize()) & (df["Deliverdate_dt"] < end.normalize() + pd.Timedelta(days=1)))
+
+    for col, selected in (
+        ("SupplierID", supplier_ids),
+        ("Category", categories),
+        ("LicenseNo", license_nos),
+        ("CustomerID", customer_ids),
+    ):
+        if selected:
+            both(df[col].isin(selected))
+    return mask
+
 def apply_filters(
     df: pd.DataFrame,
     date_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]],
@@ -971,169 +4171,680 @@ def apply_filters(
     license_nos: List[str],
     customer_ids: List[str],
 ) -> pd.DataFrame:
+    """Works on the raw standardized frame and on the aggregate cube alike (same column names)."""
     if df is None or df.empty:
         return df
+    mask = distribution_filter_mask(df, date_range, supplier_ids, categories, license_nos, customer_ids)
+    return df if mask is None else df[mask]
 
-    out = df.copy()
+def filtered_head(df: pd.DataFrame, mask: Optional[np.ndarray], n: int) -> pd.DataFrame:
+    """First n filtered rows without materializing the whole filtered frame."""
+    if mask is None:
+        return df.head(n)
+    return df.iloc[np.flatnonzero(mask)[:n]]
 
-    # Date filter (Deliverdate_dt)
-    if "Deliverdate_dt" in out.columns and out["Deliverdate_dt"].notna().any() and date_range:
-        start, end = date_range
-        out = out[(out["Deliverdate_dt"] >= start) & (out["Deliverdate_dt"] <= end)]
+class DistributionFilterIndex:
+    """
+    Filter index over one frame (raw rows or the cube), built once per dataset: row ids sorted by date
+    plus an inverted index (CSR postings: row ids grouped by category code) per filter column. A filter
+    is a few postings scatters into boolean bitmaps, their AND, and one take() at the end; count()
+    answers "how many records match" before any frame is built. Appended rows are indexed as a new
+    segment (extend), so the cost of an append scales with the new rows only.
+    """
 
-    def filter_in(col, selected):
-        nonlocal out
-        if selected:
-            out = out[out[col].isin(selected)]
+    FILTER_COLS = ["SupplierID", "Category", "LicenseNo", "CustomerID"]
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df.iloc[:0]
+        self.n = 0
+        self.weights = None
+        self.segments: List[Dict[str, Any]] = []
+        self.extend(df)
+
+    def extend(self, df: pd.DataFrame) -> None:
+        """Index rows self.n: of df, which must start with the rows already indexed."""
+        part = df.iloc[self.n:]
+        seg: Dict[str, Any] = {"offset": self.n, "postings": {}, "date_rows": None, "sorted_dates": None}
+        for col in self.FILTER_COLS:
+            if col not in part.columns:
+                continue
+            s = part[col]
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                codes, vocab = s.cat.codes.to_numpy(), s.cat.categories
+            else:
+                codes, vocab = pd.factorize(s.astype(str))
+            order = np.argsort(codes, kind="stable").astype(np.int64)
+            offsets = np.searchsorted(codes[order], np.arange(len(vocab) + 1))
+            seg["postings"][col] = ({str(v): i for i, v in enumerate(vocab)}, order, offsets)
+        if "Deliverdate_dt" in part.columns:
+            dates = part["Deliverdate_dt"].to_numpy(dtype="datetime64[ns]")
+            valid = np.flatnonzero(~np.isnat(dates))
+            if len(valid):
+                order = np.argsort(dates[valid], kind="stable")
+                seg["date_rows"] = valid[order]
+                seg["sorted_dates"] = dates[valid][order]
+        self.segments.append(seg)
+        self.df = df
+        self.n = len(df)
+        self.weights = df["records"].to_numpy() if "records" in df.columns else None
+
+    @property
+    def has_dates(self) -> bool:
+        return any(seg["date_rows"] is not None for seg in self.segments)
+
+    def _bitmap(self, rows: List[np.ndarray]) -> np.ndarray:
+        bits = np.zeros(self.n, dtype=bool)
+        for r in rows:
+            bits[r] = True
+        return bits
+
+    def value_mask(self, col: str, values: List[str]) -> np.ndarray:
+        values = [str(v) for v in values]
+        rows = []
+        for seg in self.segments:
+            if col not in seg["postings"]:
+                continue
+            lookup, order, offsets = seg["postings"][col]
+            for v in values:
+                c = lookup.get(v)
+                if c is not None and offsets[c + 1] > offsets[c]:
+                    rows.append(order[offsets[c]:offsets[c + 1]] + seg["offset"])
+        return self._bitmap(rows)
+
+    def date_mask(self, start: pd.Timestamp, end: pd.Timestamp) -> np.ndarray:
+        # whole days, same rule as distribution_filter_mask
+        lo_t = np.datetime64(start.normalize(), "ns")
+        hi_t = np.datetime64(end.normalize() + pd.Timedelta(days=1), "ns")
+        rows = []
+        for seg in self.segments:
+            if seg["date_rows"] is None:
+                continue
+            lo = np.searchsorted(seg["sorted_dates"], lo_t, side="left")
+            hi = np.searchsorted(seg["sorted_dates"], hi_t, side="left")
+            rows.append(seg["date_rows"][lo:hi] + seg["offset"])
+        return self._bitmap(rows)
+
+    def mask(
+        self,
+        date_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]],
+        supplier_ids: List[str],
+        categories: List[str],
+        license_nos: List[str],
+        customer_ids: List[str],
+    ) -> Optional[np.ndarray]:
+        """Same semantics as distribution_filter_mask; None when nothing is filtered."""
+        bitmaps = []
+        if date_range and self.has_dates:
+            bitmaps.append(self.date_mask(*date_range))
+        for col, selected in zip(self.FILTER_COLS, (supplier_ids, categories, license_nos, customer_ids)):
+            if selected and col in self.df.columns:
+                bitmaps.append(self.value_mask(col, selected))
+        if not bitmaps:
+            return None
+        out = bitmaps[0]
+        for b in bitmaps[1:]:
+            np.logical_and(out, b, out=out)
+        return out
+
+    def count(self, mask: Optional[np.ndarray]) -> int:
+        if mask is None:
+            return int(self.weights.sum()) if self.weights is not None else self.n
+        return int(self.weights[mask].sum()) if self.weights is not None else int(np.count_nonzero(mask))
+
+    def take(self, mask: Optional[np.ndarray]) -> pd.DataFrame:
+        return self.df if mask is None else self.df.take(np.flatnonzero(mask))
+
+# Aggregate cube: Number and row counts per (supplier, category, license, customer, day). Built once per
+# standardized dataset; filters slice it and every chart / stats pack rolls it up instead of rescanning rows.
+DIST_CUBE_DIMS = ["SupplierID", "Category", "LicenseNo", "CustomerID", "Deliverdate_dt"]
+
+def build_distribution_cube(df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or df.empty:
+        return pd.DataFrame(columns=DIST_CUBE_DIMS + ["Number", "records"])
+    keys = [df[c] for c in DIST_CUBE_DIMS[:-1]] + [df["Deliverdate_dt"].dt.floor("D")]
+    cube = (
+        df.groupby(keys, observed=True, dropna=False, sort=False)["Number"]
+        .agg(["sum", "size"])
+        .rename(columns={"sum": "Number", "size": "records"})
+        .reset_index()
+    )
+    cube["records"] = pd.to_numeric(cube["records"], downcast="integer")
+    cube.attrs["source_rows"] = int(len(df))
+    return cube
 
-    filter_in("SupplierID", supplier_ids)
-    filter_in("Category", categories)
-    filter_in("LicenseNo", license_nos)
-    filter_in("CustomerID", customer_ids)
+def frame_records(df: pd.DataFrame) -> int:
+    """Row count of the underlying data: sums the cube's records column, len() for raw rows."""
+    if df is None:
+        return 0
+    return int(df["records"].sum()) if "records" in df.columns else int(len(df))
+
+# Incremental append: delta files are standardized on their own, deduplicated against the existing rows
+# through a hash index on a configurable key, and folded into the frame, the cube and the filter indexes.
+DIST_DEDUP_KEY = ["SupplierID", "Deliverdate", "CustomerID", "UDID", "LotNO", "SerNo"]
+
+def distribution_row_hashes(df: pd.DataFrame, cols: List[str]) -> np.ndarray:
+    """64-bit hash per row over cols. Text columns hash by value (missing -> ""), so categorical and
+    plain string columns, and ints vs digit strings in Deliverdate, hash alike."""
+    parts = {}
+    for c in cols:
+        s = df[c]
+        if (
+            isinstance(s.dtype, pd.CategoricalDtype)
+            or pd.api.types.is_datetime64_any_dtype(s.dtype)
+            or pd.api.types.infer_dtype(s, skipna=False) == "string"
+        ):
+            parts[c] = s
+        else:
+            parts[c] = s.astype(object).where(s.notna(), "").astype(str)
+    return pd.util.hash_pandas_object(pd.DataFrame(parts, index=df.index), index=False, categorize=False).to_numpy()
+
+class RowHashIndex:
+    """
+    uint64 hashes with the row position of each, kept as a few sorted runs (log-structured): add() sorts
+    only the new hashes into a run and merges runs of similar size, so an append costs O(delta log delta)
+    amortized instead of copying the whole history. lookup() is one binary search per run.
+    """
+
+    def __init__(self, hashes: Optional[np.ndarray] = None, positions: Optional[np.ndarray] = None):
+        self.runs: List[Tuple[np.ndarray, np.ndarray]] = []
+        if hashes is not None and len(hashes):
+            self.add(hashes, np.arange(len(hashes)) if positions is None else positions)
+
+    def __len__(self) -> int:
+        return sum(len(h) for h, _ in self.runs)
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """Position for each hash, -1 when absent."""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        out = np.full(len(hashes), -1, dtype=np.int64)
+        for h, p in self.runs:
+            i = np.minimum(np.searchsorted(h, hashes), len(h) - 1)
+            hit = h[i] == hashes
+            out[hit] = p[i[hit]]
+        return out
 
+    def add(self, hashes: np.ndarray, positions: np.ndarray) -> None:
+        if not len(hashes):
+            return
+        h, p = np.asarray(hashes, dtype=np.uint64), np.asarray(positions, dtype=np.int64)
+        order = np.argsort(h, kind="stable")
+        h, p = h[order], p[order]
+        # merge while the previous run is no more than twice as large: run sizes stay geometric
+        while self.runs and len(self.runs[-1][0]) <= 2 * len(h):
+            rh, rp = self.runs.pop()
+            h, p = np.concatenate([rh, h]), np.concatenate([rp, p])
+            order = np.argsort(h, kind="stable")
+            h, p = h[order], p[order]
+        self.runs.append((h, p))
+
+def _extend_categories(a: pd.Series, b: pd.Series) -> pd.CategoricalDtype:
+    """a's vocabulary with b's unseen values appended, so a's codes stay valid."""
+    new = b.cat.categories.difference(a.cat.categories, sort=True)
+    return pd.CategoricalDtype(a.cat.categories.append(new)) if len(new) else a.dtype
+
+def _append_frames(base: pd.DataFrame, extra: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Column-wise base + extra; category columns get the extended base vocabulary (base codes unchanged)."""
+    a_types, b_types = {}, {}
+    for c in columns:
+        a, b = base[c], extra[c]
+        if isinstance(a.dtype, pd.CategoricalDtype) and isinstance(b.dtype, pd.CategoricalDtype):
+            dtype = _extend_categories(a, b)
+            if dtype != a.dtype:
+                a_types[c] = dtype
+            b_types[c] = dtype
+    a = base[columns].astype(a_types) if a_types else base[columns]
+    return pd.concat([a, extra[columns].astype(b_types)], ignore_index=True)
+
+def append_distribution(
+    base: pd.DataFrame,
+    base_extras: Optional[pd.DataFrame],
+    delta: pd.DataFrame,
+    delta_extras: Optional[pd.DataFrame],
+    dedup: RowHashIndex,
+    key_cols: List[str],
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, int]:
+    """
+    Append standardized delta rows to base. Rows whose key hash is already in dedup (or repeats within
+    the delta) are dropped; dedup is updated in place. Returns (frame, extras, appended rows, duplicates).
+    """
+    h = distribution_row_hashes(delta, key_cols)
+    keep = np.zeros(len(delta), dtype=bool)
+    keep[np.unique(h, return_index=True)[1]] = True
+    keep &= dedup.lookup(h) < 0
+    kept = delta[keep].reset_index(drop=True)
+    dupes = int(len(delta) - len(kept))
+
+    df = _append_frames(base, kept, list(base.columns))
+    df.attrs["deliverdate_formats"] = _merge_date_stats(
+        dict(base.attrs.get("deliverdate_formats") or {}), delta.attrs.get("deliverdate_formats")
+    )
+    dedup.add(h[keep], np.arange(len(base), len(base) + len(kept)))
+
+    if base_extras is None:
+        base_extras = _extras_side_table(pd.DataFrame())
+    extras = base_extras
+    if delta_extras is not None and len(delta_extras):
+        new_pos = np.cumsum(keep) - 1
+        x = delta_extras[keep[delta_extras["row"].to_numpy()]].copy()
+        x["row"] = (new_pos[x["row"].to_numpy()] + len(base)).astype(np.int32)
+        if len(x):
+            extras = pd.concat([base_extras.astype({"field": str}), x.astype({"field": str})], ignore_index=True)
+            extras["field"] = extras["field"].astype("category")
+    return df, extras[DIST_EXTRAS_COLS], kept, dupes
+
+def _add_at_positions(frame: pd.DataFrame, col: str, pos: np.ndarray, inc: np.ndarray) -> None:
+    """frame[col][pos] += inc in place (pos unique); the column is widened to int64 only when a sum overflows it."""
+    j = frame.columns.get_loc(col)
+    values = frame[col].to_numpy()
+    new = values[pos].astype(np.int64) + inc
+    if len(new) and values.dtype != np.int64 and new.max() > np.iinfo(values.dtype).max:
+        frame[col] = frame[col].astype(np.int64)
+    frame.iloc[pos, j] = new.astype(frame[col].dtype, copy=False)
+
+def update_distribution_cube(
+    cube: pd.DataFrame,
+    cells: Optional[RowHashIndex],
+    delta_rows: pd.DataFrame,
+) -> Tuple[pd.DataFrame, RowHashIndex, int, int]:
+    """
+    Fold new raw rows into the cube: cells that already exist get their Number / records bumped in place
+    (only those positions are written), new cells are appended at the end (so filter index positions stay
+    valid). cells maps cube-cell hashes to positions and is built from the cube on first use. The cube is
+    updated in place and a new frame object is returned, so identity-keyed memos see the change.
+    Returns (cube, cells, updated, added).
+    """
+    if cells is None:
+        cells = RowHashIndex(distribution_row_hashes(cube, DIST_CUBE_DIMS))
+    dc = build_distribution_cube(delta_rows)
+    if dc.empty:
+        return cube, cells, 0, 0
+    h = distribution_row_hashes(dc, DIST_CUBE_DIMS)
+    pos = cells.lookup(h)
+    hit = pos >= 0
+    if hit.any():
+        # dc has one row per cell, so the hit positions are unique
+        _add_at_positions(cube, "Number", pos[hit], dc["Number"].to_numpy(dtype=np.int64)[hit])
+        _add_at_positions(cube, "records", pos[hit], dc["records"].to_numpy(dtype=np.int64)[hit])
+    fresh = dc[~hit].reset_index(drop=True)
+    if len(fresh):
+        out = _append_frames(cube, fresh, DIST_CUBE_DIMS + ["Number", "records"])
+        out["records"] = pd.to_numeric(out["records"], downcast="integer")
+    else:
+        out = cube.copy(deep=False)
+    out.attrs["source_rows"] = int(cube.attrs.get("source_rows", 0)) + int(len(delta_rows))
+    cells.add(h[~hit], np.arange(len(cube), len(cube) + len(fresh)))
+    return out, cells, int(hit.sum()), int(len(fresh))
+
+# Network pruning is hierarchical and flow-preserving: suppliers are ranked by volume, and every later
+# level keeps the top-K children of each drawn parent (the previous level's Other bucket included), by
+# the flow along that edge. Everything not drawn at a level is folded into one Other node, so each hop's
+# edges still sum to the full Number total. The node budget is shared across levels (unused share rolls
+# down). All of it runs on label codes over the aggregate rows; no row-level subset is built.
+DIST_GRAPH_LEVELS = [
+    ("SupplierID", "Supplier", "#00F5D4", 22),
+    ("Category", "Category", "#FEE440", 18),
+    ("LicenseNo", "License", "#A78BFA", 16),
+    ("CustomerID", "Customer", "#FF5D8F", 16),
+]
+DIST_GRAPH_TOP_PER_PARENT = int(os.environ.get("DIST_GRAPH_TOP_PER_PARENT", "8"))
+DIST_GRAPH_NODE_BUDGET = int(os.environ.get("DIST_GRAPH_NODE_BUDGET", "240"))
+DIST_GRAPH_OTHER = "__other__"  # node id suffix of a level's Other bucket
+DIST_GRAPH_OTHER_COLOR = "#8D99AE"
+DIST_GRAPH_LEVEL_GAP = 220  # layout: px between level rows
+DIST_GRAPH_NODE_GAP = 120  # layout: px between nodes in a row
+DIST_GRAPH_MEMO_ENTRIES = int(os.environ.get("DIST_GRAPH_MEMO_ENTRIES", "32"))
+DIST_SANKEY_MAX_PATHS = int(os.environ.get("DIST_SANKEY_MAX_PATHS", "300"))
+
+def _label_codes(col: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """(codes, labels) with codes in groupby order (category order, sorted otherwise); missing -> -1."""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy(dtype=np.int64), col.cat.categories.to_numpy(dtype=object)
+    codes, labels = pd.factorize(col, sort=True)
+    return codes.astype(np.int64, copy=False), np.asarray(labels, dtype=object)
+
+def _code_sums(codes: np.ndarray, weights: np.ndarray, n: int) -> np.ndarray:
+    ok = codes >= 0
+    sums = np.bincount(codes[ok], weights=weights[ok], minlength=n)
+    return np.rint(sums).astype(np.int64) if np.issubdtype(weights.dtype, np.integer) else sums
+
+def _pair_sums(keys: np.ndarray, weights: np.ndarray, space: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct keys in [0, space) and their weight sums; dense bincount when the key space is small enough."""
+    if space <= max(4 * len(keys), 1 << 22):
+        present = np.flatnonzero(np.bincount(keys, minlength=space))
+        return present, _code_sums(keys, weights, space)[present]
+    uniq, inv = np.unique(keys, return_inverse=True)
+    return uniq, _code_sums(inv, weights, len(uniq))
+
+def prune_network_levels(
+    df: pd.DataFrame,
+    top_per_parent: int = DIST_GRAPH_TOP_PER_PARENT,
+    node_budget: int = DIST_GRAPH_NODE_BUDGET,
+) -> List[Dict[str, Any]]:
+    """
+    One entry per DIST_GRAPH_LEVELS level: labels, kept (label codes drawn, largest volume first),
+    mapped (per row: position in kept, or len(kept) for Other) and others (distinct labels in Other).
+    """
+    weights = df["Number"].to_numpy()
+    remaining = max(int(node_budget), len(DIST_GRAPH_LEVELS))
+    out: List[Dict[str, Any]] = []
+    parent = None
+    for i, (col, _, _, _) in enumerate(DIST_GRAPH_LEVELS):
+        codes, labels = _label_codes(df[col])
+        n = len(labels)
+        volume = _code_sums(codes, weights, n)
+        seen = np.bincount(codes[codes >= 0], minlength=n) > 0
+        drawable = seen & np.fromiter((str(v).strip() != "" for v in labels), dtype=bool, count=n)
+        if parent is None:
+            candidates = np.flatnonzero(drawable)
+        else:
+            # flow per (drawn parent, child); top-K children of each parent by that flow
+            child = np.where(codes >= 0, codes, n)
+            uniq, flow = _pair_sums(parent * (n + 1) + child, weights, (int(parent.max()) + 1) * (n + 1))
+            p, c = uniq // (n + 1), uniq % (n + 1)
+            ok = c < n
+            ok[ok] = drawable[c[ok]]
+            p, c, flow = p[ok], c[ok], flow[ok]
+            order = np.lexsort((-flow, p))
+            p, c = p[order], c[order]
+            starts = np.flatnonzero(np.r_[True, p[1:] != p[:-1]])
+            rank = np.arange(len(p)) - np.repeat(starts, np.diff(np.r_[starts, len(p)]))
+            candidates = np.unique(c[rank < max(1, int(top_per_parent))])
+        alloc = remaining // (len(DIST_GRAPH_LEVELS) - i)
+        kept = candidates[np.argsort(-volume[candidates], kind="stable")][:alloc]
+        remaining -= len(kept)
+        position = np.full(n + 1, len(kept), dtype=np.int64)  # last slot: code -1
+        position[kept] = np.arange(len(kept))
+        mapped = position[codes]
+        out.append({"labels": labels, "kept": kept, "mapped": mapped, "others": int(seen.sum()) - len(kept)})
+        parent = mapped
     return out
 
-def build_network_graph(df: pd.DataFrame, max_nodes_per_level: int = 60) -> Tuple[List[Node], List[Edge]]:
+def build_network_model(
+    df: pd.DataFrame,
+    top_per_parent: int = DIST_GRAPH_TOP_PER_PARENT,
+    node_budget: int = DIST_GRAPH_NODE_BUDGET,
+) -> Dict[str, Any]:
+    """
+    supplier -> category -> license -> customer, pruned by prune_network_levels (Other nodes keep the
+    totals), as plain arrays: per node id/label/title/level/color/size and a layered layout (x, y);
+    per edge src/dst (node positions) and value. network_elements turns it into agraph objects.
+    """
+    weights = df["Number"].to_numpy()
+    levels = prune_network_levels(df, top_per_parent, node_budget)
+    ids: List[str] = []
+    labels: List[str] = []
+    titles: List[str] = []
+    level_of: List[int] = []
+    offsets = []
+    for li, ((_, prefix, _, _), lv) in enumerate(zip(DIST_GRAPH_LEVELS, levels)):
+        offsets.append(len(ids))
+        lab, kept = lv["labels"], lv["kept"]
+        ids.extend(f"{prefix}:{lab[c]}" for c in kept)
+        labels.extend(str(lab[c]) for c in kept)
+        titles.extend(f"{prefix} = {lab[c]}" for c in kept)
+        other_units = int(weights[lv["mapped"] == len(kept)].sum())
+        ids.append(f"{prefix}:{DIST_GRAPH_OTHER}")
+        labels.append(f"Other ({lv['others']:,})")
+        titles.append(f"{lv['others']:,} {prefix} value(s) not drawn · {other_units:,} units")
+        level_of.extend([li] * (len(kept) + 1))
+    level_of = np.asarray(level_of)
+
+    # Aggregated edges between adjacent levels over all rows (pruned labels count towards Other)
+    src, dst, val = [], [], []
+    for li, (upper, lower) in enumerate(zip(levels, levels[1:])):
+        nb = len(lower["kept"]) + 1
+        uniq, sums = _pair_sums(upper["mapped"] * nb + lower["mapped"], weights, (len(upper["kept"]) + 1) * nb)
+        src.append(offsets[li] + uniq // nb)
+        dst.append(offsets[li + 1] + uniq % nb)
+        val.append(sums)
+    src, dst, val = np.concatenate(src), np.concatenate(dst), np.concatenate(val).astype(float)
+
+    # A node is drawn when it carries flow (an Other slot with nothing in it is not)
+    present = np.zeros(len(ids), dtype=bool)
+    present[src] = True
+    present[dst] = True
+
+    # Layered layout: one row per level; suppliers by volume, every lower node at the flow-weighted
+    # mean x of its parents (barycenter ordering keeps crossings down), Other at the end of its row
+    x = np.zeros(len(ids))
+    for li in range(len(DIST_GRAPH_LEVELS)):
+        members = np.flatnonzero((level_of == li) & present)
+        if li == 0 or not len(members):
+            order = members
+        else:
+            into = np.isin(dst, members)
+            w_sum = np.bincount(dst[into], weights=val[into], minlength=len(ids))
+            wx_sum = np.bincount(dst[into], weights=val[into] * x[src[into]], minlength=len(ids))
+            bary = np.divide(wx_sum, w_sum, out=np.zeros(len(ids)), where=w_sum > 0)[members]
+            is_other = np.asarray([ids[m].endswith(":" + DIST_GRAPH_OTHER) for m in members])
+            order = members[np.lexsort((members, bary, is_other))]
+        x[order] = (np.arange(len(order)) - (len(order) - 1) / 2) * DIST_GRAPH_NODE_GAP
+    y = level_of * DIST_GRAPH_LEVEL_GAP
+
+    colors = [DIST_GRAPH_LEVELS[l][2] for l in level_of]
+    for i, nid in enumerate(ids):
+        if nid.endswith(":" + DIST_GRAPH_OTHER):
+            colors[i] = DIST_GRAPH_OTHER_COLOR
+    return {
+        "ids": ids,
+        "index": {nid: i for i, nid in enumerate(ids)},
+        "labels": labels,
+        "titles": titles,
+        "level": level_of,
+        "colors": colors,
+        "sizes": [DIST_GRAPH_LEVELS[l][3] for l in level_of],
+        "present": present,
+        "x": x,
+        "y": y,
+        "src": src,
+        "dst": dst,
+        "value": val,
+    }
+
+def network_visible(model: Dict[str, Any], expanded: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
     """
-    supplier -> category -> license -> customer
-    Build a hierarchical directed graph. Uses aggregation to limit node explosion.
+    (node mask, edge mask) to draw. expanded=None: the whole network. Otherwise level of detail:
+    suppliers, plus the children of every expanded node that is itself visible.
     """
+    present, src, dst = model["present"], model["src"], model["dst"]
+    if expanded is None:
+        return present.copy(), np.ones(len(src), dtype=bool)
+    is_open = np.zeros(len(present), dtype=bool)
+    is_open[[model["index"][nid] for nid in expanded if nid in model["index"]]] = True
+    visible = present & (model["level"] == 0)
+    for _ in range(len(DIST_GRAPH_LEVELS) - 1):
+        visible[dst[visible[src] & is_open[src]]] = True
+    return visible, visible[src] & is_open[src]
+
+def network_elements(model: Dict[str, Any], expanded: Optional[List[str]] = None) -> Tuple[List[Node], List[Edge]]:
+    """agraph Node/Edge objects for what network_visible draws, placed at the precomputed layout."""
+    node_mask, edge_mask = network_visible(model, expanded)
+    ids, x, y = model["ids"], model["x"], model["y"]
+    nodes = [
+        Node(
+            id=ids[i], label=model["labels"][i], size=model["sizes"][i], color=model["colors"][i],
+            title=model["titles"][i], x=float(x[i]), y=float(y[i]),
+        )
+        for i in np.flatnonzero(node_mask)
+    ]
+    edges = [
+        Edge(source=ids[s], target=ids[d], value=float(v), label=str(int(v)))
+        for s, d, v in zip(model["src"][edge_mask], model["dst"][edge_mask], model["value"][edge_mask])
+    ]
+    return nodes, edges
+
+def build_network_graph(
+    df: pd.DataFrame,
+    top_per_parent: int = DIST_GRAPH_TOP_PER_PARENT,
+    node_budget: int = DIST_GRAPH_NODE_BUDGET,
+) -> Tuple[List[Node], List[Edge]]:
+    """The whole pruned network as agraph objects (see build_network_model)."""
     if df is None or df.empty:
         return [], []
+    return network_elements(build_network_model(df, top_per_parent, node_budget))
 
-    # Top nodes per level by volume
-    def top_vals(col):
-        g = df.groupby(col)["Number"].sum().sort_values(ascending=False)
-        vals = [v for v in g.index.tolist() if str(v).strip() != ""]
-        return vals[:max_nodes_per_level]
-
-    top_sup = top_vals("SupplierID")
-    top_cat = top_vals("Category")
-    top_lic = top_vals("LicenseNo")
-    top_cus = top_vals("CustomerID")
-
-    d = df.copy()
-    d = d[d["SupplierID"].isin(top_sup)]
-    d = d[d["Category"].isin(top_cat)]
-    d = d[d["LicenseNo"].isin(top_lic)]
-    d = d[d["CustomerID"].isin(top_cus)]
-
-    # Build aggregated edges with weights
-    e1 = d.groupby(["SupplierID", "Category"])["Number"].sum().reset_index()
-    e2 = d.groupby(["Category", "LicenseNo"])["Number"].sum().reset_index()
-    e3 = d.groupby(["LicenseNo", "CustomerID"])["Number"].sum().reset_index()
-
-    # Nodes
-    nodes = []
-    node_ids = set()
-
-    def add_node(prefix, value, color, size):
-        nid = f"{prefix}:{value}"
-        if nid in node_ids:
-            return
-        node_ids.add(nid)
-        nodes.append(Node(
-            id=nid,
-            label=str(value),
-            size=size,
-            color=color,
-            title=f"{prefix} = {value}"
-        ))
-
-    for v in top_sup:
-        add_node("Supplier", v, "#00F5D4", 22)
-    for v in top_cat:
-        add_node("Category", v, "#FEE440", 18)
-    for v in top_lic:
-        add_node("License", v, "#A78BFA", 16)
-    for v in top_cus:
-        add_node("Customer", v, "#FF5D8F", 16)
-
-    edges = []
-    def add_edge(src_prefix, src, dst_prefix, dst, w):
-        s = f"{src_prefix}:{src}"
-        t_ = f"{dst_prefix}:{dst}"
-        if s in node_ids and t_ in node_ids:
-            edges.append(Edge(source=s, target=t_, value=float(w), label=str(int(w))))
-
-    for _, r in e1.iterrows():
-        add_edge("Supplier", r["SupplierID"], "Category", r["Category"], r["Number"])
-    for _, r in e2.iterrows():
-        add_edge("Category", r["Category"], "License", r["LicenseNo"], r["Number"])
-    for _, r in e3.iterrows():
-        add_edge("License", r["LicenseNo"], "Customer", r["CustomerID"], r["Number"])
+# Node info drill-down: per node value its records, units and top counterparts in every other dimension,
+# precomputed over the cube cells so a click is a lookup. Row ids of a node are the cube filter index's
+# postings; the drill index only keeps per-cell label codes and the per-value summaries.
+DIST_NODE_INFO_TOP = 5
 
-    return nodes, edges
+class NodeDrillIndex:
+    """
+    Drill-down index over one cube frame: label codes per dimension plus, per node value, records,
+    units and the top DIST_NODE_INFO_TOP counterparts (by units) in each other dimension, all from
+    bincounts over codes. summary() is a dict lookup and a few array reads. narrow(mask) builds the
+    index of a filtered slice from the parent's codes (labels are shared, nothing is re-encoded), so a
+    filter change costs one pass over the surviving cells and clicks stay independent of data size.
+    """
 
-def node_info(df: pd.DataFrame, node_id: str) -> str:
-    if not node_id or ":" not in node_id or df is None or df.empty:
+    COLS = [col for col, _, _, _ in DIST_GRAPH_LEVELS]
+
+    def __init__(
+        self,
+        codes: Dict[str, np.ndarray],
+        labels: Dict[str, np.ndarray],
+        lookup: Dict[str, Dict[str, int]],
+        units: np.ndarray,
+        records: np.ndarray,
+    ):
+        self.codes, self.labels, self.lookup = codes, labels, lookup
+        self.units, self.records = units, records
+        self.n = len(units)
+        self.value_records = {c: _code_sums(codes[c], records, len(labels[c])) for c in self.COLS}
+        self.value_units = {c: _code_sums(codes[c], units, len(labels[c])) for c in self.COLS}
+        # (col, other) -> (codes, units) arrays of shape (values of col, top); code -1 pads short lists
+        self.top: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]] = {}
+        for i, a in enumerate(self.COLS):
+            for b in self.COLS[i + 1:]:
+                na, nb = len(labels[a]), len(labels[b])
+                ok = (codes[a] >= 0) & (codes[b] >= 0)
+                keys, sums = _pair_sums(codes[a][ok] * nb + codes[b][ok], units[ok], na * nb)
+                ca, cb = keys // nb, keys % nb
+                self.top[(a, b)] = self._top_children(ca, cb, sums, na, nb)
+                self.top[(b, a)] = self._top_children(cb, ca, sums, nb, na)
+
+    @staticmethod
+    def _top_children(
+        parent: np.ndarray, child: np.ndarray, sums: np.ndarray, n_parent: int, n_child: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Per parent code, its top children by units (ties in label order)."""
+        k = DIST_NODE_INFO_TOP
+        top = int(sums.max()) if len(sums) else 0
+        span = top - int(sums.min()) + 1 if len(sums) else 1
+        if np.issubdtype(sums.dtype, np.integer) and n_parent * span * n_child < 2 ** 62:
+            # one sort on a unique composite key: parent, units desc, child
+            order = np.argsort((parent * span + (top - sums)) * n_child + child)
+        else:
+            order = np.lexsort((child, -sums, parent))
+        parent, child, sums = parent[order], child[order], sums[order]
+        rank = np.arange(len(parent)) - np.searchsorted(parent, parent)
+        keep = rank < k
+        top_codes = np.full((n_parent, k), -1, dtype=np.int64)
+        top_sums = np.zeros((n_parent, k), dtype=sums.dtype)
+        top_codes[parent[keep], rank[keep]] = child[keep]
+        top_sums[parent[keep], rank[keep]] = sums[keep]
+        return top_codes, top_sums
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "NodeDrillIndex":
+        codes, labels, lookup = {}, {}, {}
+        for c in cls.COLS:
+            codes[c], labels[c] = _label_codes(df[c])
+            lookup[c] = {str(v): i for i, v in enumerate(labels[c])}
+        units = df["Number"].to_numpy()
+        records = df["records"].to_numpy(dtype=np.int64) if "records" in df.columns else np.ones(len(df), dtype=np.int64)
+        return cls(codes, labels, lookup, units, records)
+
+    def narrow(self, mask: Optional[np.ndarray]) -> "NodeDrillIndex":
+        """Index of the cells selected by a filter mask (DistributionFilterIndex.mask); None keeps all."""
+        if mask is None:
+            return self
+        return NodeDrillIndex(
+            {c: v[mask] for c, v in self.codes.items()}, self.labels, self.lookup, self.units[mask], self.records[mask]
+        )
+
+    def _table(self, col: str, codes: np.ndarray, sums: np.ndarray) -> str:
+        ok = codes >= 0
+        idx = pd.Index(self.labels[col][codes[ok]], name=col)
+        return pd.DataFrame({"units": sums[ok]}, index=idx).to_markdown()
+
+    def summary(self, col: str, value: str) -> Tuple[int, int, Dict[str, str]]:
+        """(records, units, other column -> top counterparts markdown) for one node value."""
+        code = self.lookup[col].get(value)
+        tops = {}
+        for b in self.COLS:
+            if b == col:
+                continue
+            top_codes, top_sums = self.top[(col, b)]
+            if code is None:
+                tops[b] = self._table(b, top_codes[:0, 0], top_sums[:0, 0])
+            else:
+                tops[b] = self._table(b, top_codes[code], top_sums[code])
+        if code is None:
+            return 0, 0, tops
+        return int(self.value_records[col][code]), int(self.value_units[col][code]), tops
+
+    def other_summary(self, col: str, drawn: List[str]) -> Tuple[int, int, Dict[str, str]]:
+        """Same for everything outside the drawn values (a level's Other node): one pass over the cells."""
+        drawn_codes = [self.lookup[col][v] for v in drawn if v in self.lookup[col]]
+        m = ~np.isin(self.codes[col], np.asarray(drawn_codes, dtype=np.int64))
+        units = self.units[m]
+        tops = {}
+        for b in self.COLS:
+            if b == col:
+                continue
+            codes = self.codes[b][m]
+            ok = codes >= 0
+            nb = len(self.labels[b])
+            present = np.flatnonzero(np.bincount(codes[ok], minlength=nb))
+            sums = _code_sums(codes, units, nb)[present]
+            order = np.lexsort((present, -sums))[:DIST_NODE_INFO_TOP]
+            tops[b] = self._table(b, present[order], sums[order])
+        return int(self.records[m].sum()), int(units.sum()), tops
+
+def node_info(drill: Optional[NodeDrillIndex], node_id: str, drawn: Optional[Dict[str, List[str]]] = None) -> str:
+    """drill: NodeDrillIndex of the filtered cube; drawn: node type -> values drawn at that level (for Other)."""
+    if not node_id or ":" not in node_id or drill is None or drill.n == 0:
         return ""
     typ, val = node_id.split(":", 1)
     val = val.strip()
-    md = [f"### {t['dist_node_info']}", f"- **Type**: `{typ}`", f"- **Value**: `{val}`"]
-    if typ == "Supplier":
-        sub = df[df["SupplierID"] == val]
-    elif typ == "Category":
-        sub = df[df["Category"] == val]
-    elif typ == "License":
-        sub = df[df["LicenseNo"] == val]
-    elif typ == "Customer":
-        sub = df[df["CustomerID"] == val]
+    col = {prefix: c for c, prefix, _, _ in DIST_GRAPH_LEVELS}.get(typ)
+    if col is None:
+        return ""
+    if val == DIST_GRAPH_OTHER:
+        md = [f"### {t['dist_node_info']}", f"- **Type**: `{typ}`", "- **Value**: Other (values not drawn at this level)"]
+        records, units, tops = drill.other_summary(col, (drawn or {}).get(typ, []))
     else:
-        sub = df
-    md.append(f"- Records: **{len(sub):,}**")
-    md.append(f"- Total units (Number): **{int(sub['Number'].sum()):,}**")
+        md = [f"### {t['dist_node_info']}", f"- **Type**: `{typ}`", f"- **Value**: `{val}`"]
+        records, units, tops = drill.summary(col, val)
+    md.append(f"- Records: **{records:,}**")
+    md.append(f"- Total units (Number): **{units:,}**")
     # Top counterparts
-    if typ != "Supplier":
-        md.append("\n**Top SupplierID**")
-        md.append(sub.groupby("SupplierID")["Number"].sum().sort_values(ascending=False).head(5).to_frame("units").to_markdown())
-    if typ != "Customer":
-        md.append("\n**Top CustomerID**")
-        md.append(sub.groupby("CustomerID")["Number"].sum().sort_values(ascending=False).head(5).to_frame("units").to_markdown())
-    if typ != "Category":
-        md.append("\n**Top Category**")
-        md.append(sub.groupby("Category")["Number"].sum().sort_values(ascending=False).head(5).to_frame("units").to_markdown())
-    if typ != "License":
-        md.append("\n**Top LicenseNo**")
-        md.append(sub.groupby("LicenseNo")["Number"].sum().sort_values(ascending=False).head(5).to_frame("units").to_markdown())
+    for b in ["SupplierID", "CustomerID", "Category", "LicenseNo"]:
+        if b in tops:
+            md.append(f"\n**Top {b}**")
+            md.append(tops[b])
     return "\n".join(md)
 
-def build_sankey(df: pd.DataFrame) -> go.Figure:
+def build_sankey(df: pd.DataFrame, max_paths: int = DIST_SANKEY_MAX_PATHS) -> go.Figure:
     if df is None or df.empty:
         return go.Figure()
 
-    g = df.groupby(["SupplierID", "Category", "LicenseNo", "CustomerID"])["Number"].sum().reset_index()
-    g = g.sort_values("Number", ascending=False).head(300)  # limit for performance
-
-    labels = []
-    label_index = {}
-
-    def idx(label):
-        if label not in label_index:
-            label_index[label] = len(labels)
-            labels.append(label)
-        return label_index[label]
-
-    # Build links for each hop
-    links_src, links_tgt, links_val = [], [], []
-    # Supplier -> Category
-    g1 = g.groupby(["SupplierID", "Category"])["Number"].sum().reset_index()
-    for _, r in g1.iterrows():
-        s = idx(f"S:{r['SupplierID']}")
-        t_ = idx(f"C:{r['Category']}")
-        links_src.append(s); links_tgt.append(t_); links_val.append(float(r["Number"]))
-    # Category -> License
-    g2 = g.groupby(["Category", "LicenseNo"])["Number"].sum().reset_index()
-    for _, r in g2.iterrows():
-        s = idx(f"C:{r['Category']}")
-        t_ = idx(f"L:{r['LicenseNo']}")
-        links_src.append(s); links_tgt.append(t_); links_val.append(float(r["Number"]))
-    # License -> Customer
-    g3 = g.groupby(["LicenseNo", "CustomerID"])["Number"].sum().reset_index()
-    for _, r in g3.iterrows():
-        s = idx(f"L:{r['LicenseNo']}")
-        t_ = idx(f"U:{r['CustomerID']}")
-        links_src.append(s); links_tgt.append(t_); links_val.append(float(r["Number"]))
+    g = df.groupby(["SupplierID", "Category", "LicenseNo", "CustomerID"], observed=True)["Number"].sum().reset_index()
+    g = g.sort_values("Number", ascending=False).head(max_paths)  # limit for performance
+
+    # Links for each hop; node labels are numbered in order of first appearance (source, then target)
+    hops = [("SupplierID", "S", "Category", "C"), ("Category", "C", "LicenseNo", "L"), ("LicenseNo", "L", "CustomerID", "U")]
+    ends, links_val = [], []
+    for a, pa_, b, pb in hops:
+        h = g.groupby([a, b], observed=True)["Number"].sum()
+        pair = np.empty(2 * len(h), dtype=object)
+        pair[0::2] = (pa_ + ":" + h.index.get_level_values(0).astype(str)).to_numpy(dtype=object)
+        pair[1::2] = (pb + ":" + h.index.get_level_values(1).astype(str)).to_numpy(dtype=object)
+        ends.append(pair)
+        links_val.append(h.to_numpy(dtype=float))
+    codes, labels = pd.factorize(np.concatenate(ends))
+    links_src, links_tgt, links_val = codes[0::2], codes[1::2], np.concatenate(links_val)
 
     fig = go.Figure(
         data=[
@@ -1143,7 +4854,7 @@ def build_sankey(df: pd.DataFrame) -> go.Figure:
                     pad=12,
                     thickness=14,
                     line=dict(color="rgba(255,255,255,0.25)", width=0.5),
-                    label=labels,
+                    label=list(labels),
                 ),
                 link=dict(source=links_src, target=links_tgt, value=links_val),
             )
@@ -1152,19 +4863,62 @@ def build_sankey(df: pd.DataFrame) -> go.Figure:
     fig.update_layout(height=520, margin=dict(l=10, r=10, t=10, b=10))
     return fig
 
-def build_timeseries(df: pd.DataFrame) -> go.Figure:
+# Time series rendering: daily totals are rolled up to the chosen granularity, long series are cut down
+# to DIST_TS_MAX_POINTS with LTTB (keeps peaks and troughs), and traces switch to WebGL (Scattergl)
+# above DIST_TS_WEBGL_POINTS so multi-year daily series stay responsive in the browser.
+DIST_TS_GRANULARITIES = ["Day", "Week", "Month"]
+DIST_TS_MAX_POINTS = int(os.environ.get("DIST_TS_MAX_POINTS", "2000"))
+DIST_TS_WEBGL_POINTS = int(os.environ.get("DIST_TS_WEBGL_POINTS", "1000"))
+DIST_HEATMAP_TOP = 20
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: indices of n_out points (first and last kept) tracing the shape of y(x)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)  # n_out - 2 buckets between the end points
+    out = np.empty(n_out, dtype=np.int64)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt = slice(hi, edges[i + 2]) if i + 2 < len(edges) else slice(n - 1, n)
+        cx, cy = x[nxt].mean(), y[nxt].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+def timeseries_frame(df: pd.DataFrame, granularity: str = "Day") -> pd.DataFrame:
+    """records / units per day, week (starting Monday) or month; one groupby over df, the rest on the daily rows."""
+    d = df
+    ts = d.groupby(d["Deliverdate_dt"].dt.floor("D")).agg(
+        records=("records", "sum") if "records" in d.columns else ("Number", "size"),
+        units=("Number", "sum"),
+    )
+    if granularity == "Week":
+        ts = ts.groupby(ts.index - pd.to_timedelta(ts.index.dayofweek, unit="D")).sum()
+    elif granularity == "Month":
+        ts = ts.groupby(ts.index.to_period("M").to_timestamp()).sum()
+    return ts.rename_axis("date").reset_index()
+
+def build_timeseries(df: pd.DataFrame, granularity: str = "Day", max_points: int = DIST_TS_MAX_POINTS) -> go.Figure:
     if df is None or df.empty:
         return go.Figure()
-    d = df.copy()
+    d = df
     if "Deliverdate_dt" not in d.columns or not d["Deliverdate_dt"].notna().any():
         return go.Figure()
-    ts = d.groupby(d["Deliverdate_dt"].dt.to_period("D").dt.to_timestamp()).agg(
-        records=("SupplierID", "size"),
-        units=("Number", "sum"),
-    ).reset_index().rename(columns={"Deliverdate_dt": "date"})
+    ts = timeseries_frame(d, granularity)
+    x = ts["date"].to_numpy()
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=ts["date"], y=ts["records"], mode="lines+markers", name="records"))
-    fig.add_trace(go.Scatter(x=ts["date"], y=ts["units"], mode="lines+markers", name="units", yaxis="y2"))
+    for col, axis in (("records", "y"), ("units", "y2")):
+        y = ts[col].to_numpy()
+        idx = lttb_indices(x.astype("int64"), y, max_points)
+        big = len(idx) > DIST_TS_WEBGL_POINTS
+        trace = go.Scattergl if big else go.Scatter
+        fig.add_trace(trace(x=x[idx], y=y[idx], mode="lines" if big else "lines+markers", name=col, yaxis=axis))
     fig.update_layout(
         height=320,
         margin=dict(l=10, r=10, t=10, b=10),
@@ -1177,8 +4931,8 @@ def build_timeseries(df: pd.DataFrame) -> go.Figure:
 def build_top_bars(df: pd.DataFrame) -> Tuple[go.Figure, go.Figure]:
     if df is None or df.empty:
         return go.Figure(), go.Figure()
-    top_sup = df.groupby("SupplierID")["Number"].sum().sort_values(ascending=False).head(12).reset_index()
-    top_cus = df.groupby("CustomerID")["Number"].sum().sort_values(ascending=False).head(12).reset_index()
+    top_sup = df.groupby("SupplierID", observed=True)["Number"].sum().sort_values(ascending=False).head(12).reset_index()
+    top_cus = df.groupby("CustomerID", observed=True)["Number"].sum().sort_values(ascending=False).head(12).reset_index()
 
     fig1 = px.bar(top_sup, x="SupplierID", y="Number", title="Top SupplierID (units)")
     fig1.update_layout(height=320, margin=dict(l=10, r=10, t=40, b=10))
@@ -1187,35 +4941,75 @@ def build_top_bars(df: pd.DataFrame) -> Tuple[go.Figure, go.Figure]:
     fig2.update_layout(height=320, margin=dict(l=10, r=10, t=40, b=10))
     return fig1, fig2
 
-def build_heatmap(df: pd.DataFrame) -> go.Figure:
+def build_heatmap(df: pd.DataFrame, top: int = DIST_HEATMAP_TOP) -> go.Figure:
     if df is None or df.empty:
         return go.Figure()
-    pivot = df.pivot_table(
-        index="SupplierID", columns="Category", values="Number", aggfunc="sum", fill_value=0
+    # (supplier, category) sums in one pass, then top suppliers by units and the top categories within
+    # them; the pivot is built for that block only
+    sup, sup_labels = _label_codes(df["SupplierID"])
+    cat, cat_labels = _label_codes(df["Category"])
+    n_sup, n_cat = len(sup_labels), len(cat_labels)
+    valid = (sup >= 0) & (cat >= 0)
+    keys, sums = _pair_sums(sup[valid] * n_cat + cat[valid], df["Number"].fillna(0).to_numpy()[valid], n_sup * n_cat)
+    if not len(keys):
+        return go.Figure()
+    ps, pc = keys // n_cat, keys % n_cat
+    sup_units = _code_sums(ps, sums, n_sup)
+    sup_present = np.unique(ps)
+    rows = sup_present[np.argsort(-sup_units[sup_present], kind="stable")[:top]]
+    row_pos = np.full(n_sup, -1, dtype=np.int64)
+    row_pos[rows] = np.arange(len(rows))
+    in_rows = row_pos[ps] >= 0
+    r, c, w = row_pos[ps[in_rows]], pc[in_rows], sums[in_rows]
+    cat_units = _code_sums(c, w, n_cat)
+    cat_present = np.unique(c)
+    cols = cat_present[np.argsort(-cat_units[cat_present], kind="stable")[:top]]
+    col_pos = np.full(n_cat, -1, dtype=np.int64)
+    col_pos[cols] = np.arange(len(cols))
+    keep = col_pos[c] >= 0
+    cells = _code_sums(r[keep] * len(cols) + col_pos[c[keep]], w[keep], len(rows) * len(cols))
+    pivot = pd.DataFrame(
+        cells.reshape(len(rows), len(cols)),
+        index=pd.Index(sup_labels[rows], name="SupplierID"),
+        columns=pd.Index(cat_labels[cols], name="Category"),
     )
-    # limit size
-    pivot = pivot.loc[pivot.sum(axis=1).sort_values(ascending=False).head(20).index]
-    pivot = pivot[pivot.sum(axis=0).sort_values(ascending=False).head(20).index]
     fig = px.imshow(pivot, aspect="auto", title="Supplier × Category (units)")
     fig.update_layout(height=460, margin=dict(l=10, r=10, t=40, b=10))
     return fig
 
+def dataset_agent_input(df: pd.DataFrame, ds_name: str, n_rows: int = 50, agg: Optional[pd.DataFrame] = None) -> str:
+    """
+    Agent input for a (filtered) dataset: stats pack JSON + the first rows as a markdown table.
+    agg is the matching slice of the aggregate cube; when given, stats come from it and df only
+    needs to hold the first n_rows rows.
+    """
+    stats_src = df if agg is None else agg
+    df_preview_md = df[STANDARD_COLS].head(n_rows).to_markdown(index=False) if not df.empty else "_empty_"
+    return (
+        "以下為「已篩選後」的醫療器材配送資料摘要：\n\n"
+        f"- 資料集名稱: {ds_name}\n"
+        f"- 篩選後筆數: {frame_records(stats_src)}\n"
+        f"- 統計摘要(JSON):\n{json.dumps(dataset_stats_pack(stats_src), ensure_ascii=False, indent=2)}\n\n"
+        f"前 {n_rows} 筆（Markdown Table）：\n\n"
+        f"{df_preview_md}\n"
+    )
+
 def dataset_stats_pack(df: pd.DataFrame) -> Dict[str, Any]:
     if df is None or df.empty:
         return {}
     pack = {}
-    pack["records"] = int(len(df))
+    pack["records"] = frame_records(df)
     if "Deliverdate_dt" in df.columns and df["Deliverdate_dt"].notna().any():
         pack["date_min"] = str(df["Deliverdate_dt"].min().date())
         pack["date_max"] = str(df["Deliverdate_dt"].max().date())
     pack["units_total"] = int(df["Number"].sum())
-    pack["supplier_count"] = int(df["SupplierID"].replace("", pd.NA).dropna().nunique())
-    pack["customer_count"] = int(df["CustomerID"].replace("", pd.NA).dropna().nunique())
-    pack["category_count"] = int(df["Category"].replace("", pd.NA).dropna().nunique())
-    pack["license_count"] = int(df["LicenseNo"].replace("", pd.NA).dropna().nunique())
+    pack["supplier_count"] = int(df.loc[df["SupplierID"] != "", "SupplierID"].nunique())
+    pack["customer_count"] = int(df.loc[df["CustomerID"] != "", "CustomerID"].nunique())
+    pack["category_count"] = int(df.loc[df["Category"] != "", "Category"].nunique())
+    pack["license_count"] = int(df.loc[df["LicenseNo"] != "", "LicenseNo"].nunique())
 
     def top(col, n=10):
-        s = df.groupby(col)["Number"].sum().sort_values(ascending=False).head(n)
+        s = df.groupby(col, observed=True)["Number"].sum().sort_values(ascending=False).head(n)
         return [{"value": str(k), "units": int(v)} for k, v in s.items() if str(k).strip() != ""]
 
     pack["top_suppliers"] = top("SupplierID", 10)
@@ -1225,6 +5019,51 @@ def dataset_stats_pack(df: pd.DataFrame) -> Dict[str, Any]:
     return pack
 
 
+# =========================
+# Background jobs (session view)
+# =========================
+def sync_session_jobs() -> None:
+    """
+    Re-attach a job passed as ?job=...&job_key=... (only when job_key is the job's owner secret), and copy
+    each finished job of this session into execution_log once.
+    """
+    runner = get_job_runner()
+    qjob = st.query_params.get("job")
+    qkey = st.query_params.get("job_key", "")
+    if qjob and qjob not in st.session_state.jobs and runner.owns(qjob, qkey):
+        st.session_state.jobs.append(qjob)
+        st.session_state.active_job = qjob
+        st.session_state.job_owner = qkey  # a reload is the same user: keep owning new jobs with the same secret
+    for job_id in st.session_state.jobs:
+        job = runner.get(job_id)
+        if job is not None and job.get("awaiting_keys"):
+            # batch job restarted without the provider key in the environment: the owner's key resumes it
+            runner.resume(job_id, {p: get_api_key(env)[0] for p, env in BATCH_KEY_ENV.items()})
+        if job is None or job["status"] in JOB_ACTIVE or job_id in st.session_state.jobs_logged:
+            continue
+        for span in job["timeline"]:
+            name = span.get("node")
+            meta = job["metas"].get(name, {})
+            if name not in job["outputs"] or getattr(meta.get("error"), "kind", "") == "cancelled":
+                continue
+            text = job["outputs"][name]
+            rec = {"ts": job["finished"], "agent": meta.get("agent") or name, "chain": job_id, "output_tokens_est": estimate_tokens(text), "output": text, "meta": meta}
+            if rec["agent"] != name:
+                rec["item"] = name  # batch jobs: "<agent> · <dataset group>"
+            st.session_state.execution_log.append(rec)
+            st.session_state.runs += 1
+        st.session_state.last_run_ts = job["finished"]
+        st.session_state.jobs_logged.append(job_id)
+
+def job_progress(job: Dict[str, Any]) -> None:
+    total = len(job["agents"]) or 1
+    finished = len(job["outputs"])
+    st.progress(finished / total, text=f"{job['id']} · {job['status']} · {finished}/{total} agents")
+    if job["running"]:
+        st.caption("Running: " + ", ".join(job["running"]))
+
+sync_session_jobs()
+
 # =========================
 # Sidebar
 # =========================
@@ -1281,6 +5120,38 @@ with st.sidebar:
     key_input("ANTHROPIC_API_KEY", t["anthropic_key"])
     key_input("GROK_API_KEY", t["grok_key"])
 
+    st.markdown("---")
+    st.session_state.llm_cache_enabled = st.toggle(
+        "⚡ Response cache",
+        value=st.session_state.llm_cache_enabled,
+        help="Reuse earlier completions for identical provider/model/prompts/temperature/max_tokens. Turn off to always call the model.",
+    )
+
+    if st.session_state.jobs:
+        st.markdown("---")
+        session_jobs = [j for j in (get_job_runner().get(i) for i in st.session_state.jobs[-5:]) if j is not None]
+
+        @st.fragment(run_every=JOB_POLL_S if any(j["status"] in JOB_ACTIVE for j in session_jobs) else None)
+        def jobs_sidebar_panel():
+            st.markdown("#### 🧵 Background jobs")
+            for job_id in reversed(st.session_state.jobs[-5:]):
+                job = get_job_runner().get(job_id)
+                if job is None:
+                    continue
+                job_progress(job)
+                c1, c2 = st.columns(2)
+                with c1:
+                    if st.button("👁️ Show", key=f"show_{job_id}", use_container_width=True):
+                        st.session_state.active_job = job_id
+                        st.rerun()
+                with c2:
+                    if job["status"] in JOB_ACTIVE and st.button("⏹️ Cancel", key=f"cancel_{job_id}", use_container_width=True):
+                        get_job_runner().cancel(job_id)
+                if job["status"] not in JOB_ACTIVE and job_id not in st.session_state.jobs_logged:
+                    st.rerun()  # finished since the last full run: refresh History and the results view
+
+        jobs_sidebar_panel()
+
     st.markdown("---")
     with st.expander("🧪 Session Controls", expanded=False):
         if st.button(t["clear_history"], use_container_width=True):
@@ -1288,6 +5159,7 @@ with st.sidebar:
             st.session_state.runs = 0
             st.session_state.last_run_ts = None
             st.session_state.chain_state = {"active": False, "agents": [], "idx": 0, "current_input": "", "last_output": "", "overrides": {}}
+            st.session_state.active_job = None
             st.toast("Cleared.", icon="🧹")
 
 
@@ -1475,6 +5347,13 @@ with tab_agents:
         st.markdown(f"#### 🔗 {t['chain_agents']}")
         selected_agents = st.multiselect(t["chain_agents"], agent_names, default=[])
 
+        parallel_dag = st.checkbox(
+            "Run all as parallel DAG (uses depends_on)",
+            value=True,
+            help="Agents with depends_on run as soon as their inputs are ready; agents without it follow the previous selected agent. "
+                 "Unchecked runs the selected agents strictly in order. Either way the run continues in the background.",
+        )
+
         chain_controls_1, chain_controls_2 = st.columns(2)
         with chain_controls_1:
             if st.button("🧭 " + t["start_chain"], use_container_width=True, disabled=not bool(selected_agents)):
@@ -1485,26 +5364,17 @@ with tab_agents:
                     "current_input": context_text,
                     "last_output": "",
                     "overrides": {},
+                    "run_id": new_run_id("chain"),
                 }
                 st.toast("Chain started (step-by-step).", icon="🧭")
                 st.rerun()
 
         with chain_controls_2:
-            if st.button("⚡ " + t["run_all"], use_container_width=True, disabled=not bool(selected_agents)):
-                st.session_state.chain_state = {
-                    "active": True,
-                    "agents": selected_agents,
-                    "idx": 0,
-                    "current_input": context_text,
-                    "last_output": "",
-                    "overrides": st.session_state.chain_state.get("overrides", {}) if isinstance(st.session_state.chain_state, dict) else {},
-                }
-                st.session_state.chain_state["auto"] = True
-                st.toast("Chain running (auto).", icon="⚡")
-                st.rerun()
+            run_all_clicked = st.button("⚡ " + t["run_all"], use_container_width=True, disabled=not bool(selected_agents))
 
         if st.button("🔁 " + t["reset_chain"], use_container_width=True):
             st.session_state.chain_state = {"active": False, "agents": [], "idx": 0, "current_input": "", "last_output": "", "overrides": {}}
+            st.session_state.active_job = None
             st.toast("Chain reset.", icon="🔁")
             st.rerun()
 
@@ -1512,16 +5382,32 @@ with tab_agents:
 
     st.markdown("---")
 
+    if run_all_clicked:
+        chain_overrides = st.session_state.chain_state.get("overrides", {}) if isinstance(st.session_state.chain_state, dict) else {}
+        st.session_state.chain_state = {"active": False, "agents": [], "idx": 0, "current_input": "", "last_output": "", "overrides": chain_overrides}
+        try:
+            job_id = get_job_runner().submit(
+                selected_agents, all_agents, context_text, chain_overrides, resolved_keys,
+                sequential=not parallel_dag, use_cache=st.session_state.llm_cache_enabled,
+                owner=st.session_state.job_owner,
+            )
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            st.session_state.jobs.append(job_id)
+            st.session_state.active_job = job_id
+            st.query_params["job"] = job_id  # a page reload re-attaches to the running job
+            st.query_params["job_key"] = st.session_state.job_owner
+            st.toast(f"Started {job_id} in the background — feel free to switch tabs.", icon="⚡")
+
     cs = st.session_state.chain_state
     if cs.get("active") and cs.get("agents"):
         idx = int(cs.get("idx", 0))
         chain = cs["agents"]
-        auto = bool(cs.get("auto", False))
 
         if idx >= len(chain):
             st.success(t["complete"])
             cs["active"] = False
-            cs["auto"] = False
         else:
             agent_name = chain[idx]
             agent_conf = next((a for a in all_agents if a.get("name") == agent_name), None) or {}
@@ -1601,7 +5487,8 @@ with tab_agents:
                 height=220,
                 key=f"input_{agent_name}_{idx}",
             )
-            st.caption(f"{t['token_estimate']}: {estimate_tokens(cs['current_input'])}")
+            step_window = model_context_limit(overrides.get("model", ""))[0]
+            st.caption(f"{t['token_estimate']}: {estimate_tokens(cs['current_input']):,} / {step_window:,} context ({overrides.get('model')})")
 
             run_col1, run_col2 = st.columns([1, 1])
             with run_col1:
@@ -1614,10 +5501,89 @@ with tab_agents:
                     key=f"view_{agent_name}_{idx}",
                 )
 
-            if do_run or auto:
+            with st.expander("🏁 Fan-out: run this step on several models", expanded=False):
+                fan_defaults = [m for m in FANOUT_DEFAULT_MODELS if resolved_keys.get(infer_provider(m))]
+                fan_models = st.multiselect("Models", MODEL_CHOICES, default=fan_defaults, key=f"fan_models_{agent_name}_{idx}")
+                fan_race = st.checkbox(
+                    "First good answer wins (cancel slower calls)",
+                    value=False,
+                    key=f"fan_race_{agent_name}_{idx}",
+                    help="Returns as soon as one model finishes without error; the other streams are closed.",
+                )
+                do_fanout = st.button(
+                    f"🏁 Run on {len(fan_models)} models",
+                    key=f"fan_run_{agent_name}_{idx}",
+                    use_container_width=True,
+                    disabled=len(fan_models) < 2,
+                )
+
+            if do_fanout:
+                with st.status(f"Running {agent_name} on {len(fan_models)} models…", expanded=True) as status:
+                    def on_fan_result(model: str, text: str, meta: Dict[str, Any]) -> None:
+                        ok = bool(text) and not meta.get("error")
+                        st.write(f"{'✅' if ok else '⚠️'} **{model}** — {meta.get('fanout_s', 0):.1f}s")
+
+                    fan = run_agent_fanout(
+                        agent_conf, cs["current_input"], overrides, resolved_keys, fan_models,
+                        race=fan_race, use_cache=st.session_state.llm_cache_enabled, on_result=on_fan_result,
+                    )
+                    label = f"Winner: {fan['winner']}" if fan["winner"] else "No model returned a usable answer"
+                    status.update(label=f"{label} · wall {fan['wall_s']:.1f}s", state="complete" if fan["winner"] else "error")
+
+                for model in fan["models"]:
+                    text, meta = fan["results"][model]
+                    if getattr(meta.get("error"), "kind", "") == "cancelled" and not text:
+                        continue
+                    st.session_state.execution_log.append(
+                        {"ts": now_str(), "agent": agent_name, "chain": cs.get("run_id", ""), "output": text, "meta": meta}
+                    )
+                    st.session_state.runs += 1
+                st.session_state.last_run_ts = now_str()
+                cs.setdefault("fanout", {})[idx] = fan
+                st.session_state.chain_state = cs
+
+            fan = (cs.get("fanout") or {}).get(idx)
+            if fan and not do_run:
+                st.markdown(f"#### 🏁 Fan-out results ({'race' if fan['race'] else 'all models'})")
+                fan_cols = st.columns(len(fan["models"]))
+                for col, model in zip(fan_cols, fan["models"]):
+                    text, meta = fan["results"][model]
+                    with col:
+                        st.markdown(f"**{'🏆 ' if model == fan['winner'] else ''}{model}**")
+                        if meta.get("error"):
+                            st.error(str(meta["error"]))
+                        else:
+                            ttft = f" · TTFT {meta['ttft_s']:.1f}s" if meta.get("ttft_s") is not None else ""
+                            cost = f" · ${meta['cost_usd']:.4f}" if meta.get("cost_usd") is not None else ""
+                            st.caption(f"{meta.get('fanout_s', 0):.1f}s{ttft}{cost}")
+                        if view == t["markdown"]:
+                            st.markdown(text)
+                        else:
+                            st.text(text)
+                        if text and st.button("➡️ " + t["use_as_next"], key=f"fan_use_{agent_name}_{idx}_{model}", use_container_width=True):
+                            cs["current_input"] = text
+                            cs["idx"] = idx + 1
+                            cs["fanout"].pop(idx, None)
+                            st.session_state.chain_state = cs
+                            st.rerun()
+
+            if do_run:
                 with st.status(f"Running {agent_name}…", expanded=True) as status:
                     st.write(f"Model: **{overrides.get('model')}** | Provider: **{overrides.get('provider')}**")
-                    output, meta = run_agent(agent_conf, cs["current_input"], overrides, resolved_keys)
+                    stream = run_agent_stream(agent_conf, cs["current_input"], overrides, resolved_keys, use_cache=st.session_state.llm_cache_enabled)
+                    notice = budget_notice(stream.meta)
+                    if notice:
+                        st.info(notice)
+                    if view == t["markdown"]:
+                        st.write_stream(stream)
+                    else:
+                        live = st.empty()
+                        for _ in stream:
+                            live.text(stream.text)
+                        live.text_area(t["output"], stream.text, height=260)
+                    output, meta = stream.text, stream.meta
+                    if stream.error:
+                        st.error(str(stream.error))
 
                     cs["last_output"] = output
                     st.session_state.chain_state = cs
@@ -1626,6 +5592,7 @@ with tab_agents:
                         {
                             "ts": now_str(),
                             "agent": agent_name,
+                            "chain": cs.get("run_id", ""),
                             "input_tokens_est": estimate_tokens(cs["current_input"]),
                             "output_tokens_est": estimate_tokens(output),
                             "output": output,
@@ -1635,12 +5602,10 @@ with tab_agents:
                     st.session_state.runs += 1
                     st.session_state.last_run_ts = now_str()
 
-                    if view == t["markdown"]:
-                        st.markdown(output)
+                    if stream.error:
+                        status.update(label=f"{agent_name} failed", state="error")
                     else:
-                        st.text_area(t["output"], output, height=260)
-
-                    status.update(label=f"{agent_name} Complete", state="complete")
+                        status.update(label=f"{agent_name} Complete", state="complete")
 
                 st.markdown("#### ✍️ " + t["edit_output_for_next"])
                 edited = st.text_area(
@@ -1655,7 +5620,6 @@ with tab_agents:
                     if st.button("➡️ " + t["use_as_next"], key=f"use_next_{agent_name}_{idx}", use_container_width=True):
                         cs["current_input"] = edited
                         cs["idx"] = idx + 1
-                        cs["auto"] = False
                         st.session_state.chain_state = cs
                         st.rerun()
 
@@ -1665,11 +5629,50 @@ with tab_agents:
                     else:
                         st.markdown(f"<div class='wow-card'><b>{t['next_agent']}:</b> —</div>", unsafe_allow_html=True)
 
-                if auto:
-                    cs["current_input"] = edited
-                    cs["idx"] = idx + 1
-                    st.session_state.chain_state = cs
-                    st.rerun()
+    elif st.session_state.active_job:
+        active = get_job_runner().get(st.session_state.active_job)
+
+        @st.fragment(run_every=JOB_POLL_S if active and active["status"] in JOB_ACTIVE else None)
+        def job_results_panel():
+            dag = get_job_runner().get(st.session_state.active_job)
+            if dag is None:
+                st.info("This background job is no longer available.")
+                return
+            title = {"dag": "DAG run", "sequential": "Sequential run", "batch": "Batch run"}.get(dag["mode"], "Run")
+            if dag["status"] in JOB_ACTIVE:
+                st.markdown(f"### 🕸️ {title} — {dag['id']}")
+                job_progress(dag)
+                for provider, b in (dag.get("batches") or {}).items():
+                    st.caption(f"{PROVIDER_LABELS.get(provider, provider)} batch `{b.get('id')}`: {b.get('status')} · "
+                               f"{b.get('completed', 0)}/{b.get('total', 0)} done, {b.get('failed', 0)} failed")
+                if dag.get("awaiting_keys"):
+                    st.warning("Resumed after a server restart: enter the API key for "
+                               + ", ".join(PROVIDER_LABELS.get(p, p) for p in dag["awaiting_keys"])
+                               + " in the sidebar to keep polling its batch.")
+                if st.button("⏹️ Cancel run", key=f"cancel_main_{dag['id']}"):
+                    get_job_runner().cancel(dag["id"])
+            else:
+                st.markdown(f"### 🕸️ {title} — {len(dag['agents'])} agents · {dag['status']} · wall {dag['wall_s']:.1f}s · sequential sum {dag['sum_s']:.1f}s")
+                if dag.get("error"):
+                    st.error(dag["error"])
+                if dag["id"] not in st.session_state.jobs_logged:
+                    st.rerun()  # full rerun copies the results into History
+            st.plotly_chart(build_dag_timeline(dag["timeline"]), use_container_width=True)
+            for name in dag["agents"]:
+                if name not in dag["outputs"]:
+                    continue
+                span = dag["metas"].get(name, {}).get("dag", {})
+                deps_txt = ", ".join(dag["deps"].get(name, [])) or "context"
+                with st.expander(f"{name} ← {deps_txt} ({span.get('status', '')})", expanded=False):
+                    err = dag["metas"].get(name, {}).get("error")
+                    if err:
+                        st.error(str(err))
+                    notice = budget_notice(dag["metas"].get(name, {}))
+                    if notice:
+                        st.info(notice)
+                    st.markdown(dag["outputs"].get(name, ""))
+
+        job_results_panel()
     else:
         st.info("Select agents and start a chain to run step-by-step (with editable outputs).")
 
@@ -1690,7 +5693,9 @@ with tab_distribution:
             value=st.session_state.dist_dataset_name,
         )
 
-        up = st.file_uploader(t["dist_upload"], type=["txt", "csv", "json"])
+        up = st.file_uploader(t["dist_upload"], type=["txt", "csv", "tsv", "json", "jsonl", "ndjson"])
+        if up is not None:
+            st.caption(f"📄 `{up.name}` ({up.size / 1e6:,.1f} MB) is streamed in chunks on standardize; the box below is only for pasted data.")
         st.session_state.dist_raw_text = st.text_area(
             t["dist_paste"],
             value=st.session_state.dist_raw_text,
@@ -1711,22 +5716,201 @@ with tab_distribution:
             if st.button("🧹 Clear dataset", use_container_width=True):
                 st.session_state.dist_raw_text = ""
                 st.session_state.dist_df = None
+                st.session_state.dist_extras = None
+                st.session_state.dist_cube = None
+                st.session_state.dist_cube_src = None
+                st.session_state.dist_cube_index = None
+                st.session_state.dist_row_index = None
+                st.session_state.dist_cube_cells = None
+                st.session_state.dist_drill_index = None
+                st.session_state.dist_drill_src = None
+                st.session_state.dist_graph_memo = OrderedDict()
+                st.session_state.dist_dedup_index = None
+                st.session_state.dist_dedup_for = None
+                st.session_state.dist_append_log = []
+                st.session_state.dist_cache_info = None
                 st.session_state.dist_summary_md = ""
+                if st.session_state.sql_stream is not None:
+                    st.session_state.sql_stream.close()
+                    st.session_state.sql_stream = None
                 st.toast("Cleared.", icon="🧹")
                 st.rerun()
 
-        # If file uploaded, override raw_text for standardization
-        if up is not None:
-            _, content = safe_read_uploaded(up)
-            if content and content.strip():
-                st.session_state.dist_raw_text = content
-
         if do_standardize:
-            raw = st.session_state.dist_raw_text or ""
-            df_raw = parse_dataset_text_to_df(raw)
-            df_std = standardize_distribution_df(df_raw)
-            st.session_state.dist_df = df_std
-            st.toast("Standardization complete.", icon="🧪")
+            st.session_state.dist_append_log = []
+            # Same bytes -> same standardized frame: look the content hash up before parsing anything.
+            ds_cache = get_dataset_cache()
+            t0 = time.perf_counter()
+            ds_key = dataset_content_key(up if up is not None else (st.session_state.dist_raw_text or ""))
+            cached = ds_cache.get(ds_key)
+            if cached is not None:
+                df_std, extras, tier = cached
+                st.session_state.dist_df = df_std
+                st.session_state.dist_extras = extras
+                st.session_state.dist_cache_info = {"tier": tier, "key": ds_key[:12], "ms": (time.perf_counter() - t0) * 1000}
+                st.toast(f"Standardized dataset loaded from cache ({tier}).", icon="⚡")
+            elif up is not None:
+                # An uploaded file takes precedence over pasted text and is never copied into the text area.
+                bar = st.progress(0.0, text=f"Ingesting {up.name}…")
+                try:
+                    up.seek(0)
+                    df_std, extras = ingest_distribution_upload(
+                        up, up.name,
+                        on_progress=lambda frac, rows: bar.progress(frac, text=f"Ingesting {up.name}… {frac * 100:.0f}% · {rows:,} rows"),
+                    )
+                except Exception as e:
+                    bar.empty()
+                    st.error(f"Could not ingest {up.name}: {type(e).__name__}: {e}")
+                else:
+                    bar.progress(1.0, text=f"Ingested {len(df_std):,} rows from {up.name}")
+                    ds_cache.put(ds_key, df_std, extras)
+                    st.session_state.dist_df = df_std
+                    st.session_state.dist_extras = extras
+                    st.session_state.dist_cache_info = {"tier": "miss", "key": ds_key[:12], "ms": (time.perf_counter() - t0) * 1000}
+                    st.toast("Standardization complete.", icon="🧪")
+            else:
+                raw = st.session_state.dist_raw_text or ""
+                df_raw = parse_dataset_text_to_df(raw)
+                df_std, extras = standardize_distribution(df_raw)
+                ds_cache.put(ds_key, df_std, extras)
+                st.session_state.dist_df = df_std
+                st.session_state.dist_extras = extras
+                st.session_state.dist_cache_info = {"tier": "miss", "key": ds_key[:12], "ms": (time.perf_counter() - t0) * 1000}
+                st.toast("Standardization complete.", icon="🧪")
+
+        with st.expander("➕ Append delta (daily files)", expanded=False):
+            st.caption(
+                "Standardizes only the uploaded file / pasted text, skips rows whose dedup key is already loaded, "
+                "and updates the aggregate cube and filter indexes incrementally."
+            )
+            dedup_key = st.multiselect("Dedup key", STANDARD_COLS, default=DIST_DEDUP_KEY, key="dist_dedup_key")
+            do_append = st.button(
+                "➕ Append to current dataset",
+                use_container_width=True,
+                disabled=st.session_state.dist_df is None or not dedup_key,
+            )
+            if do_append:
+                t0 = time.perf_counter()
+                try:
+                    if up is not None:
+                        up.seek(0)
+                        delta, delta_extras = ingest_distribution_upload(up, up.name)
+                    else:
+                        delta, delta_extras = standardize_distribution(parse_dataset_text_to_df(st.session_state.dist_raw_text or ""))
+                except Exception as e:
+                    st.error(f"Could not read the delta: {type(e).__name__}: {e}")
+                    delta = None
+                if delta is not None:
+                    base = st.session_state.dist_df
+                    dedup = st.session_state.get("dist_dedup_index")
+                    dedup_for = st.session_state.get("dist_dedup_for") or (None, None)
+                    if dedup is None or dedup_for[0] is not base or dedup_for[1] != tuple(dedup_key):
+                        dedup = RowHashIndex(distribution_row_hashes(base, dedup_key))
+                    df_new, extras_new, added, dupes = append_distribution(
+                        base, st.session_state.dist_extras, delta, delta_extras, dedup, dedup_key
+                    )
+                    if st.session_state.get("dist_cube_src") is base and len(added):
+                        cube, cells, n_upd, n_new = update_distribution_cube(
+                            st.session_state.dist_cube, st.session_state.get("dist_cube_cells"), added
+                        )
+                        st.session_state.dist_cube = cube
+                        st.session_state.dist_cube_cells = cells
+                        # cached graphs describe the old cube; appends only add nodes, so expanded ones stay
+                        st.session_state.dist_graph_memo = OrderedDict()
+                        st.session_state.dist_graph_src = cube
+                        st.session_state.dist_cube_index.extend(cube)
+                        if st.session_state.get("dist_row_index") is not None:
+                            st.session_state.dist_row_index.extend(df_new)
+                        st.session_state.dist_cube_src = df_new
+                    elif st.session_state.get("dist_cube_src") is base:
+                        st.session_state.dist_cube_src = df_new
+                    st.session_state.dist_df = df_new
+                    st.session_state.dist_extras = extras_new
+                    st.session_state.dist_dedup_index = dedup
+                    st.session_state.dist_dedup_for = (df_new, tuple(dedup_key))
+                    st.session_state.dist_cache_info = None
+                    st.session_state.dist_append_log.append({
+                        "ts": now_str(),
+                        "source": up.name if up is not None else "pasted text",
+                        "delta_rows": int(len(delta)),
+                        "appended": int(len(added)),
+                        "duplicates": dupes,
+                        "total_rows": int(len(df_new)),
+                        "ms": round((time.perf_counter() - t0) * 1000),
+                    })
+                    st.toast(f"Appended {len(added):,} rows ({dupes:,} duplicates skipped).", icon="➕")
+            if st.session_state.dist_append_log:
+                st.dataframe(pd.DataFrame(st.session_state.dist_append_log), use_container_width=True, hide_index=True)
+
+        with st.expander("🗄️ Dataset store (saved datasets)", expanded=False):
+            if not dataset_store_available():
+                st.info("Install `pyarrow` to save datasets to disk and load them back without re-parsing.")
+            else:
+                store = get_dataset_store()
+                st.caption(f"`{DATASET_STORE_DIR}` · Arrow IPC, partitioned by Deliverdate month, memory-mapped on load")
+                save_name = (st.session_state.dist_dataset_name or "").strip()
+                if st.button(
+                    f"💾 Save current dataset as “{save_name}”",
+                    use_container_width=True,
+                    disabled=st.session_state.dist_df is None or not save_name,
+                ):
+                    with st.spinner("Saving…"):
+                        entry = store.save(save_name, st.session_state.dist_df, st.session_state.dist_extras)
+                    st.toast(f"Saved {entry['rows']:,} rows in {len(entry['months'])} month partition(s).", icon="💾")
+                catalog = store.catalog()
+                if not catalog:
+                    st.caption("No saved datasets yet.")
+                else:
+                    st.dataframe(
+                        pd.DataFrame([
+                            {"name": k, "rows": v["rows"], "months": len(v["months"]), "from": v["date_min"], "to": v["date_max"],
+                             "MB": round(v["bytes"] / 1e6, 1), "saved": v["saved"]}
+                            for k, v in catalog.items()
+                        ]),
+                        use_container_width=True,
+                        hide_index=True,
+                    )
+                    names = list(catalog)
+                    pick = st.selectbox(
+                        "Dataset", names,
+                        index=names.index(save_name) if save_name in names else 0,
+                        key="store_pick",
+                    )
+                    entry = catalog[pick]
+                    months = [m for m in entry["months"] if m != DATASET_STORE_NO_MONTH]
+                    m_range = None
+                    if len(months) > 1:
+                        m_range = st.select_slider("Months to load", options=months, value=(months[0], months[-1]), key="store_months")
+                    load_cols = st.multiselect("Columns to load", STANDARD_COLS, default=STANDARD_COLS, key="store_cols")
+                    l1, l2 = st.columns(2)
+                    with l1:
+                        do_load = st.button("📂 Load", use_container_width=True, key="store_load")
+                    with l2:
+                        do_delete = st.button("🗑️ Delete", use_container_width=True, key="store_delete")
+                    if do_load:
+                        date_range = None
+                        if m_range and (m_range[0] != months[0] or m_range[1] != months[-1]):
+                            start = pd.Timestamp(f"{m_range[0]}-01")
+                            date_range = (start, pd.Timestamp(f"{m_range[1]}-01") + pd.offsets.MonthEnd(0))
+                        t0 = time.perf_counter()
+                        with st.spinner(f"Loading {pick}…"):
+                            df_std, extras, info = store.load(
+                                pick, date_range=date_range,
+                                columns=None if set(load_cols) >= set(STANDARD_COLS) else load_cols,
+                            )
+                        st.session_state.dist_df = df_std
+                        st.session_state.dist_extras = extras
+                        st.session_state.dist_dataset_name = pick
+                        st.session_state.dist_append_log = []
+                        st.session_state.dist_cache_info = {
+                            "tier": "store", "key": entry["dir"], "ms": (time.perf_counter() - t0) * 1000,
+                            "partitions": info["partitions"], "partitions_total": info["partitions_total"], "bytes": info["bytes"],
+                        }
+                        st.rerun()
+                    if do_delete:
+                        store.delete(pick)
+                        st.toast(f"Deleted {pick}.", icon="🗑️")
+                        st.rerun()
 
     with right_in:
         st.markdown(f"<div class='wow-card'><b>{t['dist_keep_prompt']}</b><br/>This stores the summary prompt per dataset name in session state.</div>", unsafe_allow_html=True)
@@ -1742,17 +5926,82 @@ with tab_distribution:
         # Preview
         st.markdown(f"#### 👀 {t['dist_preview']}")
         st.markdown(df_preview_markdown(df, n=20))
+        date_stats = df.attrs.get("deliverdate_formats")
+        if date_stats:
+            fmt_txt = " · ".join(f"`{f}` {date_stats[f]:,}" for f, _ in DELIVERDATE_FORMATS if date_stats.get(f))
+            extra = [f"{k} {date_stats[k]:,}" if isinstance(date_stats[k], int) else f"{k}: {date_stats[k]}"
+                     for k in ("fallback", "unparsed", "missing") if date_stats.get(k)]
+            st.caption(
+                f"Deliverdate formats: {fmt_txt or '—'}" + (" · " + " · ".join(extra) if extra else "")
+                + (" · format detection cached" if date_stats.get("cached_detection") else "")
+            )
+        extras_tbl = st.session_state.get("dist_extras")
+        mem_mb = df.memory_usage(deep=True).sum() / 1e6
+        st.caption(
+            f"In memory: {mem_mb:,.1f} MB · {len(DIST_CATEGORICAL_COLS)} dictionary-encoded columns · Number `{df['Number'].dtype}`"
+            + (f" · extras: {extras_tbl['field'].nunique()} unmapped fields, {len(extras_tbl):,} values" if extras_tbl is not None and len(extras_tbl) else "")
+        )
+        cache_info = st.session_state.get("dist_cache_info")
+        if cache_info:
+            if cache_info["tier"] == "store":
+                source = (
+                    f"🗄️ Loaded from dataset store ({cache_info['partitions']}/{cache_info['partitions_total']} month partitions, "
+                    f"{cache_info['bytes'] / 1e6:,.1f} MB mapped)"
+                )
+            elif cache_info["tier"] == "miss":
+                source = "🧪 Standardized and cached"
+            else:
+                source = f"⚡ Loaded from dataset cache ({cache_info['tier']})"
+            st.caption(source + f" in {cache_info['ms']:,.0f} ms · key `{cache_info['key']}`")
+
+        # Aggregate cube: built once per standardized dataset (appends update it in place); filters and
+        # charts below only touch it
+        if st.session_state.get("dist_cube_src") is not df:
+            t0 = time.perf_counter()
+            with st.spinner("Building aggregate cube…"):
+                st.session_state.dist_cube = build_distribution_cube(df)
+                st.session_state.dist_cube_index = DistributionFilterIndex(st.session_state.dist_cube)
+            st.session_state.dist_cube_src = df
+            st.session_state.dist_cube_cells = None
+            if st.session_state.sql_stream is not None:
+                st.session_state.sql_stream.close()  # it may hold the previous frame
+                st.session_state.sql_stream = None
+            st.session_state.dist_row_index = None
+            st.session_state.dist_cube_ms = (time.perf_counter() - t0) * 1000
+        cube = st.session_state.dist_cube
+        cube_index = st.session_state.dist_cube_index
+        drill_src = st.session_state.get("dist_drill_src")
+        if drill_src is not None and drill_src is not cube:
+            st.session_state.dist_drill_index = None  # stale after a new dataset or an append
+            st.session_state.dist_drill_src = None
+
+        def row_index() -> DistributionFilterIndex:
+            # raw-row index: only needed when a button asks for sample rows
+            if st.session_state.get("dist_row_index") is None:
+                st.session_state.dist_row_index = DistributionFilterIndex(df)
+            return st.session_state.dist_row_index
+
+        def drill_index() -> NodeDrillIndex:
+            # node info drill-down index: only needed once a network node is clicked
+            if st.session_state.get("dist_drill_index") is None:
+                st.session_state.dist_drill_index = NodeDrillIndex.from_frame(cube)
+                st.session_state.dist_drill_src = cube
+            return st.session_state.dist_drill_index
+        st.caption(
+            f"Aggregate cube: {len(cube):,} cells for {len(df):,} rows "
+            f"(built in {st.session_state.get('dist_cube_ms', 0):,.0f} ms)"
+        )
 
         # Filters
         st.markdown(f"#### 🎛️ {t['dist_filters']}")
-        opts = build_filter_options(df)
+        opts = build_filter_options(cube)
 
         f1, f2, f3, f4 = st.columns([1, 1, 1, 1])
         # Date range
         date_range = None
-        if "Deliverdate_dt" in df.columns and df["Deliverdate_dt"].notna().any():
-            dmin = df["Deliverdate_dt"].min()
-            dmax = df["Deliverdate_dt"].max()
+        if "Deliverdate_dt" in cube.columns and cube["Deliverdate_dt"].notna().any():
+            dmin = cube["Deliverdate_dt"].min()
+            dmax = cube["Deliverdate_dt"].max()
             with f1:
                 picked = st.date_input(
                     t["dist_date_range"],
@@ -1775,18 +6024,23 @@ with tab_distribution:
 
         sel_cus = st.multiselect(t["dist_customer"], opts["CustomerID"], default=[])
 
-        df_f = apply_filters(df, date_range, sel_sup, sel_cat, sel_lic, sel_cus)
+        # df_f is the filtered slice of the cube; raw rows are only gathered (via the row mask) when a
+        # summary / agent run needs sample records.
+        filters = (date_range, sel_sup, sel_cat, sel_lic, sel_cus)
+        cube_mask = cube_index.mask(*filters)
+        n_records = cube_index.count(cube_mask)
+        df_f = cube_index.take(cube_mask)
 
         # Quick stats
         s1, s2, s3, s4 = st.columns(4)
         with s1:
-            st.metric("Records", f"{len(df_f):,}")
+            st.metric("Records", f"{n_records:,}")
         with s2:
             st.metric("Units (Number)", f"{int(df_f['Number'].sum()):,}" if not df_f.empty else "0")
         with s3:
-            st.metric("Suppliers", f"{df_f['SupplierID'].replace('', pd.NA).dropna().nunique():,}" if not df_f.empty else "0")
+            st.metric("Suppliers", f"{df_f.loc[df_f['SupplierID'] != '', 'SupplierID'].nunique():,}" if not df_f.empty else "0")
         with s4:
-            st.metric("Customers", f"{df_f['CustomerID'].replace('', pd.NA).dropna().nunique():,}" if not df_f.empty else "0")
+            st.metric("Customers", f"{df_f.loc[df_f['CustomerID'] != '', 'CustomerID'].nunique():,}" if not df_f.empty else "0")
 
         st.markdown("---")
         st.markdown(f"#### 📈 {t['dist_viz']}")
@@ -1795,11 +6049,62 @@ with tab_distribution:
         g1, g2 = st.columns([1.2, 0.8], gap="large")
         with g1:
             st.markdown(f"##### 🕸️ {t['dist_network']}")
-            nodes, edges = build_network_graph(df_f, max_nodes_per_level=60)
+            # Graph memo: pruned network + layout, drawn elements and node summaries per (cube, filter state,
+            # pruning settings, expanded nodes); starts over when the cube changes (an append keeps the expanded nodes)
+            if st.session_state.get("dist_graph_src") is not cube:
+                st.session_state.dist_graph_memo = OrderedDict()
+                st.session_state.dist_graph_src = cube
+                st.session_state.dist_graph_expanded = []
+                st.session_state.dist_graph_clicked = None
+
+            def graph_memo(key, build):
+                memo = st.session_state.dist_graph_memo
+                if key in memo:
+                    memo.move_to_end(key)
+                    return memo[key]
+                memo[key] = value = build()
+                while len(memo) > DIST_GRAPH_MEMO_ENTRIES:
+                    memo.popitem(last=False)
+                return value
+
+            k1, k2, k3 = st.columns([1, 1, 1.2])
+            with k1:
+                graph_k = st.slider("Top-K per parent", 1, 50, DIST_GRAPH_TOP_PER_PARENT, key="dist_graph_k")
+            with k2:
+                graph_budget = st.number_input("Node budget", min_value=8, max_value=5000, value=DIST_GRAPH_NODE_BUDGET, step=20, key="dist_graph_budget")
+            with k3:
+                graph_view = st.radio("View", ["Expand on click", "Full network"], horizontal=True, key="dist_graph_view")
+            lod = graph_view == "Expand on click"
+            graph_key = (
+                tuple(date_range) if date_range else None, tuple(sel_sup), tuple(sel_cat), tuple(sel_lic), tuple(sel_cus),
+                int(graph_k), int(graph_budget),
+            )
+            nodes, edges, model = [], [], None
+            if not df_f.empty:
+                model = graph_memo(("model",) + graph_key, lambda: build_network_model(df_f, int(graph_k), int(graph_budget)))
+                expanded = tuple(st.session_state.dist_graph_expanded) if lod else None
+                nodes, edges = graph_memo(
+                    ("elements",) + graph_key + (expanded,),
+                    lambda: network_elements(model, None if expanded is None else list(expanded)),
+                )
             if nodes:
+                if lod:
+                    c1, c2 = st.columns([3, 1])
+                    with c1:
+                        st.caption(
+                            f"{len(nodes):,} of {int(model['present'].sum()):,} nodes shown · "
+                            "click a node to expand its neighbourhood"
+                        )
+                    with c2:
+                        if st.button("Collapse all", use_container_width=True, disabled=not st.session_state.dist_graph_expanded, key="dist_graph_collapse"):
+                            st.session_state.dist_graph_expanded = []
+                            # forget the last click too, so clicking that node again expands it
+                            st.session_state.dist_graph_clicked = None
+                            st.rerun()
+                # positions come from the server-side layout, so the browser does no layout work
                 config = Config(
                     directed=True,
-                    hierarchical=True,
+                    hierarchical=False,
                     physics=False,
                     height=520,
                     width=1000,
@@ -1808,8 +6113,22 @@ with tab_distribution:
                     collapsible=True,
                 )
                 selected = agraph(nodes=nodes, edges=edges, config=config)
+                if selected and selected != st.session_state.dist_graph_clicked:
+                    st.session_state.dist_graph_clicked = selected
+                    if lod and selected not in st.session_state.dist_graph_expanded:
+                        st.session_state.dist_graph_expanded.append(selected)
+                        st.rerun()
                 if selected:
-                    st.markdown(node_info(df_f, selected))
+                    def selected_info() -> str:
+                        # node info drill-down index, narrowed from the cube's once per filter state
+                        drill = graph_memo(("drill",) + graph_key[:5], lambda: drill_index().narrow(cube_mask))
+                        drawn: Dict[str, List[str]] = {}
+                        for nid in model["ids"]:
+                            typ, val = nid.split(":", 1)
+                            if val != DIST_GRAPH_OTHER:
+                                drawn.setdefault(typ, []).append(val)
+                        return node_info(drill, selected, drawn)
+                    st.markdown(graph_memo(("info",) + graph_key + (selected,), selected_info))
             else:
                 st.info("Network is empty after filters (or too sparse).")
 
@@ -1821,7 +6140,8 @@ with tab_distribution:
         g3, g4 = st.columns([1, 1], gap="large")
         with g3:
             st.markdown(f"##### ⏱️ {t['dist_timeseries']}")
-            st.plotly_chart(build_timeseries(df_f), use_container_width=True)
+            ts_granularity = st.radio("Granularity", DIST_TS_GRANULARITIES, horizontal=True, key="dist_ts_granularity")
+            st.plotly_chart(build_timeseries(df_f, ts_granularity), use_container_width=True)
         with g4:
             st.markdown(f"##### 🏆 {t['dist_top']}")
             fig_top_sup, fig_top_cus = build_top_bars(df_f)
@@ -1868,8 +6188,6 @@ with tab_distribution:
 
         # Build summary input pack (avoid dumping entire dataset)
         pack = dataset_stats_pack(df_f)
-        sample20 = df_f[STANDARD_COLS].head(20).to_dict(orient="records")
-        pack["sample_20_records"] = sample20
 
         # Resolve key for chosen model
         prov = infer_provider(sum_model)
@@ -1885,6 +6203,8 @@ with tab_distribution:
             if not chosen_key:
                 st.error(f"Missing API key for provider '{prov}'.")
             else:
+                row_mask = row_index().mask(*filters)
+                pack["sample_20_records"] = filtered_head(df, row_mask, 20)[STANDARD_COLS].to_dict(orient="records")
                 sys = "你是資深資料分析師與醫療器材供應鏈/追溯性顧問。請嚴謹、可稽核、用繁體中文。"
                 usr = (
                     f"{sum_prompt}\n\n"
@@ -1901,10 +6221,14 @@ with tab_distribution:
                         user_prompt=usr,
                         max_tokens=7000,   # keep summary within bounds
                         temperature=0.25,
+                        use_cache=st.session_state.llm_cache_enabled,
                     )
-                st.session_state.dist_summary_md = out
+                if meta.get("error"):
+                    st.error(str(meta["error"]))
+                else:
+                    st.session_state.dist_summary_md = out
                 st.session_state.execution_log.append(
-                    {"ts": now_str(), "agent": "Distribution-Summary", "output": out, "meta": meta}
+                    {"ts": now_str(), "agent": "Distribution-Summary", "chain": "distribution", "output": out, "meta": meta}
                 )
                 st.session_state.runs += 1
                 st.session_state.last_run_ts = now_str()
@@ -1928,18 +6252,9 @@ with tab_distribution:
         with colC:
             run_agent_btn = st.button("▶️ " + t["dist_run_selected_agent"], use_container_width=True, disabled=(selected_agent == "—"))
 
-        # Build dataset input for agent: stats + markdown preview
-        df_preview_md = df_f[STANDARD_COLS].head(50).to_markdown(index=False) if not df_f.empty else "_empty_"
-        agent_input = (
-            "以下為「已篩選後」的醫療器材配送資料摘要：\n\n"
-            f"- 資料集名稱: {ds_name}\n"
-            f"- 篩選後筆數: {len(df_f)}\n"
-            f"- 統計摘要(JSON):\n{json.dumps(dataset_stats_pack(df_f), ensure_ascii=False, indent=2)}\n\n"
-            "前 50 筆（Markdown Table）：\n\n"
-            f"{df_preview_md}\n"
-        )
-
         if run_agent_btn:
+            row_mask = row_index().mask(*filters)
+            agent_input = dataset_agent_input(filtered_head(df, row_mask, 50), ds_name, agg=df_f)
             openai_key, _ = get_api_key("OPENAI_API_KEY")
             gemini_key, _ = get_api_key("GEMINI_API_KEY")
             anthropic_key, _ = get_api_key("ANTHROPIC_API_KEY")
@@ -1954,14 +6269,188 @@ with tab_distribution:
                 overrides["provider"] = infer_provider(agent_model_override)
 
             with st.status(f"Running {selected_agent} on filtered dataset…", expanded=True) as status:
-                out, meta = run_agent(agent_conf, agent_input, overrides, resolved_keys)
-                st.markdown(out)
-                status.update(label=f"{selected_agent} Complete", state="complete")
-
-            st.session_state.execution_log.append({"ts": now_str(), "agent": selected_agent, "output": out, "meta": meta})
+                stream = run_agent_stream(agent_conf, agent_input, overrides, resolved_keys, use_cache=st.session_state.llm_cache_enabled)
+                notice = budget_notice(stream.meta)
+                if notice:
+                    st.info(notice)
+                st.write_stream(stream)
+                out, meta = stream.text, stream.meta
+                if stream.error:
+                    st.error(str(stream.error))
+                    status.update(label=f"{selected_agent} failed", state="error")
+                else:
+                    status.update(label=f"{selected_agent} Complete", state="complete")
+
+            st.session_state.execution_log.append({"ts": now_str(), "agent": selected_agent, "chain": "distribution", "output": out, "meta": meta})
             st.session_state.runs += 1
             st.session_state.last_run_ts = now_str()
 
+        with st.expander("📦 Batch run (offline bulk reports, ~50% cheaper)", expanded=False):
+            st.caption(
+                "Runs the chosen agents over the filtered dataset, optionally once per group, through the OpenAI / Anthropic "
+                "batch APIs (results within 24h). Other providers run interactively in the same background job."
+            )
+            b1, b2 = st.columns([1.4, 1.0])
+            with b1:
+                batch_agents = st.multiselect("Agents", agent_names, default=[], key="batch_agents")
+                batch_model = st.selectbox("Model override", ["(use agent default)"] + MODEL_CHOICES, index=0, key="batch_model")
+            with b2:
+                batch_split = st.selectbox("One report per", ["(whole filtered dataset)", "SupplierID", "CustomerID", "Category", "LicenseNo"], index=1, key="batch_split")
+                batch_max_groups = st.number_input("Max groups (largest first)", min_value=1, max_value=1000, value=50, step=1, key="batch_max_groups")
+                batch_transport = st.radio("Transport", list(BATCH_TRANSPORTS.keys()), index=0, key="batch_transport")
+
+            # (label, split value); rows for each group are only gathered on submit
+            if batch_split == "(whole filtered dataset)" or df_f.empty:
+                batch_groups = [(ds_name, None)]
+            else:
+                top = df_f.groupby(batch_split, observed=True)["Number"].sum().sort_values(ascending=False).head(int(batch_max_groups)).index
+                batch_groups = [(f"{ds_name} · {batch_split}={g}", g) for g in top]
+            st.caption(f"{len(batch_agents)} agent(s) × {len(batch_groups)} dataset(s) = {len(batch_agents) * len(batch_groups)} request(s)")
+
+            if st.button("📦 Submit batch", use_container_width=True, disabled=not batch_agents, key="batch_submit"):
+                openai_key, _ = get_api_key("OPENAI_API_KEY")
+                gemini_key, _ = get_api_key("GEMINI_API_KEY")
+                anthropic_key, _ = get_api_key("ANTHROPIC_API_KEY")
+                grok_key, _ = get_api_key("GROK_API_KEY")
+                resolved_keys = {"openai": openai_key, "gemini": gemini_key, "anthropic": anthropic_key, "grok": grok_key}
+
+                batch_overrides = {}
+                if batch_model != "(use agent default)":
+                    batch_overrides = {"model": batch_model, "provider": infer_provider(batch_model)}
+                by_name = {a.get("name"): a for a in all_agents}
+                rows_idx = row_index()
+                row_mask = rows_idx.mask(*filters)
+                if row_mask is None:
+                    row_mask = np.ones(len(df), dtype=bool)
+                group_inputs = []
+                for label, g in batch_groups:
+                    if g is None:
+                        group_inputs.append((label, dataset_agent_input(filtered_head(df, row_mask, 50), label, agg=df_f)))
+                    else:
+                        g_mask = row_mask & rows_idx.value_mask(batch_split, [g])
+                        group_inputs.append((label, dataset_agent_input(filtered_head(df, g_mask, 50), label, agg=df_f[df_f[batch_split] == g])))
+                items = [
+                    {"id": f"{name} · {label}", "agent_conf": by_name.get(name) or {}, "input": text, "overrides": batch_overrides}
+                    for label, text in group_inputs
+                    for name in batch_agents
+                ]
+                job_id = get_job_runner().submit_batch(
+                    items, resolved_keys, BATCH_TRANSPORTS[batch_transport], owner=st.session_state.job_owner
+                )
+                st.session_state.jobs.append(job_id)
+                st.session_state.active_job = job_id
+                st.query_params["job"] = job_id
+                st.query_params["job_key"] = st.session_state.job_owner
+                st.toast(f"Batch {job_id} submitted ({len(items)} requests). Progress is in the sidebar; results land in History.", icon="📦")
+
+        st.markdown("---")
+        st.markdown("#### 🧮 SQL (DuckDB)")
+        if not sql_engine_available():
+            st.info("Install `duckdb` to query the dataset with SQL.")
+        else:
+            store_names = list(get_dataset_store().catalog()) if dataset_store_available() else []
+            s1, s2 = st.columns([1.0, 1.4])
+            with s1:
+                sql_source = st.selectbox(
+                    "Source", ["Current dataset (in memory)"] + [f"🗄️ {n}" for n in store_names], key="sql_source",
+                )
+            with s2:
+                if sql_source.startswith("🗄️ "):
+                    st.caption(
+                        f"`{SQL_TABLE_NAME}`: the saved rows, scanned from their Arrow partitions "
+                        "(filter on `month = 'YYYY-MM'` to read only that partition)."
+                    )
+                else:
+                    st.caption(
+                        f"`{SQL_TABLE_NAME}`: the standardized rows ({len(df):,}) · `{SQL_TABLE_NAME}_cube`: the aggregate cube "
+                        f"({len(cube):,} cells; `Number`, `records` per supplier/category/license/customer/day). "
+                        "Dates: `Deliverdate` is the raw text, `Deliverdate_dt` the parsed timestamp."
+                    )
+
+            # SQL blocks from the latest agent outputs that contain any (e.g. 21-SQL 查詢產生器)
+            agent_sql = []
+            for entry in reversed(st.session_state.execution_log[-50:]):
+                blocks = extract_sql_blocks(entry.get("output") or "")
+                for i, q in enumerate(blocks):
+                    head = next((ln.strip() for ln in q.splitlines() if ln.strip()), "")
+                    agent_sql.append((f"{entry.get('agent', '?')} · {entry.get('ts', '')} · #{i + 1}  {head[:70]}", q))
+                if len(agent_sql) >= 100:
+                    break
+
+            def _load_agent_sql(q: str) -> None:
+                st.session_state.sql_query = q
+                st.session_state.sql_run_pending = True
+
+            if agent_sql:
+                a1, a2 = st.columns([3.0, 1.0])
+                with a1:
+                    pick_sql = st.selectbox(
+                        "SQL from agent outputs", range(len(agent_sql)), format_func=lambda i: agent_sql[i][0], key="sql_agent_pick",
+                    )
+                with a2:
+                    st.write("")
+                    st.button(
+                        "▶️ Run this query", use_container_width=True, key="sql_agent_run",
+                        on_click=_load_agent_sql, args=(agent_sql[pick_sql][1],),
+                    )
+
+            st.text_area("Query", key="sql_query", height=140)
+            do_sql = st.button("▶️ Run query", key="sql_run") or st.session_state.pop("sql_run_pending", False)
+            st.caption(
+                f"Read-only; one statement per run; cancelled after {SQL_TIMEOUT_S:g}s; "
+                f"results stream {SQL_PAGE_ROWS:,} rows per page."
+            )
+
+            if do_sql:
+                if st.session_state.sql_stream is not None:
+                    st.session_state.sql_stream.close()
+                st.session_state.sql_stream = None
+                st.session_state.sql_page = 0
+                st.session_state.sql_error = None
+                if sql_source.startswith("🗄️ "):
+                    rows = get_dataset_store().arrow_dataset(sql_source[len("🗄️ "):])
+                    tables = {f"{SQL_TABLE_NAME}_rows": rows}
+                    views = {SQL_TABLE_NAME: f"SELECT * EXCLUDE (_row) FROM {SQL_TABLE_NAME}_rows"}
+                else:
+                    tables = {SQL_TABLE_NAME: df, f"{SQL_TABLE_NAME}_cube": cube}
+                    views = None
+                try:
+                    with st.spinner("Running query…"):
+                        stream = SqlResultStream(st.session_state.sql_query, tables, views=views)
+                        stream.page(0)
+                    st.session_state.sql_stream = stream
+                except Exception as e:
+                    st.session_state.sql_error = f"{type(e).__name__}: {e}"
+
+            if st.session_state.sql_error:
+                st.error(st.session_state.sql_error)
+            stream = st.session_state.sql_stream
+            if stream is not None:
+                page_i = st.session_state.sql_page
+                try:
+                    page_df = stream.page(page_i)
+                except Exception as e:
+                    st.session_state.sql_stream = None
+                    st.session_state.sql_error = f"{type(e).__name__}: {e}"
+                    st.error(st.session_state.sql_error)
+                else:
+                    def _sql_goto(i: int) -> None:
+                        st.session_state.sql_page = i
+
+                    has_next = stream.has_page(page_i + 1)
+                    first = page_i * stream.page_rows
+                    p1, p2, p3 = st.columns([1, 3, 1])
+                    with p1:
+                        st.button("◀ Prev", use_container_width=True, disabled=page_i == 0, key="sql_prev", on_click=_sql_goto, args=(page_i - 1,))
+                    with p2:
+                        st.caption(
+                            (f"Page {page_i + 1} · rows {first + 1:,}–{first + len(page_df):,}" if len(page_df) else "No rows")
+                            + ("" if has_next else " (end of result)")
+                            + f" · {stream.ms:,.0f} ms in DuckDB"
+                        )
+                    with p3:
+                        st.button("Next ▶", use_container_width=True, disabled=not has_next, key="sql_next", on_click=_sql_goto, args=(page_i + 1,))
+                    st.dataframe(page_df, use_container_width=True, hide_index=True)
 
 # =========================
 # AI Note Keeper Tab (original)
@@ -2000,10 +6489,15 @@ with tab_notes:
     st.markdown(f"#### ✨ {t['ai_magics']}")
     magic1, magic2, magic3, magic4, magic5, magic6 = st.columns(6)
 
-    def note_ai(system_prompt: str, user_prompt: str) -> str:
+    # Live area under the magic buttons; magics stream their output here.
+    note_live = st.empty()
+
+    def note_ai(system_prompt: str, user_prompt: str, target=None) -> Optional[str]:
+        """Streams the completion and returns it, or shows the error and returns None."""
         if not note_key:
-            return f"(Missing API key for provider '{provider}'.)"
-        out, _meta = call_llm(
+            st.error(f"Missing API key for provider '{provider}'.")
+            return None
+        stream = call_llm_stream(
             provider=provider,
             model=note_model,
             api_key=note_key,
@@ -2011,10 +6505,24 @@ with tab_notes:
             user_prompt=user_prompt,
             max_tokens=int(note_max),
             temperature=float(note_temp),
+            use_cache=st.session_state.llm_cache_enabled,
+        )
+        target = target if target is not None else note_live
+        with target.container():
+            st.write_stream(stream)
+        # In Markdown view the final note is rendered below; drop the live copy.
+        if target is note_live and view_mode == t["markdown"]:
+            note_live.empty()
+        st.session_state.execution_log.append(
+            {"ts": now_str(), "agent": "Note-Keeper", "chain": "notes", "output": stream.text, "meta": stream.meta}
         )
-        st.session_state.note_last_ai = out
         st.session_state.runs += 1
         st.session_state.last_run_ts = now_str()
+        if stream.error:
+            st.error(str(stream.error))
+            return None
+        out = stream.text
+        st.session_state.note_last_ai = out
         return out
 
     with magic1:
@@ -2030,13 +6538,17 @@ with tab_notes:
                 "- If the note contains tabular data, use Markdown tables\n\n"
                 f"NOTE:\n{st.session_state.note_text}"
             )
-            st.session_state.note_markdown = note_ai(sys, usr)
+            out = note_ai(sys, usr)
+            if out is not None:
+                st.session_state.note_markdown = out
 
     with magic2:
         if st.button("🧠", help=t["magic_summary"], use_container_width=True):
             sys = "You summarize notes accurately."
             usr = f"Summarize this note in Markdown with sections: Key Points, Risks, Open Questions.\n\n{st.session_state.note_text}"
-            st.session_state.note_markdown = note_ai(sys, usr)
+            out = note_ai(sys, usr)
+            if out is not None:
+                st.session_state.note_markdown = out
 
     with magic3:
         if st.button("✅", help=t["magic_actions"], use_container_width=True):
@@ -2047,7 +6559,9 @@ with tab_notes:
                 "If owner/due/status not present, leave blank.\n\n"
                 f"{st.session_state.note_text}"
             )
-            st.session_state.note_markdown = note_ai(sys, usr)
+            out = note_ai(sys, usr)
+            if out is not None:
+                st.session_state.note_markdown = out
 
     with magic4:
         if st.button("🃏", help=t["magic_flashcards"], use_container_width=True):
@@ -2060,7 +6574,9 @@ with tab_notes:
                 "  **A:** ...\n\n"
                 f"{st.session_state.note_text}"
             )
-            st.session_state.note_markdown = note_ai(sys, usr)
+            out = note_ai(sys, usr)
+            if out is not None:
+                st.session_state.note_markdown = out
 
     with magic5:
         if st.button("🌐", help=t["magic_translate"], use_container_width=True):
@@ -2071,7 +6587,9 @@ with tab_notes:
                 "Preserve formatting as Markdown.\n\n"
                 f"{st.session_state.note_text}"
             )
-            st.session_state.note_markdown = note_ai(sys, usr)
+            out = note_ai(sys, usr)
+            if out is not None:
+                st.session_state.note_markdown = out
 
     with magic6:
         st.button("🔦", help=t["magic_keywords"], use_container_width=True)
@@ -2114,8 +6632,7 @@ with tab_notes:
             sys = "You are a helpful assistant. Use the note as the primary context."
             note_context = st.session_state.note_markdown or st.session_state.note_text
             usr = f"NOTE CONTEXT:\n{note_context}\n\nUSER REQUEST:\n{user_q}\n\nReturn in Markdown."
-            ans = note_ai(sys, usr)
-            st.markdown(ans)
+            note_ai(sys, usr, target=st.empty())
 
 
 # =========================
@@ -2126,10 +6643,44 @@ with tab_history:
     if not st.session_state.execution_log:
         st.info("No runs yet.")
     else:
+        with st.expander("📊 Telemetry (latency · tokens · cost)", expanded=True):
+            tel = build_telemetry_frame(st.session_state.execution_log)
+            m1, m2, m3, m4 = st.columns(4)
+            with m1:
+                st.metric("Calls", f"{len(tel):,}", help=f"{int(tel['failed'].sum())} failed")
+            with m2:
+                st.metric("Tokens in / out", f"{int(tel['input_tokens'].sum()):,} / {int(tel['output_tokens'].sum()):,}")
+            with m3:
+                st.metric("Cost (USD, list price)", f"${tel['cost_usd'].sum():.4f}")
+            with m4:
+                st.metric("Cache hit rate", f"{tel['cache_hit'].mean() * 100:.0f}%")
+            est_share = (tel["usage_source"] == "estimate").mean()
+            if est_share > 0:
+                st.caption(f"{est_share * 100:.0f}% of calls use locally estimated token counts (provider reported no usage).")
+            st.markdown("**Per model**")
+            st.dataframe(telemetry_rollup(tel, "model"), use_container_width=True, hide_index=True)
+            st.markdown("**Per agent**")
+            st.dataframe(telemetry_rollup(tel, "agent"), use_container_width=True, hide_index=True)
+            st.markdown("**Per chain / run**")
+            st.dataframe(telemetry_rollup(tel, "chain"), use_container_width=True, hide_index=True)
+
         for rec in reversed(st.session_state.execution_log[-200:]):
             meta = rec.get("meta", {}) or {}
-            header = f"{rec.get('ts','')} — {rec.get('agent','')} ({meta.get('provider','')}/{meta.get('model','')})"
+            header = f"{rec.get('ts','')} — {rec.get('item') or rec.get('agent','')} ({meta.get('provider','')}/{meta.get('model','')})"
+            if (meta.get("batch") or {}).get("mode") == "batch":
+                header += " · 📦 batch"
+            if meta.get("cache") == "hit":
+                header += f" · ⚡ cache hit ({meta.get('cache_tier', '')})"
+            if meta.get("error"):
+                header += " · ⚠️ failed"
+            notice = budget_notice(meta)
+            if notice:
+                header += " · 🗜️ compacted"
             with st.expander(header, expanded=False):
+                if meta.get("error"):
+                    st.error(str(meta["error"]))
+                if notice:
+                    st.info(notice)
                 st.markdown(rec.get("output", ""))
 
 
@@ -2162,4 +6713,92 @@ with tab_settings:
                     st.error(f"{t['invalid_yaml']}: {e}")
 
         with c2:
-            st.caption("Tip: Each agent can include: name, provider(optional), model, system_prompt, prompt, temperature, max_tokens.")
+            st.caption("Tip: Each agent can include: name, provider(optional), model, system_prompt, prompt, temperature, max_tokens, depends_on(optional).")
+
+    with st.expander("🔌 LLM client pool", expanded=False):
+        pool_stats = get_llm_client_pool().stats()
+        st.caption(
+            f"Timeout {LLM_HTTP_TIMEOUT_S:.0f}s (connect {LLM_HTTP_CONNECT_TIMEOUT_S:.0f}s) · "
+            f"max connections {LLM_HTTP_MAX_CONNECTIONS} / keep-alive {LLM_HTTP_MAX_KEEPALIVE} · "
+            f"idle eviction {LLM_CLIENT_IDLE_TTL_S:.0f}s · max clients {LLM_CLIENT_MAX_ENTRIES}"
+        )
+        p1, p2, p3 = st.columns(3)
+        with p1:
+            st.metric("Pool hits", pool_stats["hits"])
+        with p2:
+            st.metric("Pool misses", pool_stats["misses"])
+        with p3:
+            st.metric("Evictions", pool_stats["evictions"])
+        if pool_stats["clients"]:
+            st.dataframe(pd.DataFrame(pool_stats["clients"]), use_container_width=True, hide_index=True)
+        if st.button("♻️ Reset client pool", use_container_width=True):
+            get_llm_client_pool().clear()
+            st.toast("Client pool cleared.", icon="♻️")
+
+    with st.expander("🚦 Rate limits & retries", expanded=False):
+        sched_stats = get_llm_scheduler().stats()
+        st.caption(
+            f"Up to {LLM_MAX_RETRIES} retries with exponential backoff + jitter (base {LLM_BACKOFF_BASE_S:g}s, cap {LLM_BACKOFF_MAX_S:g}s); "
+            f"Retry-After is honored; queue wait limit {LLM_QUEUE_TIMEOUT_S:.0f}s."
+        )
+        r1, r2, r3 = st.columns(3)
+        with r1:
+            st.metric("Throttled waits", sched_stats["waits"])
+        with r2:
+            st.metric("Retries", sched_stats["retries"])
+        with r3:
+            st.metric("429 responses", sched_stats["rate_limited"])
+        st.dataframe(
+            pd.DataFrame([{"provider": p, **lim} for p, lim in PROVIDER_RATE_LIMITS.items()]),
+            use_container_width=True,
+            hide_index=True,
+        )
+        if sched_stats["buckets"]:
+            st.dataframe(pd.DataFrame(sched_stats["buckets"]), use_container_width=True, hide_index=True)
+
+    with st.expander("⚡ LLM response cache", expanded=False):
+        cache_stats = get_llm_response_cache().stats()
+        st.caption(
+            f"{'Enabled' if st.session_state.llm_cache_enabled else 'Disabled'} for this session (sidebar toggle) · "
+            f"TTL {LLM_CACHE_TTL_S / 3600:.0f}h · disk cap {LLM_CACHE_MAX_BYTES / 1e6:.0f} MB · memory {LLM_CACHE_MEMORY_ENTRIES} entries"
+        )
+        q1, q2, q3, q4 = st.columns(4)
+        with q1:
+            st.metric("Hits (memory / disk)", f"{cache_stats['hits_memory']} / {cache_stats['hits_disk']}")
+        with q2:
+            st.metric("Misses", cache_stats["misses"])
+        with q3:
+            st.metric("Entries on disk", f"{cache_stats['disk_entries']:,}")
+        with q4:
+            st.metric("Disk size", f"{cache_stats['disk_bytes'] / 1e6:.1f} MB")
+        if st.button("🗑️ Clear response cache", use_container_width=True):
+            get_llm_response_cache().clear()
+            st.toast("Response cache cleared.", icon="🗑️")
+
+    with st.expander("🗂️ Dataset cache", expanded=False):
+        ds_stats = get_dataset_cache().stats()
+        st.caption(
+            f"Standardized datasets by content hash · memory cap {DATASET_CACHE_MEMORY_BYTES // (1024 * 1024)} MB · "
+            + (f"spill `{DATASET_CACHE_DIR}` (cap {DATASET_CACHE_MAX_BYTES // (1024 * 1024)} MB)" if DATASET_CACHE_SPILL else "spill disabled")
+        )
+        d1, d2, d3, d4 = st.columns(4)
+        with d1:
+            st.metric("Hits (memory / disk)", f"{ds_stats['hits_memory']} / {ds_stats['hits_disk']}")
+        with d2:
+            st.metric("Misses", ds_stats["misses"])
+        with d3:
+            st.metric("Evictions (memory / disk)", f"{ds_stats['evictions_memory']} / {ds_stats['evictions_disk']}")
+        with d4:
+            st.metric("Entries (memory / disk)", f"{ds_stats['memory_entries']} / {ds_stats['disk_entries']}")
+        st.caption(f"In memory {ds_stats['memory_bytes'] / 1e6:,.1f} MB · on disk {ds_stats['disk_bytes'] / 1e6:,.1f} MB")
+        if st.button("🗑️ Clear dataset cache", use_container_width=True):
+            get_dataset_cache().clear()
+            st.toast("Dataset cache cleared.", icon="🗑️")
+
+    with st.expander("🧵 Background jobs", expanded=False):
+        job_stats = get_job_runner().stats()
+        st.caption(f"{JOB_WORKERS} worker thread(s) · state kept in `{JOBS_DIR}` (last {JOB_RETENTION} finished jobs) · UI polls every {JOB_POLL_S:g}s")
+        j1, j2, j3, j4, j5 = st.columns(5)
+        for col, key in zip((j1, j2, j3, j4, j5), ("queued", "running", "done", "failed", "cancelled")):
+            with col:
+                st.metric(key.capitalize(), job_stats[key])
@@ -0,0 +1,21 @@
+import os
+import logging
+import warnings
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+# app.py is a Streamlit script: everything above the session view is definitions (plus bare-mode
+# session init), so tests execute that part and use the resulting namespace.
+APP_UI_MARKER = "# =========================\n# Background jobs (session view)"
+
+
+@pytest.fixture(scope="session")
+def app():
+    warnings.filterwarnings("ignore")
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    with open(APP_PATH, "r", encoding="utf-8") as f:
+        src = f.read()
+    ns = {"__name__": "app_under_test", "__file__": APP_PATH}
+    exec(compile(src[: src.index(APP_UI_MARKER)], APP_PATH, "exec"), ns)
+    return ns
@@ -0,0 +1,68 @@
+import pandas as pd
+
+
+def _raw(start, n, suppliers=("S1", "S2"), days=5):
+    ids = range(start, start + n)
+    return pd.DataFrame({
+        "SupplierID": [suppliers[k % len(suppliers)] for k in ids],
+        "Category": ["Stent" if k % 3 else "Catheter" for k in ids],
+        "LicenseNo": ["L1"] * n,
+        "CustomerID": [f"C{k % 4}" for k in ids],
+        "Deliverdate": [f"202401{1 + k % days:02d}" for k in ids],
+        "UDID": [f"U{k}" for k in ids],
+        "Number": [1 + k % 5 for k in ids],
+    })
+
+
+def _cube_table(cube):
+    dims = ["SupplierID", "Category", "LicenseNo", "CustomerID", "Deliverdate_dt"]
+    out = cube[dims + ["Number", "records"]].astype({c: str for c in dims}).astype({"Number": int, "records": int})
+    return out.sort_values(dims).reset_index(drop=True)
+
+
+def _base(app, n=40):
+    base, extras = app["standardize_distribution"](_raw(0, n))
+    dedup = app["RowHashIndex"](app["distribution_row_hashes"](base, app["DIST_DEDUP_KEY"]))
+    return base, extras, dedup
+
+
+def test_dedup_counts_within_and_across_deltas(app):
+    base, extras, dedup = _base(app)
+    # rows 30..39 already exist; 40..49 are new, each listed twice in the delta
+    raw = pd.concat([_raw(30, 20), _raw(40, 10)], ignore_index=True)
+    delta, delta_extras = app["standardize_distribution"](raw)
+    df, extras, kept, dupes = app["append_distribution"](base, extras, delta, delta_extras, dedup, app["DIST_DEDUP_KEY"])
+    assert (len(kept), dupes) == (10, 20)
+    assert len(df) == 50 and df["UDID"].is_unique
+    # a second delta repeating the first one is dropped entirely
+    again, _ = app["standardize_distribution"](_raw(40, 10))
+    df2, _, kept2, dupes2 = app["append_distribution"](df, extras, again, None, dedup, app["DIST_DEDUP_KEY"])
+    assert (len(kept2), dupes2, len(df2)) == (0, 10, 50)
+
+
+def test_incremental_cube_matches_full_rebuild(app):
+    base, extras, dedup = _base(app)
+    cube = app["build_distribution_cube"](base)
+    cells = None
+    # the second delta brings a supplier and dates the base vocabulary has not seen
+    for raw in (_raw(20, 40), _raw(100, 15, suppliers=("S9",), days=9)):
+        delta, delta_extras = app["standardize_distribution"](raw)
+        base, extras, kept, _ = app["append_distribution"](base, extras, delta, delta_extras, dedup, app["DIST_DEDUP_KEY"])
+        cube, cells, updated, added = app["update_distribution_cube"](cube, cells, kept)
+    full = app["build_distribution_cube"](base)
+    pd.testing.assert_frame_equal(_cube_table(cube), _cube_table(full))
+    assert cube.attrs["source_rows"] == len(base) == 75
+
+
+def test_row_hash_index_runs(app):
+    import numpy as np
+
+    rng = np.random.default_rng(3)
+    hashes = rng.choice(np.iinfo(np.int64).max, 5000, replace=False).astype(np.uint64)
+    idx = app["RowHashIndex"](hashes[:1000])
+    for lo in range(1000, 5000, 250):
+        idx.add(hashes[lo:lo + 250], np.arange(lo, lo + 250))
+    assert len(idx) == 5000 and len(idx.runs) <= 6
+    np.testing.assert_array_equal(idx.lookup(hashes[::-1]), np.arange(5000)[::-1])
+    missing = np.array([1, 2, 3], dtype=np.uint64)
+    assert (idx.lookup(missing) == -1).all()
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+KEYS = {"openai": "sk-test", "anthropic": "sk-ant-test", "gemini": "gm-test", "grok": "xai-test"}
+
+
+def _item(item_id, model, text="hello batch"):
+    return {"id": item_id, "agent_conf": {"name": item_id.split(" · ")[0], "model": model, "prompt": "{input}"},
+            "input": text, "overrides": {}}
+
+
+def test_mock_batch_results_and_batch_pricing(app):
+    items = [_item("A · g1", "gpt-4o-mini"), _item("B · g1", "claude-3-5-haiku-latest")]
+    factory = lambda provider, key: app["MockBatchTransport"](provider, polls=2)
+    res = app["run_agent_batch"](items, KEYS, factory, poll_s=0)
+    assert set(res) == {"A · g1", "B · g1"}
+    for item_id, (text, meta) in res.items():
+        assert text.startswith("[mock ")
+        assert not meta.get("error")
+        assert meta["batch"]["mode"] == "batch"
+        full = app["estimate_cost_usd"](meta["model"], meta["usage"])
+        assert meta["cost_usd"] == pytest.approx(full * app["BATCH_PRICE_FACTOR"], abs=1e-6)
+
+
+def test_mock_batch_failed_ids(app):
+    items = [_item("A · g1", "gpt-4o-mini"), _item("A · g2", "gpt-4o-mini")]
+    factory = lambda provider, key: app["MockBatchTransport"](provider, fail_ids=("req-1",))
+    res = app["run_agent_batch"](items, KEYS, factory, poll_s=0)
+    assert res["A · g1"][0] and not res["A · g1"][1].get("error")
+    assert res["A · g2"][0] == ""
+    assert res["A · g2"][1]["error"].kind == "batch_failed"
+
+
+def test_cancel_cancels_provider_batch(app):
+    submitted = []
+
+    class Recording(app["MockBatchTransport"]):
+        def submit(self, jsonl):
+            submitted.append(super().submit(jsonl))
+            return submitted[-1]
+
+    cancel = threading.Event()
+    cancel.set()
+    factory = lambda provider, key: Recording(provider, polls=10 ** 6)
+    res = app["run_agent_batch"]([_item("A · g1", "gpt-4o-mini")], KEYS, factory, poll_s=0, cancel_event=cancel)
+    assert res["A · g1"][1]["error"].kind == "cancelled"
+    store = app["get_mock_batch_store"]()["batches"]
+    assert submitted and all(store[batch_id]["cancelled"] for batch_id in submitted)
+
+
+def test_batches_submitted_before_interactive_fallback(app, monkeypatch):
+    order = []
+
+    class Recording(app["MockBatchTransport"]):
+        def submit(self, jsonl):
+            order.append("submit")
+            return super().submit(jsonl)
+
+    def fake_call_llm(**kwargs):
+        order.append("interactive")
+        return "interactive answer", {"provider": kwargs["provider"], "model": kwargs["model"]}
+
+    monkeypatch.setitem(app, "call_llm", fake_call_llm)
+    items = [_item("G · g1", "gemini-2.5-flash"), _item("A · g1", "gpt-4o-mini")]
+    res = app["run_agent_batch"](items, KEYS, lambda p, k: Recording(p), poll_s=0)
+    assert order == ["submit", "interactive"]
+    assert res["G · g1"][1]["batch"]["mode"] == "interactive"
+
+
+def _wait(runner, job_id, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = runner.get(job_id)
+        if job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} still {runner.get(job_id)['status']}")
+
+
+def test_batch_polling_does_not_hold_a_job_worker(app, tmp_path):
+    runner = app["JobRunner"](str(tmp_path), workers=1, batch_poll_s=0.05)
+    slow = lambda provider, key: app["MockBatchTransport"](provider, polls=40)
+    batch_id = runner.submit_batch([_item("A · g1", "gpt-4o-mini")], KEYS, slow)
+    time.sleep(0.2)
+    other = runner._enqueue("dag", ["x"], {}, "", lambda job_id, cancel: {})
+    assert _wait(runner, other, timeout=1.0)["status"] == "done"
+    assert runner.get(batch_id)["status"] == "running"
+    job = _wait(runner, batch_id)
+    assert job["status"] == "done" and job["outputs"]["A · g1"].startswith("[mock ")
+
+
+def test_batch_results_are_written_in_bulk(app, tmp_path, monkeypatch):
+    monkeypatch.setitem(app, "JOB_PERSIST_INTERVAL_S", 3600.0)
+    runner = app["JobRunner"](str(tmp_path), workers=1, batch_poll_s=0.05)
+    writes = []
+    persist = runner._persist
+    runner._persist = lambda job: (writes.append(job["id"]), persist(job))
+    items = [_item(f"A · g{i}", "gpt-4o-mini") for i in range(200)]
+    job_id = runner.submit_batch(items, KEYS, lambda provider, key: app["MockBatchTransport"](provider, polls=2))
+    job = _wait(runner, job_id)
+    assert job["status"] == "done" and len(job["outputs"]) == 200
+    assert len(writes) < 20
+    with open(os.path.join(str(tmp_path), f"{job_id}.json"), encoding="utf-8") as f:
+        assert len(json.load(f)["outputs"]) == 200
+
+
+def _persisted_batch_job(app, jobs_dir, transport_name, polls=1):
+    transport = app["MockBatchTransport"]("openai", polls=polls)
+    body = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "hi"}]}
+    batch_id = transport.submit(json.dumps({"custom_id": "req-0", "body": body}))
+    call = {"agent": "A", "provider": "openai", "model": "gpt-4o-mini", "system_prompt": "", "user_prompt": "hi",
+            "max_tokens": 100, "temperature": 0.2, "budget": {}}
+    job = {"id": "batch-restart", "owner": "", "mode": "batch", "agents": ["A · g1", "B · g1"], "deps": {},
+           "status": "running", "created": "", "started": "", "finished": None, "running": ["A · g1", "B · g1"],
+           "outputs": {}, "metas": {}, "timeline": [], "wall_s": 0.0, "sum_s": 0.0, "error": None,
+           "transport": transport_name,
+           "batches": {"openai": {"id": batch_id, "status": "in_progress", "done": False, "custom": {"req-0": "A · g1"},
+                                  "calls": {"A · g1": call}, "submitted": time.time() - 60}}}
+    with open(os.path.join(jobs_dir, "batch-restart.json"), "w", encoding="utf-8") as f:
+        json.dump(job, f)
+
+
+def test_restart_resumes_persisted_mock_batches(app, tmp_path):
+    _persisted_batch_job(app, str(tmp_path), "Mock (local, no API calls)", polls=3)
+    runner = app["JobRunner"](str(tmp_path), workers=1, batch_poll_s=0.05)
+    job = _wait(runner, "batch-restart")
+    assert job["status"] == "done"
+    assert job["outputs"]["A · g1"] == "[mock gpt-4o-mini] hi"
+    # the interactive item of the old process is gone; it is reported, not left pending
+    assert job["metas"]["B · g1"]["error"].kind == "cancelled"
+
+
+def test_unknown_mock_batch_fails_its_items(app, tmp_path):
+    _persisted_batch_job(app, str(tmp_path), "Mock (local, no API calls)")
+    with open(os.path.join(str(tmp_path), "batch-restart.json"), encoding="utf-8") as f:
+        job = json.load(f)
+    job["batches"]["openai"]["id"] = "mock-openai-from-a-previous-process"
+    with open(os.path.join(str(tmp_path), "batch-restart.json"), "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    runner = app["JobRunner"](str(tmp_path), workers=1, batch_poll_s=0.05)
+    job = _wait(runner, "batch-restart")
+    assert job["status"] == "done" and job["metas"]["A · g1"]["error"]
+
+
+def test_restart_waits_for_a_key_then_resumes(app, tmp_path, monkeypatch):
+    def provider_transport(provider, api_key):
+        assert api_key == "sk-owner"
+        return app["MockBatchTransport"](provider)
+
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setitem(app, "provider_batch_transport", provider_transport)
+    monkeypatch.setitem(app["BATCH_TRANSPORTS"], "Provider batch API", provider_transport)
+    _persisted_batch_job(app, str(tmp_path), "Provider batch API")
+    runner = app["JobRunner"](str(tmp_path), workers=1, batch_poll_s=0.05)
+    time.sleep(0.2)
+    job = runner.get("batch-restart")
+    assert job["status"] == "running" and job["awaiting_keys"] == ["openai"]
+    runner.resume("batch-restart", {"openai": "sk-owner"})
+    job = _wait(runner, "batch-restart")
+    assert job["status"] == "done" and job["outputs"]["A · g1"] == "[mock gpt-4o-mini] hi"
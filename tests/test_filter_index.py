@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def _frame(app):
+    rng = np.random.default_rng(7)
+    n = 400
+    dates = pd.Series(pd.date_range("2024-01-01", periods=30, freq="D").strftime("%Y%m%d"))
+    raw = pd.DataFrame({
+        "SupplierID": rng.choice(["S1", "S2", "S3"], n),
+        "Category": rng.choice(["Stent", "Catheter", "", None], n),
+        "LicenseNo": rng.choice(["L1", "L2"], n),
+        "CustomerID": rng.choice(["C1", "C2", "C3", "C4"], n),
+        # unparseable and missing dates become NaT
+        "Deliverdate": rng.choice(list(dates) + ["not a date", None], n),
+        "Number": rng.integers(1, 9, n),
+    })
+    return app["standardize_distribution"](raw)[0]
+
+
+FILTERS = [
+    (None, [], [], [], []),
+    ((pd.Timestamp("2024-01-05"), pd.Timestamp("2024-01-12")), [], [], [], []),
+    ((pd.Timestamp("2024-01-05 18:00"), pd.Timestamp("2024-01-05 06:00")), ["S1"], [], [], []),
+    (None, ["S2", "S3"], ["Stent"], [], []),
+    (None, [], [""], [], []),
+    (None, [], ["Missing category"], [], []),
+    ((pd.Timestamp("2024-01-01"), pd.Timestamp("2024-01-30")), ["S1"], ["Catheter", "Stent"], ["L2"], ["C1", "C4"]),
+]
+
+
+@pytest.mark.parametrize("flt", FILTERS)
+@pytest.mark.parametrize("on_cube", [False, True], ids=["rows", "cube"])
+def test_index_mask_matches_filter_mask(app, flt, on_cube):
+    df = _frame(app)
+    assert df["Deliverdate_dt"].isna().any()
+    if on_cube:
+        df = app["build_distribution_cube"](df)
+    expected = app["distribution_filter_mask"](df, *flt)
+    got = app["DistributionFilterIndex"](df).mask(*flt)
+    if expected is None:
+        assert got is None
+    else:
+        np.testing.assert_array_equal(got, expected)
+
+
+def test_extended_index_matches_fresh_index(app):
+    df = _frame(app)
+    idx = app["DistributionFilterIndex"](df.iloc[:250])
+    idx.extend(df)
+    for flt in FILTERS:
+        expected = app["distribution_filter_mask"](df, *flt)
+        got = idx.mask(*flt)
+        assert (got is None) if expected is None else np.array_equal(got, expected)
+    assert idx.count(None) == len(df)
@@ -0,0 +1,41 @@
+import io
+import json
+
+import pandas as pd
+import pytest
+
+RECORDS = [{"SupplierID": "S1", "Number": 3}, {"SupplierID": "S2", "Number": 5}, {"SupplierID": "S1", "Number": 1}]
+
+
+def _chunks(app, payload, name, chunk_rows=2):
+    return list(app["iter_upload_chunks"](io.BytesIO(payload.encode("utf-8")), name, chunk_rows=chunk_rows))
+
+
+@pytest.mark.parametrize("payload", [
+    json.dumps({"data": RECORDS}, separators=(",", ":")),
+    json.dumps({"records": RECORDS}),
+    json.dumps(RECORDS),
+    json.dumps({"SupplierID": ["S1", "S2", "S1"], "Number": [3, 5, 1]}),
+    "\n".join(json.dumps(r) for r in RECORDS) + "\n",
+], ids=["compact-envelope", "envelope", "array", "dict-of-lists", "ndjson"])
+def test_json_shapes_yield_records(app, payload):
+    df = pd.concat(_chunks(app, payload, "upload.json"), ignore_index=True)
+    assert list(df["SupplierID"]) == ["S1", "S2", "S1"]
+    assert list(df["Number"].astype(int)) == [3, 5, 1]
+
+
+def test_arrow_failure_mid_file_restarts_with_pandas(app, monkeypatch):
+    monkeypatch.setitem(app, "CSV_BLOCK_BYTES", 16 * 1024)
+    # quoted multi-line notes: records and physical lines no longer line up
+    notes = ["first\nsecond" if i % 100 == 0 else "n" for i in range(6000)]
+    lines = ["SupplierID,CustomerID,Number,Note"] + [f'S{i % 7},C{i},{1 + i % 3},"{notes[i]}"' for i in range(6000)]
+    # invalid UTF-8 far past the first block: pyarrow has already yielded chunks when it fails
+    lines[5001] = 'S\xff,C5000,2,"n"'
+    lines[300] += "\n"  # a blank line, skipped by the CSV readers but not by a line count
+    payload = ("\n".join(lines) + "\n").encode("latin-1")
+    progress = []
+    df, _ = app["ingest_distribution_upload"](io.BytesIO(payload), "upload.csv", chunk_rows=1000,
+                                              on_progress=lambda f, rows: progress.append(rows))
+    assert len(df) == 6000
+    assert list(df["CustomerID"].iloc[[0, 4999, 5000, 5999]].astype(str)) == ["C0", "C4999", "C5000", "C5999"]
+    assert progress[-1] == 6000
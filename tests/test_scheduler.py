@@ -0,0 +1,44 @@
+import pytest
+
+
+class Overloaded(Exception):
+    status_code = 529
+
+
+@pytest.fixture
+def sched(app, monkeypatch):
+    sched = app["LLMScheduler"]()
+    monkeypatch.setitem(app, "get_llm_scheduler", lambda: sched)
+    monkeypatch.setitem(app, "backoff_delay", lambda attempt, retry_after_s=None: 0.0)
+    return sched
+
+
+def _tpm(sched, model):
+    bucket = sched._get("anthropic", model)["tpm"]
+    bucket._refill(bucket.updated)
+    return bucket.tokens, bucket.capacity
+
+
+def test_failed_attempts_return_their_reservation(app, sched, monkeypatch):
+    def fail(*args, **kwargs):
+        raise Overloaded("overloaded")
+
+    monkeypatch.setitem(app, "_call_llm_provider", fail)
+    text, meta = app["call_llm"]("anthropic", "claude-3-5-haiku-latest", "k", "sys", "hello", max_tokens=12000)
+    assert text == "" and meta["error"].kind == "server_error"
+    assert meta["error"].attempts == app["LLM_MAX_RETRIES"] + 1
+    tokens, capacity = _tpm(sched, "claude-3-5-haiku-latest")
+    assert tokens == pytest.approx(capacity)
+
+
+def test_failed_stream_attempts_return_their_reservation(app, sched, monkeypatch):
+    def fail(*args, **kwargs):
+        raise Overloaded("overloaded")
+        yield ""
+
+    monkeypatch.setitem(app, "_provider_deltas", fail)
+    stream = app["call_llm_stream"]("anthropic", "claude-3-5-haiku-latest", "k", "sys", "hello", max_tokens=12000)
+    assert "".join(stream) == ""
+    assert stream.meta["error"].kind == "server_error"
+    tokens, capacity = _tpm(sched, "claude-3-5-haiku-latest")
+    assert tokens == pytest.approx(capacity)